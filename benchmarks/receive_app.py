@@ -0,0 +1,132 @@
+"""
+Benchmark receiving AS2 messages through the full Django stack against the
+receive only application of ``pyas2.receive_app``.
+
+Run it from the root of the repository:
+
+    $ python benchmarks/receive_app.py --requests 500
+
+Both applications receive the same kind of unsigned and unencrypted messages,
+the database is an in-memory test database and the files are stored in a
+temporary folder. For each application half of the requests are timed and the
+other half are traced to report the peak memory allocated by a request.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "example.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from django.db import connection  # noqa: E402
+from pyas2lib import Message as As2Message  # noqa: E402
+from pyas2lib import Organization as As2Organization  # noqa: E402
+from pyas2lib import Partner as As2Partner  # noqa: E402
+
+from pyas2.models import Organization, Partner  # noqa: E402
+from pyas2.receive_app import get_receive_wsgi_application  # noqa: E402
+
+
+def build_environ(payload, size):
+    """Build the WSGI environ of a partner POST of a new AS2 message."""
+    as2message = As2Message(
+        sender=As2Organization(as2_name="benchpartner"),
+        receiver=As2Partner(as2_name="benchorg", compress=False),
+    )
+    as2message.build(payload * size, filename="bench.edi")
+    headers = dict(as2message.headers)
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/pyas2/as2receive",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8080",
+        "REMOTE_ADDR": "127.0.0.1",
+        "wsgi.url_scheme": "http",
+        "CONTENT_TYPE": headers.pop("Content-Type"),
+        "CONTENT_LENGTH": str(len(as2message.content)),
+        "wsgi.input": BytesIO(as2message.content),
+    }
+    for key, value in headers.items():
+        environ["HTTP_%s" % key.replace("-", "_").upper()] = value
+    return environ
+
+
+def send(application, environ):
+    """Send the request to the application and check that it succeeded."""
+    statuses = []
+    b"".join(application(environ, lambda status, headers: statuses.append(status)))
+    if not statuses[0].startswith("200"):
+        raise RuntimeError(f"Request failed with status {statuses[0]}")
+
+
+def run(application, environs):
+    """Send the requests to the application, returns the seconds per request
+    and the average peak of memory allocated by a request."""
+    start = time.perf_counter()
+    for environ in environs[: len(environs) // 2]:
+        send(application, environ)
+    elapsed = time.perf_counter() - start
+
+    peaks = []
+    for environ in environs[len(environs) // 2 :]:
+        tracemalloc.start()
+        send(application, environ)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return elapsed / (len(environs) // 2), sum(peaks) / len(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--size", type=int, default=1, help="Payload size in KB")
+    args = parser.parse_args()
+
+    settings.MEDIA_ROOT = tempfile.mkdtemp()
+    settings.ALLOWED_HOSTS = ["*"]
+    connection.creation.create_test_db(verbosity=0)
+    Organization.objects.create(name="Bench Org", as2_name="benchorg")
+    Partner.objects.create(
+        name="Bench Partner",
+        as2_name="benchpartner",
+        target_url="http://localhost:8080/pyas2/as2receive",
+        compress=False,
+        mdn=False,
+    )
+
+    applications = [
+        ("full stack", get_wsgi_application()),
+        ("receive app", get_receive_wsgi_application()),
+    ]
+    try:
+        # Warm up both applications before measuring
+        for _, application in applications:
+            send(application, build_environ(b"x" * 1024, args.size))
+
+        print(f"{args.requests} requests of {args.size} KB")
+        for name, application in applications:
+            environs = [
+                build_environ(b"x" * 1024, args.size) for _ in range(args.requests)
+            ]
+            per_request, peak = run(application, environs)
+            print(
+                f"{name:>12}: {per_request * 1000:.3f} ms/request, "
+                f"{peak / 1024:.1f} KB peak allocated per request"
+            )
+    finally:
+        shutil.rmtree(settings.MEDIA_ROOT)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,15 @@
 import os
 
 from django.contrib import admin
+from django.contrib import messages
 from django.http import HttpResponseRedirect
 from django.urls import reverse_lazy
 from django.utils.html import format_html
 
+from pyas2.breaker import CircuitBreaker
 from pyas2.models import Mdn
 from pyas2.models import Message
+from pyas2.models import MessageTimings
 from pyas2.models import Organization
 from pyas2.models import Partner
 from pyas2.models import PrivateKey
@@ -15,6 +18,15 @@ from pyas2.models import PublicCertificate
 from pyas2.forms import PartnerForm
 from pyas2.forms import PublicCertificateForm
 from pyas2.forms import PrivateKeyForm
+from pyas2.sender import BulkResender
+from pyas2.tasks import enqueue, get_backend
+
+# Number of messages resent by each task of the resend action
+RESEND_BATCH_SIZE = 500
+
+# Number of messages the resend action resends within the request when the
+# tasks run inline
+RESEND_INLINE_LIMIT = 100
 
 
 @admin.register(PrivateKey)
@@ -70,6 +82,7 @@ class PartnerAdmin(admin.ModelAdmin):
         "signature_cert",
         "mdn",
         "mdn_mode",
+        "circuit_state",
     ]
     list_filter = ("name", "as2_name")
     fieldsets = (
@@ -119,15 +132,45 @@ class PartnerAdmin(admin.ModelAdmin):
                 "fields": ("mdn", "mdn_mode", "mdn_sign"),
             },
         ),
+        (
+            "Rate Limits",
+            {
+                "classes": ("collapse", "wide"),
+                "fields": ("rate_limit_msgs", "rate_limit_bytes", "max_in_flight"),
+            },
+        ),
+        (
+            "Retry Settings",
+            {
+                "classes": ("collapse", "wide"),
+                "fields": ("retry_delay", "retry_max_delay", "retry_jitter"),
+            },
+        ),
         (
             "Advanced Settings",
             {
                 "classes": ("collapse", "wide"),
-                "fields": ("keep_filename", "cmd_send", "cmd_receive"),
+                "fields": (
+                    "keep_filename",
+                    "default_priority",
+                    "cmd_send",
+                    "cmd_receive",
+                ),
             },
         ),
     )
-    actions = ["send_message"]
+    actions = ["send_message", "reset_circuit"]
+
+    @staticmethod
+    def circuit_state(obj):
+        """Return the state of the circuit breaker of the partner."""
+        breaker = CircuitBreaker(obj)
+        state = breaker.state
+        if state == CircuitBreaker.CLOSED:
+            return state
+        return f"{state} ({breaker.failures} failures)"
+
+    circuit_state.short_description = "Circuit"
 
     def send_message(self, request, queryset):  # pylint: disable=W0613,R0201
         """Send the message to the first partner chosen by the user."""
@@ -138,6 +181,13 @@ class PartnerAdmin(admin.ModelAdmin):
 
     send_message.short_description = "Send a message to the selected partner"
 
+    def reset_circuit(self, request, queryset):  # pylint: disable=W0613,R0201
+        """Close the circuit breakers of the selected partners."""
+        for partner in queryset:
+            CircuitBreaker(partner).record_success()
+
+    reset_circuit.short_description = "Reset the circuit of the selected partners"
+
 
 @admin.register(Organization)
 class OrganizationAdmin(admin.ModelAdmin):
@@ -147,19 +197,41 @@ class OrganizationAdmin(admin.ModelAdmin):
     list_filter = ("name", "as2_name")
 
 
+def timing_column(phase):
+    """Return a sortable list column showing the time taken by a phase of the
+    message."""
+    field = f"{phase}_ms"
+
+    def column(obj):
+        timings = getattr(obj, "timings", None)
+        return getattr(timings, field, None)
+
+    column.short_description = MessageTimings._meta.get_field(field).verbose_name
+    column.admin_order_field = f"timings__{field}"
+    column.__name__ = f"timing_{phase}"
+    return column
+
+
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     """Admin class for the Message model."""
 
     search_fields = ("message_id", "payload")
 
-    list_filter = ("direction", "status", "organization__as2_name", "partner__as2_name")
+    list_filter = (
+        "direction",
+        "status",
+        "priority",
+        "organization__as2_name",
+        "partner__as2_name",
+    )
 
     list_display = [
         "message_id",
         "timestamp",
         "status",
         "direction",
+        "priority",
         "organization",
         "partner",
         "compressed",
@@ -167,7 +239,10 @@ class MessageAdmin(admin.ModelAdmin):
         "signed",
         "download_file",
         "mdn_url",
+        *(timing_column(phase) for phase in MessageTimings.PHASES),
     ]
+    list_select_related = ("organization", "partner", "mdn", "timings")
+    actions = ["resend_messages"]
 
     @staticmethod
     def mdn_url(obj):
@@ -198,6 +273,41 @@ class MessageAdmin(admin.ModelAdmin):
     download_file.allow_tags = True
     download_file.short_description = "Payload"
 
+    def resend_messages(self, request, queryset):
+        """Resend the selected outbound messages concurrently, with the task
+        backend unless it runs the tasks inline, in which case the selection
+        is resent within the request and limited to ``RESEND_INLINE_LIMIT``
+        messages."""
+        queryset = queryset.order_by("timestamp")
+        if not get_backend().runs_inline:
+            message_ids = list(queryset.values_list("pk", flat=True))
+            for start in range(0, len(message_ids), RESEND_BATCH_SIZE):
+                enqueue(
+                    "resend_messages",
+                    message_ids=message_ids[start : start + RESEND_BATCH_SIZE],
+                )
+            self.message_user(
+                request, f"Queued {len(message_ids)} messages for resending."
+            )
+            return
+
+        if queryset.count() > RESEND_INLINE_LIMIT:
+            self.message_user(
+                request,
+                f"Select at most {RESEND_INLINE_LIMIT} messages to resend, use the "
+                "resendas2messages command or a background TASK_BACKEND for more.",
+                messages.ERROR,
+            )
+            return
+        sent, failed = BulkResender().run(queryset)
+        self.message_user(
+            request,
+            f"Resent {sent} messages, {failed} failed.",
+            messages.WARNING if failed else messages.SUCCESS,
+        )
+
+    resend_messages.short_description = "Resend the selected outbound messages"
+
     def has_add_permission(self, request):
         return False
 
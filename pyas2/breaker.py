@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from django.core.cache import caches
+
+from pyas2 import settings
+from pyas2.ratelimit import cache_lock
+
+logger = logging.getLogger("pyas2")
+
+
+class CircuitOpen(Exception):
+    """Raised when a send is short-circuited because the partner is down."""
+
+
+class CircuitBreaker:
+    """Circuit breaker for the outbound traffic to a partner's target host.
+
+    After ``CIRCUIT_BREAKER_THRESHOLD`` consecutive failures the circuit is
+    opened and sends fail immediately without opening a connection. Once the
+    ``CIRCUIT_BREAKER_COOLDOWN`` has passed the circuit is half-open and a
+    single probe send is let through, its result closes or re-opens the
+    circuit. The state is shared across processes through the cache.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, partner, cache=None):
+        self.partner = partner
+        self.cache = cache or caches[settings.CIRCUIT_BREAKER_CACHE]
+        host = urlsplit(partner.target_url).netloc
+        self.key = f"pyas2:breaker:{partner.as2_name}:{host}"
+
+    def _get(self):
+        return self.cache.get(self.key, {"failures": 0, "opened_at": None})
+
+    @classmethod
+    def _state(cls, opened_at):
+        if opened_at is None:
+            return cls.CLOSED
+        if time.time() - opened_at < settings.CIRCUIT_BREAKER_COOLDOWN:
+            return cls.OPEN
+        return cls.HALF_OPEN
+
+    @property
+    def state(self):
+        """Return the current state of the circuit."""
+        return self._state(self._get()["opened_at"])
+
+    @property
+    def failures(self):
+        """Return the number of consecutive failures."""
+        return self._get()["failures"]
+
+    def record_success(self):
+        """Close the circuit after a successful send."""
+        with cache_lock(self.cache, self.key):
+            self.cache.delete(self.key)
+            self.cache.delete(f"{self.key}:probe")
+
+    def record_failure(self):
+        """Count the failed send and open the circuit once the threshold is hit."""
+        with cache_lock(self.cache, self.key):
+            state = self._get()
+            state["failures"] += 1
+            if state["failures"] >= settings.CIRCUIT_BREAKER_THRESHOLD:
+                if state["opened_at"] is None:
+                    logger.warning(
+                        f'Opening circuit to partner "{self.partner.as2_name}" after '
+                        f'{state["failures"]} consecutive failures.'
+                    )
+                state["opened_at"] = time.time()
+            self.cache.set(self.key, state, timeout=None)
+            self.cache.delete(f"{self.key}:probe")
+
+    @contextmanager
+    def guard(self):
+        """Let the send in the block through unless the circuit is open and
+        record its outcome."""
+        current = self._get()
+        state = self._state(current["opened_at"])
+        if state == self.OPEN or (
+            state == self.HALF_OPEN
+            and not self.cache.add(
+                f"{self.key}:probe", 1, timeout=settings.CIRCUIT_BREAKER_COOLDOWN
+            )
+        ):
+            raise CircuitOpen(
+                f'Circuit to partner "{self.partner.as2_name}" is open after '
+                f'{current["failures"]} consecutive failures.'
+            )
+
+        recovering = bool(current["failures"] or current["opened_at"])
+        try:
+            yield
+        except requests.exceptions.RequestException as e:
+            # Client errors mean the partner is up and responding
+            response = getattr(e, "response", None)
+            if response is None or response.status_code >= 500:
+                self.record_failure()
+            elif recovering:
+                self.record_success()
+            raise
+        except Exception:
+            self.cache.delete(f"{self.key}:probe")
+            raise
+        if recovering:
+            self.record_success()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from dataclasses import dataclass
+
+from django.core.cache import caches
+from django.utils import timezone
+from oscrypto import asymmetric
+from pyas2lib import Partner as As2Partner
+from pyas2lib.utils import (
+    extract_certificate_info,
+    pem_to_der,
+    verify_certificate_chain,
+)
+
+from pyas2 import settings
+
+
+def get_validation_cache_key(cert, cert_ca, ignore_self_signed=True):
+    """Return the cache key for the chain validation of the certificate against
+    the CA bundle, made up of their SHA-256 fingerprints and of whether self
+    signed certificates are accepted."""
+    cert_fp = hashlib.sha256(bytes(cert)).hexdigest()
+    ca_fp = hashlib.sha256(bytes(cert_ca or b"")).hexdigest()
+    return f"pyas2:certchain:{cert_fp}:{ca_fp}:{int(bool(ignore_self_signed))}"
+
+
+def invalidate_certificate_validation(cert, cert_ca):
+    """Drop the cached chain validations of the certificate."""
+    cache = caches[settings.CERT_VALIDATION_CACHE]
+    cache.delete_many(
+        [
+            get_validation_cache_key(cert, cert_ca, ignore_self_signed)
+            for ignore_self_signed in (True, False)
+        ]
+    )
+
+
+def get_chain_valid_to(cert, cert_ca):
+    """Return the earliest expiry of the certificate and of the certificates
+    of the CA bundle, or None if none of them has one."""
+    certificates = [pem_to_der(cert, return_multiple=False)]
+    if cert_ca:
+        certificates.extend(pem_to_der(cert_ca))
+    expiries = [extract_certificate_info(der)["valid_to"] for der in certificates]
+    return min((valid_to for valid_to in expiries if valid_to), default=None)
+
+
+def validate_certificate_chain(cert, cert_ca, ignore_self_signed=True):
+    """Verify the certificate against the CA bundle unless a successful
+    validation is cached, raises an AS2Exception if the certificate is not
+    valid.
+
+    Successful validations are cached for ``CERT_VALIDATION_CACHE_TTL``
+    seconds at most and never beyond the expiry of the certificate or of any
+    certificate of the CA bundle.
+    """
+    cache = caches[settings.CERT_VALIDATION_CACHE]
+    key = get_validation_cache_key(cert, cert_ca, ignore_self_signed)
+    if cache.get(key):
+        return
+
+    verify_certificate_chain(
+        pem_to_der(cert, return_multiple=False),
+        pem_to_der(cert_ca) if cert_ca else [],
+        ignore_self_signed=ignore_self_signed,
+    )
+
+    timeout = settings.CERT_VALIDATION_CACHE_TTL
+    valid_to = get_chain_valid_to(cert, cert_ca)
+    if valid_to:
+        remaining = (valid_to - timezone.now()).total_seconds()
+        timeout = min(timeout, int(remaining))
+    if timeout > 0:
+        cache.set(key, True, timeout=timeout)
+
+
+@dataclass
+class CachedAs2Partner(As2Partner):
+    """Partner of pyas2lib that caches the validation of the certificate chains."""
+
+    def load_verify_cert(self):
+        if self.validate_certs:
+            validate_certificate_chain(
+                self.verify_cert, self.verify_cert_ca, self.ignore_self_signed
+            )
+        return asymmetric.load_certificate(self.verify_cert)
+
+    def load_encrypt_cert(self):
+        if self.validate_certs:
+            validate_certificate_chain(
+                self.encrypt_cert, self.encrypt_cert_ca, self.ignore_self_signed
+            )
+        return asymmetric.load_certificate(self.encrypt_cert)
@@ -211,4 +211,10 @@ class SendAs2MessageForm(forms.Form):
         queryset=Organization.objects.all(), empty_label=None
     )
     partner = forms.ModelChoiceField(queryset=Partner.objects.all())
+    priority = forms.TypedChoiceField(
+        choices=[("", _("Partner Default"))] + list(Partner.PRIORITY_CHOICES),
+        coerce=int,
+        empty_value=None,
+        required=False,
+    )
     file = forms.FileField()
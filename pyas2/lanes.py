@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+from pyas2 import settings
+
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+
+# Names of the priorities as used in the outbox folders and commands
+PRIORITY_NAMES = {
+    "high": PRIORITY_HIGH,
+    "normal": PRIORITY_NORMAL,
+    "low": PRIORITY_LOW,
+}
+
+
+class PriorityLanes:
+    """Queue of outbound work split into one lane per priority.
+
+    Items are dispatched from the highest priority lane first. To avoid
+    starving the lower lanes under a constant load of urgent messages, a
+    waiting lane that has been skipped ``starvation_limit`` times in a row is
+    served next regardless of its priority.
+    """
+
+    def __init__(self, starvation_limit=None):
+        if starvation_limit is None:
+            starvation_limit = settings.PRIORITY_STARVATION_LIMIT
+        self.starvation_limit = starvation_limit
+        self.lanes = {}
+        self.skipped = {}
+
+    def push(self, priority, item):
+        """Add the item to the end of the lane for the given priority."""
+        self.lanes.setdefault(priority, deque()).append(item)
+        self.skipped.setdefault(priority, 0)
+
+    def pop(self):
+        """Remove and return the next item to be dispatched."""
+        waiting = sorted(p for p, lane in self.lanes.items() if lane)
+        if not waiting:
+            raise IndexError("pop from empty lanes")
+
+        lane = waiting[0]
+        starved = [p for p in waiting if self.skipped[p] >= self.starvation_limit]
+        if starved:
+            lane = max(starved, key=lambda p: (self.skipped[p], -p))
+
+        for priority in waiting:
+            self.skipped[priority] += 1
+        self.skipped[lane] = 0
+        return self.lanes[lane].popleft()
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def __iter__(self):
+        while len(self):
+            yield self.pop()
@@ -0,0 +1,290 @@
+import dataclasses
+import itertools
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from pyas2lib import Mdn as AS2Mdn
+from pyas2lib import Message as AS2Message
+
+from pyas2.models import Organization
+from pyas2.models import Partner
+
+
+def parse_sizes(value):
+    """Parse the payload size distribution, a comma separated list of sizes in
+    bytes each with an optional weight, e.g. ``1024:9,1048576:1``."""
+    sizes, weights = [], []
+    try:
+        for item in value.split(","):
+            size, _, weight = item.partition(":")
+            sizes.append(int(size))
+            weights.append(float(weight or 1))
+    except ValueError as e:
+        raise CommandError(f'Invalid payload sizes "{value}"') from e
+    return sizes, weights
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of the sorted values."""
+    if not values:
+        return 0
+    rank = max(math.ceil(pct / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class LoadTest:
+    """Send AS2 messages built with the profiles of an organization and a
+    partner to a receive URL and collect the results."""
+
+    def __init__(self, as2org, as2partner, url, sizes, weights, rate=0, auth=None):
+        self.as2org = as2org
+        self.as2partner = as2partner
+        self.url = url
+        self.sizes = sizes
+        self.weights = weights
+        self.rate = rate
+        self.auth = auth
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.local = threading.local()
+        self.latencies = []
+        self.errors = Counter()
+        self.mdns = Counter()
+        self.sent_bytes = 0
+        self.start = None
+
+    def wait_for_turn(self):
+        """Block until the next message can be sent at the requested rate."""
+        with self.lock:
+            index = next(self.sequence)
+        if self.rate:
+            delay = self.start + index / self.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    @property
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send_one(self, _):
+        """Build and send a message and record its latency and outcome."""
+        size = random.choices(self.sizes, self.weights)[0]
+        as2message = AS2Message(sender=self.as2org, receiver=self.as2partner)
+        as2message.build(
+            os.urandom(size),
+            filename="loadtest.bin",
+            disposition_notification_to="no-reply@pyas2.com",
+        )
+        self.wait_for_turn()
+
+        started = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.url,
+                auth=self.auth,
+                headers=as2message.headers,
+                data=as2message.content,
+            )
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            error = f"HTTP {e.response.status_code}"
+        except requests.exceptions.RequestException as e:
+            error = type(e).__name__
+        else:
+            error = None
+        latency = time.perf_counter() - started
+
+        mdn_status = None
+        if error is None:
+            mdn_status = self.verify_mdn(as2message, response)
+        with self.lock:
+            self.latencies.append(latency)
+            if error:
+                self.errors[error] += 1
+            else:
+                self.sent_bytes += len(as2message.content)
+                self.mdns[mdn_status] += 1
+
+    def verify_mdn(self, as2message, response):
+        """Return the outcome of the MDN requested with the message."""
+        if not self.as2partner.mdn_mode:
+            return "not requested"
+        if self.as2partner.mdn_mode == "ASYNC":
+            return "asynchronous, not verified"
+
+        mdn_headers = {k.lower(): v for k, v in response.headers.items()}
+        if "content-type" not in mdn_headers:
+            return "missing"
+        mdn_content = (
+            f'message-id: {mdn_headers.get("message-id", as2message.message_id)}\n'
+            f'content-type: {mdn_headers["content-type"]}\n\n'
+        ).encode("utf-8") + response.content
+        try:
+            status, detailed_status = AS2Mdn().parse(
+                mdn_content, lambda message_id, partner_id: as2message
+            )
+        except Exception as e:  # pylint: disable=W0703
+            return f"invalid: {e}"
+        if detailed_status:
+            return f"{status}: {detailed_status}"
+        return status
+
+    def run(self, messages, concurrency):
+        """Send the messages from the concurrent workers and return the
+        elapsed seconds."""
+        self.start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(self.send_one, range(messages)))
+        return time.perf_counter() - self.start
+
+
+class Command(BaseCommand):
+    """Command to load test an AS2 server."""
+
+    help = (
+        "Send concurrent AS2 messages built with the profiles of an organization "
+        "and a partner to a receive URL, and report the throughput, latencies, "
+        "errors and MDN results"
+    )
+    args = "<organization_as2name partner_as2name>"
+
+    def add_arguments(self, parser):
+        parser.add_argument("org_as2name", type=str)
+        parser.add_argument("partner_as2name", type=str)
+        parser.add_argument(
+            "--url",
+            dest="url",
+            default=None,
+            help="Receive URL to send the messages to, defaults to the partner's URL",
+        )
+        parser.add_argument(
+            "--messages",
+            type=int,
+            dest="messages",
+            default=100,
+            help="Number of messages to send",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            dest="concurrency",
+            default=10,
+            help="Number of messages sent at the same time",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            dest="rate",
+            default=0,
+            help="Max number of messages sent per second, unlimited by default",
+        )
+        parser.add_argument(
+            "--sizes",
+            dest="sizes",
+            default="1024",
+            help=(
+                "Payload sizes in bytes with optional weights, "
+                "e.g. 1024:9,1048576:1 for one large payload in ten"
+            ),
+        )
+        parser.add_argument(
+            "--mdn",
+            choices=["partner", "none", "sync", "async"],
+            dest="mdn",
+            default="partner",
+            help="MDN requested with the messages, defaults to the partner's setting",
+        )
+        parser.add_argument(
+            "--mdn-url",
+            dest="mdn_url",
+            default=None,
+            help="URL the asynchronous MDNs are returned to",
+        )
+
+    def handle(self, *args, **options):
+        # Check if organization and partner exists
+        try:
+            org = Organization.objects.get(as2_name=options["org_as2name"])
+        except Organization.DoesNotExist as e:
+            raise CommandError(
+                f'Organization "{options["org_as2name"]}" does not exist'
+            ) from e
+        try:
+            partner = Partner.objects.get(as2_name=options["partner_as2name"])
+        except Partner.DoesNotExist as e:
+            raise CommandError(
+                f'Partner "{options["partner_as2name"]}" does not exist'
+            ) from e
+        if options["messages"] < 1 or options["concurrency"] < 1:
+            raise CommandError("The messages and concurrency must be at least 1")
+
+        # Set up the MDN requested with the messages
+        as2org = org.as2org
+        if options["mdn_url"]:
+            as2org = dataclasses.replace(as2org, mdn_url=options["mdn_url"])
+        mdn_modes = {
+            "partner": partner.mdn_mode if partner.mdn else None,
+            "none": None,
+            "sync": "SYNC",
+            "async": "ASYNC",
+        }
+        as2partner = dataclasses.replace(
+            partner.as2partner, mdn_mode=mdn_modes[options["mdn"]]
+        )
+        if as2partner.mdn_mode == "ASYNC" and not as2org.mdn_url:
+            raise CommandError("The MDN URL must be set for asynchronous MDNs")
+
+        auth = None
+        if partner.http_auth:
+            auth = (partner.http_auth_user, partner.http_auth_pass)
+        sizes, weights = parse_sizes(options["sizes"])
+        load_test = LoadTest(
+            as2org,
+            as2partner,
+            options["url"] or partner.target_url,
+            sizes,
+            weights,
+            rate=options["rate"],
+            auth=auth,
+        )
+        self.stdout.write(
+            f'Sending {options["messages"]} messages to "{load_test.url}" with a '
+            f'concurrency of {options["concurrency"]}.'
+        )
+        elapsed = load_test.run(options["messages"], options["concurrency"])
+        self.report(load_test, elapsed)
+
+    def report(self, load_test, elapsed):
+        """Write the results of the load test."""
+        latencies = sorted(load_test.latencies)
+        succeeded = sum(load_test.mdns.values())
+        self.stdout.write(f"Elapsed: {elapsed:.2f}s")
+        self.stdout.write(
+            f"Throughput: {len(latencies) / elapsed:.1f} messages/s, "
+            f"{load_test.sent_bytes / elapsed / 1024:.1f} KB/s"
+        )
+        self.stdout.write(
+            "Latency (ms): "
+            + ", ".join(
+                f"p{pct}={percentile(latencies, pct) * 1000:.1f}"
+                for pct in (50, 90, 95, 99)
+            )
+            + f", max={(latencies[-1] if latencies else 0) * 1000:.1f}"
+        )
+        self.stdout.write(f"Succeeded: {succeeded}")
+        self.stdout.write(f"Failed: {sum(load_test.errors.values())}")
+        for error, count in load_test.errors.most_common():
+            self.stdout.write(f"  {error}: {count}")
+        self.stdout.write("MDNs:")
+        for status, count in load_test.mdns.most_common():
+            self.stdout.write(f"  {status}: {count}")
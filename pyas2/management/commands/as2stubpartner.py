@@ -0,0 +1,112 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from pyas2.stubpartner import StubPartnerServer
+
+
+class Command(BaseCommand):
+    """Command to run a stub AS2 partner."""
+
+    help = (
+        "Run a stub AS2 partner that receives messages and returns MDNs, with "
+        "artificial latency, errors and bandwidth limits for benchmarking"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--host", dest="host", default="127.0.0.1", help="Address to listen on"
+        )
+        parser.add_argument(
+            "--port", type=int, dest="port", default=8090, help="Port to listen on"
+        )
+        parser.add_argument(
+            "--key",
+            dest="key",
+            default=None,
+            help="Private key in PEM format used to decrypt messages and sign MDNs",
+        )
+        parser.add_argument(
+            "--key-pass", dest="key_pass", default=None, help="Password of the key"
+        )
+        parser.add_argument(
+            "--cert",
+            dest="cert",
+            default=None,
+            help="Certificate in PEM format used to verify the message signatures",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            dest="latency",
+            default=0,
+            help="Seconds added to each request",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            dest="jitter",
+            default=0,
+            help="Max random seconds added to the latency of each request",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            dest="error_rate",
+            default=0,
+            help="Share of the requests that fail, between 0 and 1",
+        )
+        parser.add_argument(
+            "--error-status",
+            type=int,
+            dest="error_status",
+            default=500,
+            help="HTTP status of the failed requests",
+        )
+        parser.add_argument(
+            "--bandwidth",
+            type=int,
+            dest="bandwidth",
+            default=0,
+            help="Max bytes per second transferred by each request, unlimited by default",
+        )
+        parser.add_argument(
+            "--mdn-delay",
+            type=float,
+            dest="mdn_delay",
+            default=0,
+            help="Seconds to wait before returning an asynchronous MDN",
+        )
+
+    def handle(self, *args, **options):
+        key = cert = None
+        try:
+            if options["key"]:
+                with open(options["key"], "rb") as key_file:
+                    key = key_file.read()
+            if options["cert"]:
+                with open(options["cert"], "rb") as cert_file:
+                    cert = cert_file.read()
+        except OSError as e:
+            raise CommandError(f"Failed to read the key or certificate: {e}") from e
+
+        server = StubPartnerServer(
+            (options["host"], options["port"]),
+            key=key,
+            key_pass=options["key_pass"],
+            cert=cert,
+            latency=options["latency"],
+            jitter=options["jitter"],
+            error_rate=options["error_rate"],
+            error_status=options["error_status"],
+            bandwidth=options["bandwidth"],
+            mdn_delay=options["mdn_delay"],
+        )
+        self.stdout.write(f"Stub partner listening on {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            for outcome, count in sorted(server.stats.items()):
+                self.stdout.write(f"{outcome}: {count}")
@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from pyas2 import settings
+from pyas2.tasks import TASKS, DatabaseBackend, enqueue
+
+
+class Command(BaseCommand):
+    """Command to run the tasks queued in the database."""
+
+    help = (
+        "Run the tasks queued in the database by the DatabaseBackend task backend, "
+        "or enqueue a task"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            dest="once",
+            default=False,
+            help="Stop once the queue is empty instead of waiting for new tasks",
+        )
+        parser.add_argument(
+            "--enqueue",
+            dest="enqueue",
+            default=None,
+            help="Enqueue the task with its default arguments, e.g. compact_store, and exit",
+        )
+
+    def handle(self, *args, **options):
+        if options["enqueue"]:
+            if options["enqueue"] not in TASKS:
+                raise CommandError(
+                    f'Unknown task "{options["enqueue"]}", use one of: '
+                    f'{", ".join(sorted(TASKS))}.'
+                )
+            enqueue(options["enqueue"])
+            self.stdout.write(f'Enqueued task "{options["enqueue"]}".')
+            return
+
+        self.stdout.write("Running the queued tasks.")
+        done, failed = 0, 0
+        while True:
+            queued_task = DatabaseBackend.claim()
+            if queued_task is None:
+                if options["once"]:
+                    break
+                time.sleep(settings.TASK_POLL_INTERVAL)
+                continue
+            if DatabaseBackend.process(queued_task):
+                done += 1
+            else:
+                failed += 1
+                self.stdout.write(f'Task "{queued_task.name}" failed.')
+        self.stdout.write(f"Ran {done} tasks, {failed} failed.")
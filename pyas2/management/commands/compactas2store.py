@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from pyas2.packs import list_day_folders, pack_folder
+
+
+class Command(BaseCommand):
+    """Command to pack the day folders of the message store."""
+
+    help = (
+        "Pack the files of each closed day folder of the message and MDN stores "
+        "into a single compressed pack with an index"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep-days",
+            type=int,
+            dest="keep_days",
+            default=1,
+            help="Number of most recent days that are not packed, including today",
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now().date() - timedelta(max(options["keep_days"], 1) - 1)
+        self.stdout.write(f"Packing the store folders of the days before {before}.")
+        for folder in list_day_folders(before):
+            packed = pack_folder(folder)
+            if packed:
+                self.stdout.write(f'Packed {packed} files of folder "{folder}".')
+        self.stdout.write("Packed all the closed store folders.")
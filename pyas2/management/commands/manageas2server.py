@@ -1,14 +1,16 @@
 import os
 from datetime import timedelta
-from email.parser import BytesHeaderParser
 
-import requests
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from pyas2lib import Message as AS2Message
 
 from pyas2 import settings
+from pyas2.breaker import CircuitBreaker
+from pyas2.lanes import PriorityLanes
 from pyas2.models import Message, Mdn
+from pyas2.packs import delete_day_folders, delete_packs
+from pyas2.tracing import SPAN_KIND_CLIENT, start_span
 
 
 class Command(BaseCommand):
@@ -29,6 +31,14 @@ class Command(BaseCommand):
             help="Cleans up all the old messages and archived files.",
         )
 
+        parser.add_argument(
+            "--by-day",
+            action="store_true",
+            dest="by_day",
+            default=False,
+            help="Clean up whole days of messages and archived files at once.",
+        )
+
         parser.add_argument(
             "--retry",
             action="store_true",
@@ -45,8 +55,31 @@ class Command(BaseCommand):
             help="Handle sending and receiving of Asynchronous MDNs.",
         )
 
+    @staticmethod
+    def prioritize(messages):
+        """Return the messages in the order they are dispatched from the
+        priority lanes."""
+        lanes = PriorityLanes()
+        for message in messages:
+            lanes.push(message.priority, message)
+        return lanes
+
     def retry(self, retry_msg):
         """Retry sending the message to the partner."""
+        # Wait for the circuit to the partner to close without counting the
+        # retry, the send would be short-circuited without an attempt
+        if CircuitBreaker(retry_msg.partner).state == CircuitBreaker.OPEN:
+            self.stdout.write(
+                "Postponed the retry of message with ID %s, the circuit to the "
+                "partner is open" % retry_msg.message_id
+            )
+            retry_msg.next_attempt_at = (
+                timezone.now()
+                + retry_msg.partner.get_retry_delay(retry_msg.retries or 0)
+            )
+            retry_msg.save(update_fields=["next_attempt_at"])
+            return
+
         # Increase the retry count
         if not retry_msg.retries:
             retry_msg.retries = 1
@@ -63,33 +96,51 @@ class Command(BaseCommand):
                 retry_msg.detailed_status = "Retry count exceeded the limit."
 
             retry_msg.status = "E"
+            retry_msg.next_attempt_at = None
             retry_msg.save()
             return
 
         self.stdout.write("Retry send the message with ID %s" % retry_msg.message_id)
 
-        # Build and resend the AS2 message
+        # Send the envelope of the first send again, or build the AS2 message
+        # again for messages sent before the envelopes were kept
+        envelope = retry_msg.load_envelope()
+        if envelope:
+            retry_msg.send_message(*envelope)
+            return
+
         as2message = AS2Message(
             sender=retry_msg.organization.as2org,
             receiver=retry_msg.partner.as2partner,
         )
-        as2message.build(
-            retry_msg.payload.read(),
-            filename=os.path.basename(retry_msg.payload.name),
-            subject=retry_msg.partner.subject,
-            content_type=retry_msg.partner.content_type,
-        )
+        with start_span("as2.build") as build_span:
+            as2message.build(
+                retry_msg.payload.read(),
+                filename=os.path.basename(retry_msg.payload.name),
+                subject=retry_msg.partner.subject,
+                content_type=retry_msg.partner.content_type,
+            )
+        retry_msg.add_timing("crypto", build_span.duration)
         retry_msg.send_message(as2message.headers, as2message.content)
 
     def handle(self, *args, **options):
 
         if options["retry"]:
             self.stdout.write("Retrying all failed outbound messages")
-            # Get the list of all messages with status retry
-            failed_msgs = Message.objects.filter(status="R", direction="OUT")
-
-            for failed_msg in failed_msgs:
-                self.retry(failed_msg)
+            # Get the messages with status retry that are due, in batches.
+            # Retried messages are either done or scheduled after the start
+            # of the run so every batch only contains new messages.
+            retry_start = timezone.now()
+            while True:
+                failed_msgs = Message.objects.filter(
+                    status="R", direction="OUT", next_attempt_at__lte=retry_start
+                ).order_by("next_attempt_at")[: settings.RETRY_BATCH_SIZE]
+                failed_msgs = list(failed_msgs)
+                if not failed_msgs:
+                    break
+
+                for failed_msg in self.prioritize(failed_msgs):
+                    self.retry(failed_msg)
 
             self.stdout.write("Processed all failed outbound messages")
 
@@ -100,38 +151,17 @@ class Command(BaseCommand):
             self.stdout.write("Sending all pending asynchronous MDNs")
             in_pending_mdns = Mdn.objects.filter(status="P")
 
-            for pending_mdn in in_pending_mdns:
-                # Parse the MDN headers from text
-                header_parser = BytesHeaderParser()
-                mdn_headers = header_parser.parsebytes(pending_mdn.headers.read())
-                try:
-                    # Set http basic auth if enabled in the partner profile
-                    auth = None
-                    if (
-                        pending_mdn.message.partner
-                        and pending_mdn.message.partner.http_auth
-                    ):
-                        auth = (
-                            pending_mdn.message.partner.http_auth_user,
-                            pending_mdn.message.partner.http_auth_pass,
+            for pending_mdn in in_pending_mdns.select_related("message__partner"):
+                # Post the MDN message to the url provided on the original as2
+                # message, the MDNs sent by the task backend meanwhile are
+                # skipped
+                with start_span("as2.mdn.send", kind=SPAN_KIND_CLIENT) as span:
+                    span.link_message(pending_mdn.message.message_id)
+                    if not pending_mdn.send_async_mdn():
+                        self.stdout.write(
+                            'Failed to send MDN "%s"' % pending_mdn.mdn_id
                         )
 
-                    # Post the MDN message to the url provided on the
-                    # original as2 message
-                    requests.post(
-                        pending_mdn.return_url,
-                        auth=auth,
-                        headers=dict(mdn_headers.items()),
-                        data=pending_mdn.payload.read(),
-                    )
-                    pending_mdn.status = "S"
-                except requests.exceptions.RequestException as e:
-                    self.stdout.write(
-                        'Failed to send MDN "%s", error: %s' % (pending_mdn.mdn_id, e)
-                    )
-                finally:
-                    pending_mdn.save()
-
             # Second Part checks if MDNs have been received for outbound
             # messages to partners
             self.stdout.write(
@@ -147,7 +177,7 @@ class Command(BaseCommand):
             )
 
             # Retry sending the message if not MDN received.
-            for pending_msg in out_pending_msgs:
+            for pending_msg in self.prioritize(out_pending_msgs.order_by("timestamp")):
                 self.retry(pending_msg)
 
             self.stdout.write("Successfully processed all pending mdns.")
@@ -158,19 +188,25 @@ class Command(BaseCommand):
             self.stdout.write(
                 "Delete all messages older than %s" % settings.MAX_ARCH_DAYS
             )
-            old_message = Message.objects.filter(timestamp__lt=max_archive_dt).order_by(
-                "timestamp"
-            )
-
-            for message in old_message:
-                message.payload.delete()
-                message.headers.delete()
-
-                try:
-                    message.mdn.payload.delete()
-                    message.mdn.headers.delete()
-                    message.mdn.delete()
-                except Mdn.DoesNotExist:
-                    pass
-                message.delete()
+            if options["by_day"]:
+                days = Message.objects.delete_by_day(max_archive_dt)
+                delete_day_folders(max_archive_dt.date())
+                self.stdout.write(f"Deleted {days} days of messages")
+            else:
+                old_message = Message.objects.filter(
+                    timestamp__lt=max_archive_dt
+                ).order_by("timestamp")
+
+                for message in old_message:
+                    message.payload.delete()
+                    if hasattr(message, "timings") and message.timings.profile:
+                        message.timings.profile.delete()
+
+                    try:
+                        message.mdn.payload.delete()
+                        message.mdn.delete()
+                    except Mdn.DoesNotExist:
+                        pass
+                    message.delete()
+                delete_packs(max_archive_dt.date())
             self.stdout.write("Cleanup maintenance process completed")
@@ -0,0 +1,85 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.utils import timezone
+
+from pyas2 import settings
+from pyas2.models import Mdn, Message, MessageTimings
+from pyas2.packs import delete_day_folders
+from pyas2.partitions import TablePartitioner, interval_start, next_interval
+
+# Partitioned models, the message is partitioned before its MDN
+PARTITIONED_MODELS = [Message, Mdn]
+
+
+class Command(BaseCommand):
+    """Command to manage the partitions of the message and MDN tables."""
+
+    help = (
+        "Create the future partitions of the message and MDN tables and drop the "
+        "partitions older than MAX_ARCH_DAYS, PostgreSQL only"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--setup",
+            action="store_true",
+            dest="setup",
+            default=False,
+            help="Convert the message and MDN tables to partitioned tables",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning is only supported on PostgreSQL.")
+        if settings.PARTITION_INTERVAL not in ("day", "month"):
+            raise CommandError(
+                f'Invalid PARTITION_INTERVAL "{settings.PARTITION_INTERVAL}", '
+                'use "day" or "month".'
+            )
+
+        today = timezone.now().date()
+        last_day = today
+        for _ in range(settings.PARTITION_PREMAKE):
+            last_day = next_interval(
+                interval_start(last_day, settings.PARTITION_INTERVAL),
+                settings.PARTITION_INTERVAL,
+            )
+        before = today - timedelta(settings.MAX_ARCH_DAYS)
+
+        for model in PARTITIONED_MODELS:
+            partitioner = TablePartitioner(model)
+            table = partitioner.table
+            if options["setup"]:
+                if partitioner.setup():
+                    self.stdout.write(
+                        f'Partitioned table "{table}", the original table has been '
+                        f'renamed to "{table}_unpartitioned" and can be dropped.'
+                    )
+                else:
+                    self.stdout.write(f'Table "{table}" is already partitioned.')
+            elif not partitioner.is_partitioned():
+                raise CommandError(
+                    f'Table "{table}" is not partitioned, run the command with --setup.'
+                )
+
+            if model is Message:
+                expired_keys = partitioner.expired_keys(before)
+            created = partitioner.create_partitions(today, last_day)
+            dropped = partitioner.drop_partitions(before)
+            self.stdout.write(
+                f'Created {created} and dropped {dropped} partitions of table "{table}".'
+            )
+
+        # The foreign keys to the messages are dropped with the partitioning
+        if expired_keys:
+            message_partitioner = TablePartitioner(Message)
+            for model in [Mdn, MessageTimings]:
+                message_partitioner.delete_orphans(model, expired_keys)
+            self.stdout.write("Deleted the MDNs and timings of the dropped messages.")
+
+        # Delete the stored files of the days whose partitions were dropped
+        delete_day_folders(interval_start(before, settings.PARTITION_INTERVAL))
+        self.stdout.write("Deleted the stored files of the dropped partitions.")
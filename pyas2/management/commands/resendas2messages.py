@@ -0,0 +1,104 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from pyas2.models import Message
+from pyas2.sender import BulkResender
+
+# Number of resent messages between two progress reports
+PROGRESS_INTERVAL = 100
+
+
+def parse_timestamp(value, end_of_day=False):
+    """Parse a date or date and time argument into an aware datetime."""
+    timestamp = parse_datetime(value)
+    if timestamp is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f'Invalid date "{value}"')
+        timestamp = datetime.combine(date, time.max if end_of_day else time.min)
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return timestamp
+
+
+class Command(BaseCommand):
+    """Command to resend outbound AS2 messages."""
+
+    help = (
+        "Resend the outbound messages matching the filters concurrently, "
+        "rebuilding them from their stored payloads"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--partner", dest="partner", default=None, help="AS2 name of the partner"
+        )
+        parser.add_argument(
+            "--organization",
+            dest="organization",
+            default=None,
+            help="AS2 name of the organization",
+        )
+        parser.add_argument(
+            "--status",
+            action="append",
+            choices=[status for status, _ in Message.STATUS_CHOICES],
+            dest="status",
+            default=None,
+            help="Status of the messages to resend, can be repeated, defaults to E and R",
+        )
+        parser.add_argument(
+            "--since",
+            dest="since",
+            default=None,
+            help="Resend the messages created on or after the date or date and time",
+        )
+        parser.add_argument(
+            "--until",
+            dest="until",
+            default=None,
+            help="Resend the messages created on or before the date or date and time",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            dest="workers",
+            default=None,
+            help="Number of messages resent at the same time",
+        )
+
+    def handle(self, *args, **options):
+        messages = Message.objects.filter(
+            direction="OUT", status__in=options["status"] or ["E", "R"]
+        )
+        if options["partner"]:
+            messages = messages.filter(partner__as2_name=options["partner"])
+        if options["organization"]:
+            messages = messages.filter(organization__as2_name=options["organization"])
+        if options["since"]:
+            messages = messages.filter(timestamp__gte=parse_timestamp(options["since"]))
+        if options["until"]:
+            messages = messages.filter(
+                timestamp__lte=parse_timestamp(options["until"], end_of_day=True)
+            )
+        messages = messages.order_by("timestamp")
+
+        total = messages.count()
+        self.stdout.write(f"Resending {total} messages.")
+
+        def progress(message, done):
+            if message.status not in ("S", "P"):
+                self.stdout.write(
+                    f"Failed to resend message {message.message_id}: "
+                    f"{message.detailed_status}"
+                )
+            if done % PROGRESS_INTERVAL == 0 or done == total:
+                self.stdout.write(f"Resent {done}/{total} messages.")
+
+        resender = BulkResender(workers=options["workers"], progress=progress)
+        sent, failed = resender.run(messages)
+        self.stdout.write(f"Sent {sent} messages, {failed} failed.")
@@ -1,11 +1,11 @@
-import os
-from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django.core.files.storage import default_storage
 
 from pyas2 import settings
+from pyas2.lanes import PRIORITY_NAMES, PriorityLanes
 from pyas2.models import Organization
 from pyas2.models import Partner
+from pyas2.outbox import scan_outboxes
+from pyas2.sender import BatchSender
 
 
 class Command(BaseCommand):
@@ -14,44 +14,33 @@ class Command(BaseCommand):
     help = "Command for sending all pending messages in the outbox folders"
 
     def handle(self, *args, **options):
-        for partner in Partner.objects.all():
+        self.stdout.write("Process files in the outbox directories.")
+        partners = {p.as2_name: p for p in Partner.objects.all()}
+        orgs = {o.as2_name: o for o in Organization.objects.all()}
+
+        # Group the files by outbox folder
+        outboxes = {}
+        for partner_name, org_name, pending_file, priority_name in scan_outboxes():
+            if partner_name in partners and org_name in orgs:
+                outbox = (org_name, partner_name, priority_name)
+                outboxes.setdefault(outbox, []).append(pending_file)
+
+        # Add the batches of files to the lane of their priority
+        lanes = PriorityLanes()
+        for (org_name, partner_name, priority_name), files in outboxes.items():
+            sender = BatchSender(orgs[org_name], partners[partner_name])
+            priority = PRIORITY_NAMES.get(priority_name)
+            for start in range(0, len(files), settings.SEND_BATCH_SIZE):
+                batch = files[start : start + settings.SEND_BATCH_SIZE]
+                lanes.push(
+                    priority or sender.partner.default_priority,
+                    (sender, batch, priority),
+                )
+
+        # Send each batch of files to the partner
+        for sender, batch, priority in lanes:
             self.stdout.write(
-                "Process files in the outbox directory for "
-                'partner "%s".' % partner.as2_name
+                'Sending %s files from organization "%s" to partner "%s".'
+                % (len(batch), sender.organization.as2_name, sender.partner.as2_name)
             )
-            for org in Organization.objects.all():
-                if settings.DATA_DIR:
-                    outbox_folder = os.path.join(
-                        settings.DATA_DIR,
-                        "messages",
-                        partner.as2_name,
-                        "outbox",
-                        org.as2_name,
-                    )
-                else:
-                    outbox_folder = os.path.join(
-                        "messages", partner.as2_name, "outbox", org.as2_name
-                    )
-
-                # Check of the directory exists and if not create it
-                try:
-                    _, pending_files = default_storage.listdir(outbox_folder)
-                except FileNotFoundError:
-                    pending_files = []
-                    os.makedirs(default_storage.path(outbox_folder))
-
-                # For each file found call send message to send it to the server
-                pending_files = filter(lambda x: x != ".", pending_files)
-                for pending_file in pending_files:
-                    pending_file = os.path.join(outbox_folder, pending_file)
-                    self.stdout.write(
-                        'Sending file "%s" from organization "%s" to partner '
-                        '"%s".' % (pending_file, org.as2_name, partner.as2_name)
-                    )
-                    call_command(
-                        "sendas2message",
-                        org.as2_name,
-                        partner.as2_name,
-                        pending_file,
-                        delete=True,
-                    )
+            sender.send(batch, priority=priority)
@@ -6,9 +6,12 @@ from django.core.management.base import CommandError
 from django.core.files.storage import default_storage
 from pyas2lib import Message as AS2Message
 
+from pyas2.lanes import PRIORITY_NAMES
 from pyas2.models import Message
 from pyas2.models import Organization
 from pyas2.models import Partner
+from pyas2.tasks import dispatch_send
+from pyas2.tracing import start_span
 
 logger = logging.getLogger("pyas2")
 
@@ -32,6 +35,14 @@ class Command(BaseCommand):
             help="Delete source file after processing",
         )
 
+        parser.add_argument(
+            "--priority",
+            choices=PRIORITY_NAMES.keys(),
+            dest="priority",
+            default=None,
+            help="Priority of the message, defaults to the partner's default priority",
+        )
+
     def handle(self, *args, **options):
 
         # Check if organization and partner exists
@@ -59,21 +70,27 @@ class Command(BaseCommand):
         with default_storage.open(options["path_to_payload"], "rb") as in_file:
             payload = in_file.read()
             as2message = AS2Message(sender=org.as2org, receiver=partner.as2partner)
-            as2message.build(
-                payload,
-                filename=original_filename,
-                subject=partner.subject,
-                content_type=partner.content_type,
-                disposition_notification_to=org.email_address or "no-reply@pyas2.com",
-            )
+            with start_span("as2.build") as build_span:
+                as2message.build(
+                    payload,
+                    filename=original_filename,
+                    subject=partner.subject,
+                    content_type=partner.content_type,
+                    disposition_notification_to=org.email_address
+                    or "no-reply@pyas2.com",
+                )
         message, _ = Message.objects.create_from_as2message(
             as2message=as2message,
             payload=payload,
             filename=original_filename,
             direction="OUT",
             status="P",
+            priority=PRIORITY_NAMES.get(
+                options.get("priority"), partner.default_priority
+            ),
         )
-        message.send_message(as2message.headers, as2message.content)
+        message.add_timing("crypto", build_span.duration)
+        dispatch_send(message, as2message.headers, as2message.content)
 
         # Delete original file if option is set
         if options["delete"]:
@@ -0,0 +1,226 @@
+import logging
+import os
+import queue
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from pyas2.lanes import PRIORITY_NAMES
+from pyas2.models import Organization
+from pyas2.models import Partner
+from pyas2.outbox import get_messages_root, parse_outbox_path, scan_outboxes
+from pyas2.sender import BatchSender
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # pragma: no cover
+    FileSystemEventHandler = object
+    Observer = None
+
+logger = logging.getLogger("pyas2")
+
+# Number of seconds before the files that failed to be sent are tried again,
+# doubled on every further failure
+SEND_RETRY_DELAY = 5
+
+# Max number of seconds between two tries of the files that failed to be sent
+SEND_RETRY_MAX_DELAY = 300
+
+# Number of seconds between two scans of the outbox folders when using file
+# system notifications, to pick up the files whose events were missed
+OBSERVER_SCAN_INTERVAL = 60
+
+
+class OutboxEventHandler(FileSystemEventHandler):
+    """Queue the paths of the files created, modified or renamed in the outboxes."""
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        path = getattr(event, "dest_path", None) or event.src_path
+        self.events.put(path)
+
+
+class Command(BaseCommand):
+    """Command to watch the outbox folders and send the files as they arrive."""
+
+    help = (
+        "Watch the outbox folders and send the files as soon as they have been "
+        "fully written, uses file system notifications when available and "
+        "polls the storage otherwise"
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = queue.Queue()
+        self.pending = {}
+        self.failures = {}
+        self.settle = 0.5
+        self.watched_root = None
+        self.scan_interval = OBSERVER_SCAN_INTERVAL
+        self.last_scan = 0
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--settle",
+            type=float,
+            dest="settle",
+            default=0.5,
+            help="Seconds a file must stay unchanged before it is sent.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            dest="interval",
+            default=5,
+            help="Seconds between two scans of the storage when polling.",
+        )
+        parser.add_argument(
+            "--polling",
+            action="store_true",
+            dest="polling",
+            default=False,
+            help="Poll the storage instead of using file system notifications.",
+        )
+
+    def scan(self):
+        """Add all the files found in the outbox folders to the pending files."""
+        for _, _, pending_file, _ in scan_outboxes():
+            self.add_pending(pending_file)
+
+    def rescan(self, now=None):
+        """Scan the outbox folders again once the scan interval has passed."""
+        now = now or time.monotonic()
+        if now - self.last_scan >= self.scan_interval:
+            self.scan()
+            self.last_scan = now
+
+    def add_pending(self, path):
+        """Track the file until it is stable enough to be sent."""
+        if path not in self.pending and parse_outbox_path(path):
+            self.pending[path] = (None, 0)
+
+    def add_event(self, path):
+        """Track the file reported by the file system notifications."""
+        relative_path = os.path.relpath(path, self.watched_root)
+        self.add_pending(os.path.join(get_messages_root(), relative_path))
+
+    def send_ready(self, now=None):
+        """Send the pending files that have not changed for the settle time,
+        the files that failed to be sent wait for their next try."""
+        now = now or time.monotonic()
+        outboxes = {}
+        for path, (last_stat, since) in list(self.pending.items()):
+            if path in self.failures and self.failures[path][1] > now:
+                continue
+            try:
+                stat = (
+                    default_storage.size(path),
+                    default_storage.get_modified_time(path),
+                )
+            except OSError:
+                del self.pending[path]
+                self.failures.pop(path, None)
+                continue
+
+            if stat != last_stat:
+                self.pending[path] = (stat, now)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                outboxes.setdefault(parse_outbox_path(path), []).append(path)
+
+        for outbox, paths in outboxes.items():
+            if self.send(*outbox, paths):
+                for path in paths:
+                    self.failures.pop(path, None)
+                continue
+
+            # Keep the files to send them again later, the files that were
+            # sent before the failure are gone from the outbox by then
+            for path in paths:
+                count = self.failures.get(path, (0, None))[0] + 1
+                delay = min(SEND_RETRY_DELAY * 2 ** (count - 1), SEND_RETRY_MAX_DELAY)
+                self.failures[path] = (count, now + delay)
+                self.pending[path] = (None, now)
+
+    def send(self, partner_name, org_name, priority_name, paths):
+        """Send the files to the partner of the outbox they were found in,
+        returns False if the files could not be sent."""
+        self.stdout.write(
+            'Sending %s files from organization "%s" to partner '
+            '"%s".' % (len(paths), org_name, partner_name)
+        )
+        org = Organization.objects.filter(as2_name=org_name).first()
+        partner = Partner.objects.filter(as2_name=partner_name).first()
+        if not org or not partner:
+            logger.error(
+                f'Failed to send files {paths}: organization "{org_name}" or '
+                f'partner "{partner_name}" does not exist'
+            )
+            return False
+        try:
+            BatchSender(org, partner).send(
+                paths, priority=PRIORITY_NAMES.get(priority_name)
+            )
+        except Exception:  # pylint: disable=W0703
+            logger.exception(f"Failed to send files {paths}")
+            return False
+        return True
+
+    def start_observer(self):
+        """Start watching the outbox folders for changes, returns None when file
+        system notifications are not available for the storage."""
+        if Observer is None:
+            return None
+        try:
+            root = default_storage.path(get_messages_root())
+        except NotImplementedError:
+            return None
+
+        os.makedirs(root, exist_ok=True)
+        self.watched_root = root
+        observer = Observer()
+        observer.schedule(OutboxEventHandler(self.events), root, recursive=True)
+        observer.daemon = True
+        observer.start()
+        return observer
+
+    def handle(self, *args, **options):
+        self.settle = options["settle"]
+        observer = None if options["polling"] else self.start_observer()
+        if observer:
+            self.stdout.write("Watching the outbox folders for new files.")
+        else:
+            self.stdout.write(
+                "Polling the outbox folders every %s seconds." % options["interval"]
+            )
+
+        # Pick up the files already waiting in the outboxes, the notifications
+        # can miss files, e.g. when their queue overflows, so the outboxes are
+        # still scanned from time to time when watching
+        self.scan_interval = OBSERVER_SCAN_INTERVAL if observer else options["interval"]
+        self.scan()
+        self.last_scan = time.monotonic()
+        try:
+            while True:
+                try:
+                    self.add_event(self.events.get(timeout=0.1))
+                    while True:
+                        self.add_event(self.events.get_nowait())
+                except queue.Empty:
+                    pass
+
+                self.rescan()
+                self.send_ready()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping the outbox watcher.")
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
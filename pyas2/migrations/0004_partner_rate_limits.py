@@ -0,0 +1,43 @@
+# Generated by Django 4.1.13 on 2026-10-19 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0003_auto_20221208_1310"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="partner",
+            name="max_in_flight",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Maximum number of messages being sent at the same time to this partner.",
+                null=True,
+                verbose_name="Max In-Flight Messages",
+            ),
+        ),
+        migrations.AddField(
+            model_name="partner",
+            name="rate_limit_bytes",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Maximum number of bytes sent per second to this partner.",
+                null=True,
+                verbose_name="Max Bytes per Second",
+            ),
+        ),
+        migrations.AddField(
+            model_name="partner",
+            name="rate_limit_msgs",
+            field=models.FloatField(
+                blank=True,
+                help_text="Maximum number of messages sent per second to this partner.",
+                null=True,
+                verbose_name="Max Messages per Second",
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.13 on 2026-10-19 17:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0004_partner_rate_limits"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="priority",
+            field=models.PositiveSmallIntegerField(
+                choices=[(1, "High"), (5, "Normal"), (9, "Low")], default=5
+            ),
+        ),
+        migrations.AddField(
+            model_name="partner",
+            name="default_priority",
+            field=models.PositiveSmallIntegerField(
+                choices=[(1, "High"), (5, "Normal"), (9, "Low")],
+                default=5,
+                help_text="Priority of the messages sent to this partner when none is specified.",
+                verbose_name="Default Message Priority",
+            ),
+        ),
+    ]
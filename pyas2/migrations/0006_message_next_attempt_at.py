@@ -0,0 +1,65 @@
+# Generated by Django 4.1.13 on 2026-10-19 17:50
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def schedule_pending_retries(apps, schema_editor):
+    """Make the messages already waiting for a retry due immediately."""
+    Message = apps.get_model("pyas2", "Message")
+    Message.objects.filter(status="R", next_attempt_at__isnull=True).update(
+        next_attempt_at=F("timestamp")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0005_message_priority"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="partner",
+            name="retry_delay",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Number of seconds to wait before the first retry of a failed message, doubled on every further retry.",
+                null=True,
+                verbose_name="Retry Delay",
+            ),
+        ),
+        migrations.AddField(
+            model_name="partner",
+            name="retry_jitter",
+            field=models.FloatField(
+                blank=True,
+                help_text="Fraction of the retry delay added or removed at random, e.g. 0.1.",
+                null=True,
+                verbose_name="Retry Jitter",
+            ),
+        ),
+        migrations.AddField(
+            model_name="partner",
+            name="retry_max_delay",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Maximum number of seconds to wait between retries.",
+                null=True,
+                verbose_name="Max Retry Delay",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["status", "direction", "next_attempt_at"],
+                name="pyas2_message_due_idx",
+            ),
+        ),
+        migrations.RunPython(schedule_pending_retries, migrations.RunPython.noop),
+    ]
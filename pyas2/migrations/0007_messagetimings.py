@@ -0,0 +1,73 @@
+# Generated by Django 4.1.13 on 2026-10-19 18:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0006_message_next_attempt_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageTimings",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "parse_ms",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="Parse (ms)"
+                    ),
+                ),
+                (
+                    "crypto_ms",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="Crypto (ms)"
+                    ),
+                ),
+                (
+                    "storage_ms",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="Storage (ms)"
+                    ),
+                ),
+                (
+                    "http_ms",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="HTTP (ms)"
+                    ),
+                ),
+                (
+                    "mdn_ms",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="MDN (ms)"
+                    ),
+                ),
+                (
+                    "hooks_ms",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="Hooks (ms)"
+                    ),
+                ),
+                ("sent_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "message",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="timings",
+                        to="pyas2.message",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.13 on 2026-10-19 18:14
+
+from django.db import migrations, models
+import pyas2.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0007_messagetimings"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="messagetimings",
+            name="profile",
+            field=models.FileField(
+                blank=True,
+                max_length=4096,
+                null=True,
+                upload_to=pyas2.models.get_profile_store,
+            ),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.1.13 on 2026-10-19 18:23
+
+from django.db import migrations
+import pyas2.models
+import pyas2.packs
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0008_messagetimings_profile"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="mdn",
+            name="headers",
+            field=pyas2.packs.PackedFileField(
+                blank=True, null=True, upload_to=pyas2.models.get_mdn_store
+            ),
+        ),
+        migrations.AlterField(
+            model_name="mdn",
+            name="payload",
+            field=pyas2.packs.PackedFileField(
+                blank=True,
+                max_length=4096,
+                null=True,
+                upload_to=pyas2.models.get_mdn_store,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="headers",
+            field=pyas2.packs.PackedFileField(
+                blank=True, null=True, upload_to=pyas2.models.get_message_store
+            ),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="payload",
+            field=pyas2.packs.PackedFileField(
+                blank=True,
+                max_length=4096,
+                null=True,
+                upload_to=pyas2.models.get_message_store,
+            ),
+        ),
+    ]
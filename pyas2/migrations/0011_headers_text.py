@@ -0,0 +1,66 @@
+from django.db import migrations, models, transaction
+
+# Number of rows updated at once by the backfill
+BATCH_SIZE = 500
+
+
+def read_header_files(apps, schema_editor):
+    """Copy the content of the header files of the messages and MDNs into the
+    headers column, the files are deleted from the store once the migration is
+    committed."""
+    copied = []
+    for model_name in ["Message", "Mdn"]:
+        model = apps.get_model("pyas2", model_name)
+        batch = []
+        for instance in (
+            model.objects.exclude(headers_file="")
+            .exclude(headers_file__isnull=True)
+            .only("pk", "headers_file")
+            .iterator(chunk_size=BATCH_SIZE)
+        ):
+            try:
+                with instance.headers_file.open("rb") as headers_file:
+                    instance.headers = headers_file.read().decode()
+            except FileNotFoundError:
+                continue
+            batch.append(instance)
+            copied.append((instance.headers_file.storage, instance.headers_file.name))
+            if len(batch) >= BATCH_SIZE:
+                model.objects.bulk_update(batch, ["headers"])
+                batch = []
+        model.objects.bulk_update(batch, ["headers"])
+
+    def delete_header_files():
+        for storage, name in copied:
+            storage.delete(name)
+
+    transaction.on_commit(delete_header_files, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0010_message_timestamp_index"),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name="message", old_name="headers", new_name="headers_file"
+        ),
+        migrations.RenameField(
+            model_name="mdn", old_name="headers", new_name="headers_file"
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="headers",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="mdn",
+            name="headers",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.RunPython(read_header_files, migrations.RunPython.noop),
+        migrations.RemoveField(model_name="message", name="headers_file"),
+        migrations.RemoveField(model_name="mdn", name="headers_file"),
+    ]
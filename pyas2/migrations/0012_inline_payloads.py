@@ -0,0 +1,47 @@
+# Generated by Django 4.1.13 on 2026-10-19 18:30
+
+from django.db import migrations, models
+import pyas2.models
+import pyas2.packs
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0011_headers_text"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mdn",
+            name="payload_inline",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="payload_inline",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="mdn",
+            name="payload",
+            field=pyas2.packs.PackedFileField(
+                blank=True,
+                inline_field="payload_inline",
+                max_length=4096,
+                null=True,
+                upload_to=pyas2.models.get_mdn_store,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="payload",
+            field=pyas2.packs.PackedFileField(
+                blank=True,
+                inline_field="payload_inline",
+                max_length=4096,
+                null=True,
+                upload_to=pyas2.models.get_message_store,
+            ),
+        ),
+    ]
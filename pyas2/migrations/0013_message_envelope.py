@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2026-10-19 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0012_inline_payloads"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="envelope",
+            field=models.BinaryField(null=True),
+        ),
+    ]
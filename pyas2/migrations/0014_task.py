@@ -0,0 +1,48 @@
+# Generated by Django 4.1.13 on 2026-10-19 18:37
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0013_message_envelope"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Task",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("arguments", models.TextField(default="{}")),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("Q", "Queued"), ("R", "Running"), ("E", "Error")],
+                        default="Q",
+                        max_length=2,
+                    ),
+                ),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("run_after", models.DateTimeField(default=django.utils.timezone.now)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("error", models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(
+                fields=["status", "run_after"], name="pyas2_task_due_idx"
+            ),
+        ),
+    ]
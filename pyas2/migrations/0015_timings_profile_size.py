@@ -0,0 +1,31 @@
+# Generated by Django 4.1.13 on 2026-10-19 19:14
+
+from django.db import migrations, models
+
+
+def read_profile_sizes(apps, schema_editor):
+    """Store the size of the existing profiles, the missing profiles are
+    counted as empty."""
+    model = apps.get_model("pyas2", "MessageTimings")
+    for timings in model.objects.exclude(profile="").exclude(profile__isnull=True):
+        try:
+            size = timings.profile.size
+        except FileNotFoundError:
+            size = 0
+        model.objects.filter(pk=timings.pk).update(profile_size=size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pyas2", "0014_task"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="messagetimings",
+            name="profile_size",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(read_profile_sizes, migrations.RunPython.noop),
+    ]
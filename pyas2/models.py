@@ -1,27 +1,44 @@
 # -*- coding: utf-8 -*-
+import functools
 import logging
 import os
 import posixpath
+import random
 import traceback
+import zlib
+from datetime import timedelta, timezone as dt_timezone
 from email.parser import HeaderParser
 from uuid import uuid4
 
 import requests
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 
 from pyas2lib import (
     Mdn as As2Mdn,
     Message as As2Message,
     Organization as As2Organization,
-    Partner as As2Partner,
 )
 from pyas2lib.utils import extract_certificate_info
 
 from pyas2 import settings
+from pyas2.breaker import CircuitBreaker, CircuitOpen
+from pyas2.certificates import CachedAs2Partner, invalidate_certificate_validation
+from pyas2.lanes import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+from pyas2.outbox import create_outbox_folder
+from pyas2.packs import PackedFileField
+from pyas2.partitions import TablePartitioner
+from pyas2.prefilter import MessagePrefilter
+from pyas2.profiling import profile_message, profiled
+from pyas2.ratelimit import PartnerThrottle, RateLimitExceeded
+from pyas2.storage import run_writes, undo_writes
+from pyas2.tracing import SPAN_KIND_CLIENT, get_current_span, start_span, traced
 from pyas2.utils import run_post_send
 
 logger = logging.getLogger("pyas2")
@@ -72,6 +89,17 @@ class PublicCertificate(models.Model):
         self.valid_to = cert_info["valid_to"]
         if not cert_info["serial"] is None:
             self.serial_number = cert_info["serial"].__str__()
+
+        # Drop the cached chain validations of the previous and new certificates
+        if self.pk:
+            previous = (
+                PublicCertificate.objects.filter(pk=self.pk)
+                .values_list("certificate", "certificate_ca")
+                .first()
+            )
+            if previous:
+                invalidate_certificate_validation(*previous)
+        invalidate_certificate_validation(self.certificate, self.certificate_ca)
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -163,6 +191,11 @@ class Partner(models.Model):
         ("SYNC", "Synchronous"),
         ("ASYNC", "Asynchronous"),
     )
+    PRIORITY_CHOICES = (
+        (PRIORITY_HIGH, _("High")),
+        (PRIORITY_NORMAL, _("Normal")),
+        (PRIORITY_LOW, _("Low")),
+    )
 
     name = models.CharField(verbose_name=_("Partner Name"), max_length=100)
     as2_name = models.CharField(
@@ -268,6 +301,72 @@ class Partner(models.Model):
         ),
     )
 
+    rate_limit_msgs = models.FloatField(
+        verbose_name=_("Max Messages per Second"),
+        null=True,
+        blank=True,
+        help_text=_("Maximum number of messages sent per second to this partner."),
+    )
+    rate_limit_bytes = models.PositiveIntegerField(
+        verbose_name=_("Max Bytes per Second"),
+        null=True,
+        blank=True,
+        help_text=_("Maximum number of bytes sent per second to this partner."),
+    )
+    max_in_flight = models.PositiveIntegerField(
+        verbose_name=_("Max In-Flight Messages"),
+        null=True,
+        blank=True,
+        help_text=_(
+            "Maximum number of messages being sent at the same time to this partner."
+        ),
+    )
+    default_priority = models.PositiveSmallIntegerField(
+        verbose_name=_("Default Message Priority"),
+        choices=PRIORITY_CHOICES,
+        default=PRIORITY_NORMAL,
+        help_text=_(
+            "Priority of the messages sent to this partner when none is specified."
+        ),
+    )
+
+    retry_delay = models.PositiveIntegerField(
+        verbose_name=_("Retry Delay"),
+        null=True,
+        blank=True,
+        help_text=_(
+            "Number of seconds to wait before the first retry of a failed message, "
+            "doubled on every further retry."
+        ),
+    )
+    retry_max_delay = models.PositiveIntegerField(
+        verbose_name=_("Max Retry Delay"),
+        null=True,
+        blank=True,
+        help_text=_("Maximum number of seconds to wait between retries."),
+    )
+    retry_jitter = models.FloatField(
+        verbose_name=_("Retry Jitter"),
+        null=True,
+        blank=True,
+        help_text=_(
+            "Fraction of the retry delay added or removed at random, e.g. 0.1."
+        ),
+    )
+
+    def get_retry_delay(self, retries):
+        """Return the time to wait before the next retry with exponential
+        backoff and jitter."""
+        base = self.retry_delay or settings.RETRY_DELAY
+        max_delay = self.retry_max_delay or settings.RETRY_MAX_DELAY
+        jitter = (
+            settings.RETRY_JITTER if self.retry_jitter is None else self.retry_jitter
+        )
+
+        delay = min(base * 2 ** min(retries, 32), max_delay)
+        delay *= 1 + random.uniform(-jitter, jitter)
+        return timedelta(seconds=max(delay, 1))
+
     @property
     def as2partner(self):
         """Returns an object of pyas2lib's Partner class"""
@@ -297,7 +396,7 @@ class Partner(models.Model):
         if self.confirmation_message:
             params["mdn_confirm_text"] = self.confirmation_message
 
-        return As2Partner(**params)
+        return CachedAs2Partner(**params)
 
     def __str__(self):
         return str(self.name)
@@ -306,6 +405,30 @@ class Partner(models.Model):
 class MessageManager(models.Manager):
     """Custom model manager for the AS2 Message model."""
 
+    @cached_property
+    def prefilter(self):
+        """Return the duplicate prefilter of the messages of this process."""
+        return MessagePrefilter(self.model)
+
+    @cached_property
+    def partitioned(self):
+        """Return True if the table has been partitioned, its unique constraint
+        then includes the timestamp. The processes running when the table is
+        partitioned need to be restarted."""
+        return (
+            connection.vendor == "postgresql"
+            and TablePartitioner(self.model).is_partitioned()
+        )
+
+    def message_exists(self, message_id, partner_id):
+        """Check if the message exists, the database is only queried when the
+        duplicate prefilter, if enabled, cannot rule it out."""
+        if settings.DUPLICATE_PREFILTER and not self.prefilter.might_contain(
+            message_id, partner_id
+        ):
+            return False
+        return self.filter(message_id=message_id, partner_id=partner_id).exists()
+
     def create_from_as2message(
         self,
         as2message,
@@ -314,8 +437,12 @@ class MessageManager(models.Manager):
         status,
         filename=None,
         detailed_status=None,
+        priority=None,
+        overwrite=False,
     ):
-        """Create the Message from the pyas2lib's Message object."""
+        """Create the Message from the pyas2lib's Message object, raises an
+        IntegrityError if the message already exists unless ``overwrite`` is
+        set."""
 
         if direction == "IN":
             organization = as2message.receiver.as2_name if as2message.receiver else None
@@ -324,45 +451,212 @@ class MessageManager(models.Manager):
             partner = as2message.receiver.as2_name if as2message.receiver else None
             organization = as2message.sender.as2_name if as2message.sender else None
 
-        message, _ = self.update_or_create(
+        # Use the default priority of the partner when none is specified, the
+        # callers holding the partner pass it to save the query
+        if priority is None and direction == "IN":
+            priority = PRIORITY_NORMAL
+        elif priority is None:
+            priority = (
+                Partner.objects.filter(as2_name=partner)
+                .values_list("default_priority", flat=True)
+                .first()
+                or PRIORITY_NORMAL
+            )
+
+        lookup = dict(
             message_id=as2message.message_id,
             partner_id=partner,
             organization_id=organization,
-            defaults=dict(
-                direction=direction,
-                status=status,
+        )
+        fields = dict(
+            direction=direction,
+            status=status,
+            compressed=as2message.compressed,
+            encrypted=as2message.encrypted,
+            signed=as2message.signed,
+            detailed_status=detailed_status,
+            priority=priority,
+            headers=as2message.headers_str.decode(),
+        )
+        # The row and the files are created together, the files written are
+        # deleted if the row is not committed so that the partner can send
+        # the message again
+        writes, results = [], []
+        try:
+            with transaction.atomic():
+                if overwrite:
+                    message, _ = self.update_or_create(defaults=fields, **lookup)
+                else:
+                    # The unique constraint catches the duplicates missed by the
+                    # checks before the insert, e.g. received by another process
+                    if self.partitioned:
+                        self.check_unique(as2message.message_id, partner)
+                    message = self.create(**lookup, **fields)
+
+                # Save the payload to store and to the inbox folder at the
+                # same time
+                if not filename:
+                    filename = f"{uuid4()}.msg"
+                writes.append(
+                    (
+                        functools.partial(
+                            message.payload.save,
+                            name=filename,
+                            content=ContentFile(payload),
+                            save=False,
+                        ),
+                        lambda _: message.payload.delete(save=False),
+                    )
+                )
+
+                full_filename = None
+                if direction == "IN" and status == "S":
+                    if settings.DATA_DIR:
+                        dirname = os.path.join(
+                            settings.DATA_DIR,
+                            "messages",
+                            organization,
+                            "inbox",
+                            partner,
+                        )
+                    else:
+                        dirname = os.path.join(
+                            "messages", organization, "inbox", partner
+                        )
+                    if not message.partner.keep_filename or not filename:
+                        filename = f"{message.message_id}.msg"
+                    full_filename = default_storage.generate_filename(
+                        posixpath.join(dirname, filename)
+                    )
+
+                    def save_inbox_copy():
+                        with start_span("as2.store.inbox"):
+                            return default_storage.save(
+                                name=full_filename, content=ContentFile(payload)
+                            )
+
+                    writes.append((save_inbox_copy, default_storage.delete))
+
+                with start_span("as2.store") as span:
+                    results = run_writes(writes)
+                message.add_timing("storage", span.duration)
+                message.save(update_fields=["payload", "payload_inline"])
+        except BaseException:
+            undo_writes(writes, results)
+            raise
+
+        # Create the outbox folder once the pair exchanges messages
+        if partner and organization:
+            create_outbox_folder(partner, organization)
+
+        return message, full_filename
+
+    def check_unique(self, message_id, partner):
+        """Raise an IntegrityError if the partner already sent or received a
+        message with the id. The unique constraint of a partitioned table
+        includes the timestamp, so the check is serialized with an advisory
+        lock held until the end of the transaction. The check is skipped when
+        the duplicate prefilter rules the message out."""
+        if settings.DUPLICATE_PREFILTER and not self.prefilter.might_contain(
+            message_id, partner
+        ):
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                [f"{partner}:{message_id}"],
+            )
+        if self.filter(message_id=message_id, partner_id=partner).exists():
+            raise IntegrityError(
+                f"Message {message_id} of partner {partner} already exists."
+            )
+
+    def delete_by_day(self, before):
+        """Delete the messages created before the datetime along with their MDNs
+        and timings, with a range delete per day and table. Only whole UTC days
+        are deleted, as the day folders of the store, returns the number of
+        days deleted."""
+        utc = dt_timezone.utc if timezone.is_aware(before) else None
+        ops = connection.ops
+        table = ops.quote_name(self.model._meta.db_table)
+        column = ops.quote_name(self.model._meta.get_field("timestamp").column)
+        days = 0
+        for day in self.filter(timestamp__lt=before).datetimes(
+            "timestamp", "day", tzinfo=utc
+        ):
+            day_end = day + timedelta(days=1)
+            if day_end > before:
+                break
+            messages = self.filter(timestamp__gte=day, timestamp__lt=day_end)
+            Mdn.objects.filter(message__in=messages).delete()
+            MessageTimings.objects.filter(message__in=messages).delete()
+            # The related rows are gone, delete the messages without fetching
+            # them as the delete of the queryset would
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE {column} >= %s AND {column} < %s",
+                    [
+                        ops.adapt_datetimefield_value(day),
+                        ops.adapt_datetimefield_value(day_end),
+                    ],
+                )
+            days += 1
+        return days
+
+    @staticmethod
+    def _store_payload(message, filename, payload):
+        with start_span("as2.store") as span:
+            message.payload.save(
+                name=filename, content=ContentFile(payload), save=False
+            )
+        message.add_timing("storage", span.duration)
+
+    def bulk_create_from_as2messages(self, organization, partner, outbound, priority):
+        """Create the pending outbound Messages for a list of pyas2lib's Message
+        objects with their payloads and file names, in a single insert when the
+        database returns the primary keys of bulk inserted rows. The payloads
+        are saved to the store at the same time."""
+        messages = []
+        writes = []
+        for as2message, payload, filename in outbound:
+            message = self.model(
+                message_id=as2message.message_id,
+                partner=partner,
+                organization=organization,
+                direction="OUT",
+                status="P",
                 compressed=as2message.compressed,
                 encrypted=as2message.encrypted,
                 signed=as2message.signed,
-                detailed_status=detailed_status,
-            ),
-        )
-
-        # Save the headers and payload to store
-        if not filename:
-            filename = f"{uuid4()}.msg"
-        message.headers.save(
-            name=f"{filename}.header", content=ContentFile(as2message.headers_str)
-        )
-        message.payload.save(name=filename, content=ContentFile(payload))
-
-        # Save the payload to the inbox folder
-        full_filename = None
-        if direction == "IN" and status == "S":
-            if settings.DATA_DIR:
-                dirname = os.path.join(
-                    settings.DATA_DIR, "messages", organization, "inbox", partner
+                priority=priority,
+                headers=as2message.headers_str.decode(),
+            )
+            messages.append(message)
+            writes.append(
+                (
+                    functools.partial(self._store_payload, message, filename, payload),
+                    lambda _, message=message: message.payload.delete(save=False),
                 )
-            else:
-                dirname = os.path.join("messages", organization, "inbox", partner)
-            if not message.partner.keep_filename or not filename:
-                filename = f"{message.message_id}.msg"
-            full_filename = default_storage.generate_filename(
-                posixpath.join(dirname, filename)
             )
-            default_storage.save(name=full_filename, content=ContentFile(payload))
+        run_writes(writes)
+
+        # The feature was named can_return_ids_from_bulk_insert before Django 3.0
+        features = connection.features
+        can_bulk_insert = getattr(
+            features,
+            "can_return_rows_from_bulk_insert",
+            getattr(features, "can_return_ids_from_bulk_insert", False),
+        )
+        if not can_bulk_insert:
+            for message in messages:
+                message.save()
+            return messages
 
-        return message, full_filename
+        messages = self.bulk_create(messages)
+        if settings.DUPLICATE_PREFILTER:
+            for message in messages:
+                self.prefilter.add(message.message_id, partner.pk, message.timestamp)
+        return messages
 
 
 def get_message_store(instance, filename):
@@ -397,10 +691,11 @@ class Message(models.Model):
         ("SYNC", _("Synchronous")),
         ("ASYNC", _("Asynchronous")),
     )
+    PRIORITY_CHOICES = Partner.PRIORITY_CHOICES
 
     message_id = models.CharField(max_length=255)
     direction = models.CharField(max_length=5, choices=DIRECTION_CHOICES)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
 
     status = models.CharField(max_length=2, choices=STATUS_CHOICES)
     detailed_status = models.TextField(null=True)
@@ -408,10 +703,15 @@ class Message(models.Model):
     organization = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
     partner = models.ForeignKey(Partner, null=True, on_delete=models.SET_NULL)
 
-    headers = models.FileField(upload_to=get_message_store, null=True, blank=True)
-    payload = models.FileField(
-        upload_to=get_message_store, null=True, blank=True, max_length=4096
+    headers = models.TextField(null=True, blank=True)
+    payload = PackedFileField(
+        upload_to=get_message_store,
+        null=True,
+        blank=True,
+        max_length=4096,
+        inline_field="payload_inline",
     )
+    payload_inline = models.BinaryField(null=True, editable=False)
 
     compressed = models.BooleanField(default=False)
     encrypted = models.BooleanField(default=False)
@@ -421,6 +721,11 @@ class Message(models.Model):
     mic = models.CharField(max_length=100, null=True)
 
     retries = models.IntegerField(null=True)
+    envelope = models.BinaryField(null=True, editable=False)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    priority = models.PositiveSmallIntegerField(
+        choices=PRIORITY_CHOICES, default=PRIORITY_NORMAL
+    )
 
     objects = MessageManager()
 
@@ -428,6 +733,12 @@ class Message(models.Model):
         """Define additional options for the Message model."""
 
         unique_together = ("message_id", "partner")
+        indexes = [
+            models.Index(
+                fields=["status", "direction", "next_attempt_at"],
+                name="pyas2_message_due_idx",
+            ),
+        ]
 
     @property
     def as2message(self):
@@ -458,8 +769,100 @@ class Message(models.Model):
         else:
             return "admin/img/icon-unknown.svg"
 
-    def send_message(self, header, payload):
-        """Send the message to the partner"""
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        # The envelope is only needed as long as the message can be retried
+        if self.status not in ("P", "R"):
+            self.envelope = None
+        super().save(*args, **kwargs)
+        if adding and settings.DUPLICATE_PREFILTER:
+            Message.objects.prefilter.add(
+                self.message_id, self.partner_id, self.timestamp
+            )
+
+    def store_envelope(self, headers, body):
+        """Keep the headers and MIME body sent to the partner, compressed, so
+        that the retries send them again as they are instead of building the
+        message again."""
+        if self.envelope is None:
+            raw_headers = "".join(
+                f"{key}: {value}\r\n" for key, value in headers.items()
+            )
+            self.envelope = zlib.compress(raw_headers.encode() + b"\r\n" + body)
+
+    def load_envelope(self):
+        """Return the headers and MIME body of the first send of the message,
+        or None if they were not kept."""
+        if self.envelope is None:
+            return None
+        # The headers end with an empty line, which is the first one when the
+        # message was sent without headers
+        raw_headers, body = (b"\r\n" + zlib.decompress(self.envelope)).split(
+            b"\r\n\r\n", 1
+        )
+        headers = HeaderParser().parsestr(raw_headers[2:].decode())
+        return dict(headers.items()), body
+
+    def add_timing(self, phase, seconds):
+        """Add the seconds spent in a phase of processing the message, they
+        are stored by save_timings."""
+        timings = self.__dict__.setdefault("_phase_timings", {})
+        timings[phase] = timings.get(phase, 0) + seconds
+
+    def save_timings(self, **extra_fields):
+        """Add the timings recorded since the last save to the stored totals
+        of the message."""
+        timings = self.__dict__.pop("_phase_timings", {})
+        fields = {
+            f"{phase}_ms": Coalesce(f"{phase}_ms", 0) + round(seconds * 1000)
+            for phase, seconds in timings.items()
+        }
+        fields.update(extra_fields)
+        if fields:
+            MessageTimings.objects.get_or_create(message=self)
+            MessageTimings.objects.filter(message=self).update(**fields)
+
+    def save_profile(self, content):
+        """Store the profile of a slow send or receive of the message and drop
+        the oldest profiles beyond ``PROFILING_MAX_SIZE`` bytes."""
+        timings, _ = MessageTimings.objects.get_or_create(message=self)
+        name = f"{timezone.now().strftime('%H%M%S')}-{self.pk}.prof"
+        timings.profile.save(name, ContentFile(content), save=False)
+        MessageTimings.objects.filter(pk=timings.pk).update(
+            profile=timings.profile.name, profile_size=len(content)
+        )
+
+        # The sizes are summed in the database, the store is only accessed to
+        # delete the oldest profiles
+        profiled = MessageTimings.objects.exclude(profile="").exclude(profile=None)
+        total_size = profiled.aggregate(total=Sum("profile_size"))["total"] or 0
+        oldest = profiled.exclude(pk=timings.pk).order_by("profile")
+        for other in oldest.iterator():
+            if total_size <= settings.PROFILING_MAX_SIZE:
+                break
+            other.profile.delete(save=False)
+            MessageTimings.objects.filter(pk=other.pk).update(
+                profile="", profile_size=None
+            )
+            total_size -= other.profile_size or 0
+
+    def schedule_retry(self, detailed_status):
+        """Mark the message for retry and schedule the next attempt using the
+        backoff settings of the partner."""
+        self.status = "R"
+        self.detailed_status = detailed_status
+        self.next_attempt_at = timezone.now() + self.partner.get_retry_delay(
+            self.retries or 0
+        )
+        self.save()
+
+    @profiled
+    @traced("as2.send")
+    def send_message(self, header, payload, session=None):
+        """Send the message to the partner, over the requests session if set."""
+        profile_message(self)
+        get_current_span().link_message(self.message_id, first=not self.retries)
+        get_current_span().set_attribute("as2.retries", self.retries or 0)
         logger.info(
             f'Sending message {self.message_id} from organization "{self.organization}" '
             f'to partner "{self.partner}".'
@@ -470,28 +873,49 @@ class Message(models.Model):
         if self.partner.http_auth:
             auth = (self.partner.http_auth_user, self.partner.http_auth_pass)
 
-        # Send the message to the partner
+        # Send the message to the partner within its rate limits, unless the
+        # circuit to the partner is open
+        breaker = CircuitBreaker(self.partner)
+        throttle = PartnerThrottle(self.partner)
         try:
-            response = requests.post(
-                self.partner.target_url,
-                auth=auth,
-                headers=header,
-                data=payload,
-                verify=self.partner.https_verify_ssl,
-            )
-            response.raise_for_status()
+            with breaker.guard(), throttle.acquire(len(payload)), start_span(
+                "http.request",
+                kind=SPAN_KIND_CLIENT,
+                attributes={
+                    "http.request.method": "POST",
+                    "url.full": self.partner.target_url,
+                },
+            ) as span:
+                response = (session or requests).post(
+                    self.partner.target_url,
+                    auth=auth,
+                    headers=header,
+                    data=payload,
+                    verify=self.partner.https_verify_ssl,
+                )
+                span.set_attribute("http.response.status_code", response.status_code)
+                response.raise_for_status()
+        except (CircuitOpen, RateLimitExceeded) as e:
+            self.store_envelope(header, payload)
+            self.schedule_retry(f"Failed to send message, error:\n{e}")
+            self.save_timings()
+            return
         except requests.exceptions.RequestException:
-            self.status = "R"
-            self.detailed_status = (
+            self.add_timing("http", span.duration)
+            self.store_envelope(header, payload)
+            self.schedule_retry(
                 f"Failed to send message, error:\n{traceback.format_exc()}"
             )
-            self.save()
+            self.save_timings()
             return
+        self.add_timing("http", span.duration)
+        self.next_attempt_at = None
 
         # Process the MDN based on the partner profile settings
         if self.partner.mdn:
             if self.partner.mdn_mode == "ASYNC":
                 self.status = "P"
+                self.store_envelope(header, payload)
             else:
                 # Process the synchronous MDN received as response
 
@@ -516,14 +940,18 @@ class Message(models.Model):
                     f"with content: {mdn_content}"
                 )
                 as2mdn = As2Mdn()
-                mdn_status, mdn_detailed_status = as2mdn.parse(
-                    mdn_content, lambda x, y: self.as2message
-                )
+                with start_span("as2.mdn.parse") as span:
+                    mdn_status, mdn_detailed_status = as2mdn.parse(
+                        mdn_content, lambda x, y: self.as2message
+                    )
+                self.add_timing("mdn", span.duration)
 
                 # Update the message status and return the response
                 if mdn_status == "processed":
                     self.status = "S"
-                    run_post_send(self)
+                    with start_span("as2.post_send") as span:
+                        run_post_send(self)
+                    self.add_timing("hooks", span.duration)
                 else:
                     self.status = "E"
                     self.detailed_status = (
@@ -536,14 +964,60 @@ class Message(models.Model):
         else:
             # No MDN requested mark message as success and run command
             self.status = "S"
-            run_post_send(self)
+            with start_span("as2.post_send") as span:
+                run_post_send(self)
+            self.add_timing("hooks", span.duration)
 
         self.save()
+        self.save_timings(sent_at=timezone.now())
 
     def __str__(self):
         return str(self.message_id)
 
 
+def get_profile_store(instance, filename):
+    """Return the path for storing the profile of a slow message."""
+    current_date = timezone.now().strftime("%Y%m%d")
+    target_dir = os.path.join("messages", "__store", "profile", current_date)
+    return "{0}/{1}".format(target_dir, filename)
+
+
+class MessageTimings(models.Model):
+    """Model for storing the time spent in each phase of processing a Message."""
+
+    PHASES = ("parse", "crypto", "storage", "http", "mdn", "hooks")
+
+    message = models.OneToOneField(
+        Message, related_name="timings", on_delete=models.CASCADE
+    )
+    parse_ms = models.PositiveIntegerField(
+        verbose_name=_("Parse (ms)"), null=True, blank=True
+    )
+    crypto_ms = models.PositiveIntegerField(
+        verbose_name=_("Crypto (ms)"), null=True, blank=True
+    )
+    storage_ms = models.PositiveIntegerField(
+        verbose_name=_("Storage (ms)"), null=True, blank=True
+    )
+    http_ms = models.PositiveIntegerField(
+        verbose_name=_("HTTP (ms)"), null=True, blank=True
+    )
+    mdn_ms = models.PositiveIntegerField(
+        verbose_name=_("MDN (ms)"), null=True, blank=True
+    )
+    hooks_ms = models.PositiveIntegerField(
+        verbose_name=_("Hooks (ms)"), null=True, blank=True
+    )
+    sent_at = models.DateTimeField(null=True, blank=True)
+    profile = models.FileField(
+        upload_to=get_profile_store, null=True, blank=True, max_length=4096
+    )
+    profile_size = models.PositiveIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return str(self.message)
+
+
 class MdnManager(models.Manager):
     """Custom model manager for the AS2 MDN model."""
 
@@ -568,13 +1042,13 @@ class MdnManager(models.Manager):
                 status=status,
                 signed=signed,
                 return_url=return_url,
+                headers=as2mdn.headers_str.decode(),
             ),
         )
         filename = f"{uuid4()}.mdn"
-        mdn.headers.save(
-            name=f"{filename}.header", content=ContentFile(as2mdn.headers_str)
-        )
-        mdn.payload.save(filename, content=ContentFile(as2mdn.content))
+        with start_span("as2.store.mdn") as span:
+            mdn.payload.save(filename, content=ContentFile(as2mdn.content))
+        message.add_timing("storage", span.duration)
         return mdn
 
 
@@ -608,10 +1082,15 @@ class Mdn(models.Model):
     signed = models.BooleanField(default=False)
     return_url = models.URLField(null=True)
 
-    headers = models.FileField(upload_to=get_mdn_store, null=True, blank=True)
-    payload = models.FileField(
-        upload_to=get_mdn_store, null=True, blank=True, max_length=4096
+    headers = models.TextField(null=True, blank=True)
+    payload = PackedFileField(
+        upload_to=get_mdn_store,
+        null=True,
+        blank=True,
+        max_length=4096,
+        inline_field="payload_inline",
     )
+    payload_inline = models.BinaryField(null=True, editable=False)
 
     objects = MdnManager()
 
@@ -619,20 +1098,64 @@ class Mdn(models.Model):
         return str(self.mdn_id)
 
     def send_async_mdn(self):
-        """Send the asynchronous MDN to the partner"""
+        """Send the asynchronous MDN to the partner, returns False if the send
+        failed. The pending MDN is claimed before it is sent so that it is
+        sent once when the task backend and ``manageas2server`` pick it up at
+        the same time."""
+        if not Mdn.objects.filter(pk=self.pk, status="P").update(status="S"):
+            logger.info(f"MDN {self.mdn_id} has already been sent.")
+            return True
 
         # convert the mdn headers to dictionary
-        headers = HeaderParser().parsestr(self.headers.read().decode())
+        headers = HeaderParser().parsestr(self.headers or "")
+
+        # Set http basic auth if enabled in the partner profile
+        auth = None
+        partner = self.message.partner
+        if partner and partner.http_auth:
+            auth = (partner.http_auth_user, partner.http_auth_pass)
 
         # Send the mdn to the partner
         try:
             response = requests.post(
-                self.return_url, headers=dict(headers.items()), data=self.payload.read()
+                self.return_url,
+                auth=auth,
+                headers=dict(headers.items()),
+                data=self.payload.read(),
             )
             response.raise_for_status()
-        except requests.exceptions.RequestException:
-            return
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Failed to send MDN {self.mdn_id}, error: {e}")
+            Mdn.objects.filter(pk=self.pk).update(status="P")
+            return False
 
-        # Update the status of the MDN
         self.status = "S"
-        self.save()
+        return True
+
+
+class Task(models.Model):
+    """Model for storing the tasks queued by the database task backend."""
+
+    STATUS_CHOICES = (
+        ("Q", _("Queued")),
+        ("R", _("Running")),
+        ("E", _("Error")),
+    )
+
+    name = models.CharField(max_length=100)
+    arguments = models.TextField(default="{}")
+    status = models.CharField(max_length=2, choices=STATUS_CHOICES, default="Q")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        """Define additional options for the Task model."""
+
+        indexes = [
+            models.Index(fields=["status", "run_after"], name="pyas2_task_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} {self.arguments}"
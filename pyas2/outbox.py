@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import os
+import posixpath
+import threading
+
+from django.core.files.storage import default_storage
+
+from pyas2 import settings
+from pyas2.lanes import PRIORITY_NAMES
+
+# Suffixes of files still being written, the writer renames them once done
+TEMP_SUFFIXES = (".tmp", ".part")
+
+# Pairs of partners and organizations whose outbox folder exists on the local disk
+_created_outboxes = set()
+_created_outboxes_lock = threading.Lock()
+
+
+def get_messages_root():
+    """Return the root folder of the partner outbox and inbox folders."""
+    if settings.DATA_DIR:
+        return os.path.join(settings.DATA_DIR, "messages")
+    return "messages"
+
+
+def get_outbox_folder(partner_name, org_name):
+    """Return the outbox folder for messages from the organization to the partner."""
+    return os.path.join(get_messages_root(), partner_name, "outbox", org_name)
+
+
+def is_ready_filename(filename):
+    """Return False for hidden and temporary files that are not ready to be sent."""
+    return not filename.startswith(".") and not filename.endswith(TEMP_SUFFIXES)
+
+
+def parse_outbox_path(path):
+    """Return the partner, organization and priority name of a file in an
+    outbox folder, or None if the path is not an outbox file."""
+    parts = os.path.relpath(path, get_messages_root()).split(os.sep)
+    if len(parts) == 4 and parts[1] == "outbox":
+        partner_name, _, org_name, filename = parts
+        priority_name = None
+    elif len(parts) == 5 and parts[1] == "outbox" and parts[3] in PRIORITY_NAMES:
+        partner_name, _, org_name, priority_name, filename = parts
+    else:
+        return None
+
+    if not is_ready_filename(filename):
+        return None
+    return partner_name, org_name, priority_name
+
+
+def create_outbox_folder(partner_name, org_name):
+    """Create the outbox folder of the partner and organization pair on the
+    local disk the first time the pair exchanges a message, object storages do
+    not need folders."""
+    key = (get_messages_root(), partner_name, org_name)
+    with _created_outboxes_lock:
+        if key in _created_outboxes:
+            return
+    try:
+        outbox_folder = default_storage.path(get_outbox_folder(partner_name, org_name))
+    except NotImplementedError:
+        outbox_folder = None
+    # The folder is created again by the next message if this fails
+    if outbox_folder:
+        os.makedirs(outbox_folder, exist_ok=True)
+    with _created_outboxes_lock:
+        _created_outboxes.add(key)
+
+
+def _scan_folder(list_folder, folder):
+    """Yield the file names and priority names of the files in an outbox folder
+    and its priority sub-folders."""
+    sub_folders, filenames = list_folder(folder)
+    for filename in filter(is_ready_filename, filenames):
+        yield filename, None
+    for priority_name in sorted(set(sub_folders) & set(PRIORITY_NAMES)):
+        _, filenames = list_folder(os.path.join(folder, priority_name))
+        for filename in filter(is_ready_filename, filenames):
+            yield os.path.join(priority_name, filename), priority_name
+
+
+def _list_local(folder):
+    """List the sub-folders and files of a local folder in a single scandir."""
+    sub_folders, filenames = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    sub_folders.append(entry.name)
+                elif entry.is_file():
+                    filenames.append(entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return sub_folders, filenames
+
+
+def _list_storage(folder):
+    """List the sub-folders and files of a folder in the storage."""
+    try:
+        return default_storage.listdir(folder)
+    except FileNotFoundError:
+        return [], []
+
+
+def _list_tree_storage(folder):
+    """Return the paths, relative to the folder, of all the files below the
+    folder in the storage. S3 compatible storages list them with a single
+    paginated prefix listing, the other storages walk the sub-folders."""
+    objects = getattr(getattr(default_storage, "bucket", None), "objects", None)
+    if objects is not None:
+        prefix = posixpath.join(getattr(default_storage, "location", ""), folder)
+        prefix = prefix.strip("/") + "/"
+        return [obj.key[len(prefix) :] for obj in objects.filter(Prefix=prefix)]
+
+    sub_folders, paths = _list_storage(folder)
+    for sub_folder in sub_folders:
+        paths.extend(
+            posixpath.join(sub_folder, path)
+            for path in _list_tree_storage(posixpath.join(folder, sub_folder))
+        )
+    return paths
+
+
+def scan_outboxes():
+    """Yield the partner name, organization name, path and priority name of
+    every file waiting in the outbox folders.
+
+    On the local disk the messages folder is walked once, only descending into
+    the existing ``{partner}/outbox/{org}`` folders, so the cost depends on the
+    folders present and not on the number of partner and organization pairs.
+    On object storages, where folders only exist while they hold files, the
+    files of each ``{partner}/outbox`` folder holding files are found with a
+    single prefix listing.
+    """
+    root = get_messages_root()
+    try:
+        local_root = default_storage.path(root)
+    except NotImplementedError:
+        local_root = None
+
+    if local_root is None:
+        top_folders, _ = _list_storage(root)
+        for partner_name in top_folders:
+            outbox_root = posixpath.join(root, partner_name, "outbox")
+            for path in _list_tree_storage(outbox_root):
+                path = posixpath.join(outbox_root, path)
+                outbox = parse_outbox_path(path)
+                if outbox:
+                    yield outbox[0], outbox[1], path, outbox[2]
+        return
+
+    top_folders, _ = _list_local(local_root)
+    for partner_name in top_folders:
+        org_names, _ = _list_local(os.path.join(local_root, partner_name, "outbox"))
+        for org_name in org_names:
+            folder = os.path.join(partner_name, "outbox", org_name)
+            pending_files = _scan_folder(_list_local, os.path.join(local_root, folder))
+            for filename, priority_name in pending_files:
+                path = os.path.join(root, folder, filename)
+                yield partner_name, org_name, path, priority_name
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import functools
+import io
+import json
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import zlib
+
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models.fields.files import FieldFile, FileField
+
+from pyas2 import settings
+
+# Folders of the message and MDN stores, they hold a folder per day
+STORE_FOLDERS = [
+    "messages/__store/payload/sent",
+    "messages/__store/payload/received",
+    "messages/__store/mdn/sent",
+    "messages/__store/mdn/received",
+]
+
+# Folders deleted by day when the archive is cleaned, the profiles are not packed
+RETENTION_FOLDERS = STORE_FOLDERS + ["messages/__store/profile"]
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+
+DAY_FOLDER_RE = re.compile(r"^\d{8}$")
+
+
+def get_day_folder(name):
+    """Return the day folder of a stored file, or None if the file is not
+    stored in a day folder."""
+    folder = posixpath.dirname(name.replace("\\", "/"))
+    if DAY_FOLDER_RE.match(posixpath.basename(folder)):
+        return folder
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def load_index(folder):
+    """Return the index of the pack of the day folder, or None if the folder
+    has not been packed."""
+    try:
+        with default_storage.open(folder + INDEX_SUFFIX, "rb") as index_file:
+            return json.loads(index_file.read())
+    except FileNotFoundError:
+        return None
+
+
+def _storage_key(name):
+    """Return the key of a file in an S3 compatible storage."""
+    return posixpath.join(getattr(default_storage, "location", ""), name).strip("/")
+
+
+def _read_range(name, offset, length):
+    """Return the bytes of the file in the range, S3 compatible storages only
+    fetch the range from the object storage."""
+    bucket = getattr(default_storage, "bucket", None)
+    if bucket is None or not length:
+        with default_storage.open(name, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+    try:
+        response = bucket.Object(_storage_key(name)).get(
+            Range=f"bytes={offset}-{offset + length - 1}"
+        )
+    except bucket.meta.client.exceptions.NoSuchKey as e:
+        raise FileNotFoundError(f"{name} does not exist.") from e
+    return response["Body"].read()
+
+
+def _replace_file(name, content):
+    """Replace the file with the content. It is written under a new name and
+    then switched to, so that the file is never missing for the readers, except
+    on storages that are neither local nor S3 compatible."""
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        path = None
+    bucket = getattr(default_storage, "bucket", None)
+    if not path and bucket is None:
+        default_storage.delete(name)
+        default_storage.save(name, content)
+        return
+
+    new_name = default_storage.save(name + ".new", content)
+    if path:
+        os.replace(default_storage.path(new_name), path)
+    else:
+        bucket.Object(_storage_key(name)).copy_from(
+            CopySource={"Bucket": bucket.name, "Key": _storage_key(new_name)}
+        )
+        default_storage.delete(new_name)
+
+
+def _read_member(index, filename):
+    offset, length, _ = index["files"][filename]
+    return zlib.decompress(_read_range(index["pack"], offset, length))
+
+
+def find_packed(name, reload=False):
+    """Return the index of the pack holding the file, raises a
+    FileNotFoundError if the file is not packed."""
+    folder = get_day_folder(name)
+    if folder:
+        if reload:
+            load_index.cache_clear()
+        index = load_index(folder)
+        if index and posixpath.basename(name) in index["files"]:
+            return index
+        if not reload:
+            # The folder may have been packed since its index was loaded
+            return find_packed(name, reload=True)
+    raise FileNotFoundError(f"{name} is neither stored nor packed.")
+
+
+def read_packed(name):
+    """Return the content of a file from the pack of its day folder, raises a
+    FileNotFoundError if the file is not packed."""
+    filename = posixpath.basename(name)
+    try:
+        return _read_member(find_packed(name), filename)
+    except FileNotFoundError:
+        # The folder was packed again since its index was loaded
+        return _read_member(find_packed(name, reload=True), filename)
+
+
+def packed_size(name):
+    """Return the uncompressed size of a packed file."""
+    return find_packed(name)["files"][posixpath.basename(name)][2]
+
+
+def list_day_folders(before, stores=None):
+    """Return the day folders of the stores, packed or not, for the days
+    before the date."""
+    folders = []
+    for store in stores or STORE_FOLDERS:
+        if not default_storage.exists(store):
+            continue
+        dirs, files = default_storage.listdir(store)
+        days = set(dirs)
+        days.update(f[: -len(INDEX_SUFFIX)] for f in files if f.endswith(INDEX_SUFFIX))
+        for day in sorted(days):
+            if DAY_FOLDER_RE.match(day) and day < before.strftime("%Y%m%d"):
+                folders.append(posixpath.join(store, day))
+    return folders
+
+
+def pack_folder(folder):
+    """Pack the files of the day folder, along with the files of an existing
+    pack of the folder, into a single pack of compressed files with an index
+    of their offsets. Returns the number of files added to the pack."""
+    if not default_storage.exists(folder):
+        return 0
+    filenames = sorted(default_storage.listdir(folder)[1])
+    if not filenames:
+        return 0
+
+    load_index.cache_clear()
+    old_index = load_index(folder)
+    files = {}
+    with tempfile.TemporaryFile() as pack:
+        # Copy the compressed files of the existing pack as they are
+        if old_index:
+            with default_storage.open(old_index["pack"], "rb") as old_pack:
+                for filename, (offset, length, size) in old_index["files"].items():
+                    old_pack.seek(offset)
+                    files[filename] = [pack.tell(), length, size]
+                    pack.write(old_pack.read(length))
+
+        for filename in filenames:
+            with default_storage.open(posixpath.join(folder, filename), "rb") as f:
+                content = f.read()
+            compressed = zlib.compress(content)
+            files[filename] = [pack.tell(), len(compressed), len(content)]
+            pack.write(compressed)
+
+        # Storages do not overwrite files, the new pack gets a new name when
+        # the folder is packed again and the index points to it
+        pack.seek(0)
+        pack_name = default_storage.save(folder + PACK_SUFFIX, File(pack))
+
+    index = json.dumps({"pack": pack_name, "files": files}).encode()
+    _replace_file(folder + INDEX_SUFFIX, ContentFile(index))
+    load_index.cache_clear()
+    if old_index and old_index["pack"] != pack_name:
+        default_storage.delete(old_index["pack"])
+
+    for filename in filenames:
+        default_storage.delete(posixpath.join(folder, filename))
+    return len(filenames)
+
+
+def delete_packs(before):
+    """Delete the packs of the days before the date."""
+    for folder in list_day_folders(before):
+        index = load_index(folder)
+        if index:
+            default_storage.delete(index["pack"])
+            default_storage.delete(folder + INDEX_SUFFIX)
+    load_index.cache_clear()
+
+
+def delete_day_folders(before):
+    """Delete the day folders of the stores for the days before the date along
+    with their packs, each folder is deleted at once when the storage is on
+    the local disk."""
+    for folder in list_day_folders(before, stores=RETENTION_FOLDERS):
+        index = load_index(folder)
+        if index:
+            default_storage.delete(index["pack"])
+            default_storage.delete(folder + INDEX_SUFFIX)
+        try:
+            path = default_storage.path(folder)
+        except NotImplementedError:
+            path = None
+        if path:
+            shutil.rmtree(path, ignore_errors=True)
+        elif default_storage.exists(folder):
+            for filename in default_storage.listdir(folder)[1]:
+                default_storage.delete(posixpath.join(folder, filename))
+    load_index.cache_clear()
+
+
+class PackedFieldFile(FieldFile):
+    """File of a model that is read from the pack of its day folder once the
+    folder has been packed, or from the inline column of the model when the
+    file was small enough to be stored in the database."""
+
+    @property
+    def inline_content(self):
+        """Return the content of the file stored in the inline column of the
+        model, or None if the file is in the storage."""
+        if self.field.inline_field:
+            compressed = getattr(self.instance, self.field.inline_field)
+            if compressed is not None:
+                return zlib.decompress(compressed)
+        return None
+
+    def _get_file(self):
+        self._require_file()
+        if getattr(self, "_file", None) is None:
+            content = self.inline_content
+            if content is not None:
+                self._file = ContentFile(content, name=self.name)
+                return self._file
+            try:
+                self._file = self.storage.open(self.name, "rb")
+            except FileNotFoundError:
+                self._file = ContentFile(read_packed(self.name), name=self.name)
+        return self._file
+
+    file = property(_get_file, FieldFile._set_file, FieldFile._del_file)
+
+    @property
+    def size(self):
+        self._require_file()
+        if not self._committed:
+            return self.file.size
+        content = self.inline_content
+        if content is not None:
+            return len(content)
+        try:
+            return self.storage.size(self.name)
+        except FileNotFoundError:
+            return packed_size(self.name)
+
+    def open(self, mode="rb"):
+        self._require_file()
+        if getattr(self, "_file", None) is None:
+            content = self.inline_content
+            if content is None:
+                try:
+                    self.file = self.storage.open(self.name, mode)
+                    return self
+                except FileNotFoundError:
+                    content = read_packed(self.name)
+            if "b" not in mode:
+                # Translate the newlines as when reading a text file
+                content = io.TextIOWrapper(io.BytesIO(content), encoding="utf-8").read()
+            self.file = ContentFile(content, name=self.name)
+        else:
+            self.file.open(mode)
+        return self
+
+    def save(self, name, content, save=True):
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        inline_field = self.field.inline_field
+        max_size = settings.INLINE_PAYLOAD_MAX_SIZE
+        if not inline_field or not max_size or content.size > max_size:
+            if inline_field:
+                setattr(self.instance, inline_field, None)
+            super().save(name, content, save=save)
+            return
+
+        # Keep the name of the file for the downloads and hooks, the file
+        # itself is only stored in the inline column
+        self.name = self.field.generate_filename(self.instance, name)
+        content.seek(0)
+        data = content.read()
+        if isinstance(data, str):
+            data = data.encode()
+        setattr(self.instance, inline_field, zlib.compress(data))
+        setattr(self.instance, self.field.attname, self.name)
+        self._committed = True
+        if save:
+            self.instance.save()
+
+    def delete(self, save=True):
+        if self and self.inline_content is not None:
+            if hasattr(self, "_file"):
+                self.close()
+                del self.file
+            self.name = None
+            setattr(self.instance, self.field.attname, None)
+            setattr(self.instance, self.field.inline_field, None)
+            self._committed = False
+            if save:
+                self.instance.save()
+            return
+        super().delete(save=save)
+
+
+class PackedFileField(FileField):
+    """File field whose files can be read from the packs of the store. When the
+    ``inline_field`` names a binary field of the model, the files up to
+    ``INLINE_PAYLOAD_MAX_SIZE`` bytes are compressed into it instead of the storage."""
+
+    attr_class = PackedFieldFile
+
+    def __init__(self, *args, inline_field=None, **kwargs):
+        self.inline_field = inline_field
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.inline_field:
+            kwargs["inline_field"] = self.inline_field
+        return name, path, args, kwargs
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative range partitioning of the message tables by timestamp on
+PostgreSQL.
+
+The tables are converted once, the original table is renamed and its rows
+copied into a partitioned table with the same columns. PostgreSQL requires the
+primary key and the unique constraints of a partitioned table to include the
+partition column, so they are created with the timestamp added and the
+uniqueness of the message ids is checked by the application, and the foreign
+keys referencing the table are dropped as they cannot reference a partitioned
+table. A default partition holds the rows outside of the created
+partitions so that inserts never fail.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.db.backends.utils import names_digest
+
+from pyas2 import settings
+
+PARTITION_COLUMN = "timestamp"
+
+
+def interval_start(day, interval):
+    """Return the first day of the partition interval containing the day."""
+    if interval == "month":
+        return day.replace(day=1)
+    return day
+
+
+def next_interval(start, interval):
+    """Return the first day of the partition interval after the one starting on
+    the day."""
+    if interval == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(table, start, interval):
+    """Return the name of the partition of the table starting on the day."""
+    return f"{table}_p{start.strftime('%Y%m' if interval == 'month' else '%Y%m%d')}"
+
+
+def partition_start(table, name, interval):
+    """Return the first day of the partition of the table with the name, or
+    None if it is not an interval partition."""
+    prefix = f"{table}_p"
+    if not name.startswith(prefix):
+        return None
+    try:
+        return datetime.strptime(
+            name[len(prefix) :], "%Y%m" if interval == "month" else "%Y%m%d"
+        ).date()
+    except ValueError:
+        return None
+
+
+def _bound(day):
+    return datetime.combine(day, datetime.min.time(), tzinfo=dt_timezone.utc)
+
+
+class TablePartitioner:
+    """Create and drop the partitions of the table of a model."""
+
+    def __init__(self, model, interval=None):
+        self.model = model
+        self.table = model._meta.db_table  # pylint: disable=W0212
+        self.interval = interval or settings.PARTITION_INTERVAL
+        self.default_partition = f"{self.table}_default"
+
+    @staticmethod
+    def quote(name):
+        return connection.ops.quote_name(name)
+
+    def execute(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall() if cursor.description else None
+
+    def is_partitioned(self, table=None):
+        rows = self.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+            [table or self.table],
+        )
+        return bool(rows)
+
+    def partitions(self):
+        """Return the names of the partitions of the table."""
+        rows = self.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s)",
+            [self.table],
+        )
+        return sorted(row[0] for row in rows)
+
+    def create_partition(self, start):
+        """Create the partition starting on the day, unless it exists, and move
+        its rows out of the default partition. Returns True if it was created."""
+        name = partition_name(self.table, start, self.interval)
+        if name in self.partitions():
+            return False
+        end = next_interval(start, self.interval)
+        with transaction.atomic():
+            self.execute(
+                f"CREATE TABLE {self.quote(name)} (LIKE {self.quote(self.table)} "
+                "INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+            )
+            if self.default_partition in self.partitions():
+                self.execute(
+                    f"WITH moved AS (DELETE FROM {self.quote(self.default_partition)} "
+                    f"WHERE {self.quote(PARTITION_COLUMN)} >= %s "
+                    f"AND {self.quote(PARTITION_COLUMN)} < %s RETURNING *) "
+                    f"INSERT INTO {self.quote(name)} SELECT * FROM moved",
+                    [_bound(start), _bound(end)],
+                )
+            self.execute(
+                f"ALTER TABLE {self.quote(self.table)} ATTACH PARTITION "
+                f"{self.quote(name)} FOR VALUES FROM (%s) TO (%s)",
+                [_bound(start), _bound(end)],
+            )
+        return True
+
+    def create_partitions(self, first_day, last_day):
+        """Create the partitions from the day to the last day, returns the
+        number of partitions created."""
+        created = 0
+        start = interval_start(first_day, self.interval)
+        while start <= last_day:
+            created += self.create_partition(start)
+            start = next_interval(start, self.interval)
+        return created
+
+    def drop_partitions(self, before):
+        """Drop the partitions that end on or before the day and delete the
+        rows of the default partition before it. Returns the number of
+        partitions dropped."""
+        dropped = 0
+        for name in self.partitions():
+            start = partition_start(self.table, name, self.interval)
+            if start and next_interval(start, self.interval) <= before:
+                self.execute(f"DROP TABLE {self.quote(name)}")
+                dropped += 1
+        if self.default_partition in self.partitions():
+            self.execute(
+                f"DELETE FROM {self.quote(self.default_partition)} "
+                f"WHERE {self.quote(PARTITION_COLUMN)} < %s",
+                [_bound(before)],
+            )
+        return dropped
+
+    def index_statements(self):
+        """Return the statements creating the primary key, the indexes and the
+        foreign keys of the model on the partitioned table."""
+        opts = self.model._meta  # pylint: disable=W0212
+        table = self.quote(self.table)
+
+        def index(columns, unique=False):
+            name = f"{self.table}_{names_digest(*columns, length=8)}_part"
+            cols = ", ".join(self.quote(column) for column in columns)
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            return f"CREATE {kind} {self.quote(name)} ON {table} ({cols})"
+
+        statements = [
+            f"ALTER TABLE {table} ADD PRIMARY KEY "
+            f"({self.quote(opts.pk.column)}, {self.quote(PARTITION_COLUMN)})"
+        ]
+        for field in opts.local_fields:
+            if field.primary_key:
+                continue
+            if field.unique:
+                statements.append(index([field.column, PARTITION_COLUMN], True))
+            elif field.db_index:
+                statements.append(index([field.column]))
+            if field.is_relation and field.db_constraint:
+                target = field.remote_field.model._meta  # pylint: disable=W0212
+                if self.is_partitioned(target.db_table):
+                    continue
+                name = f"{self.table}_{names_digest(field.column, length=8)}_fk_part"
+                statements.append(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {self.quote(name)} "
+                    f"FOREIGN KEY ({self.quote(field.column)}) REFERENCES "
+                    f"{self.quote(target.db_table)} "
+                    f"({self.quote(field.target_field.column)}) "
+                    "DEFERRABLE INITIALLY DEFERRED"
+                )
+        for fields in opts.unique_together:
+            columns = [opts.get_field(name).column for name in fields]
+            statements.append(index(columns + [PARTITION_COLUMN], True))
+        for model_index in opts.indexes:
+            columns = [opts.get_field(name).column for name in model_index.fields]
+            statements.append(index(columns))
+        return statements
+
+    def setup(self):
+        """Convert the table to a partitioned table, the original table is kept
+        with the suffix ``_unpartitioned``. Returns False if the table is
+        already partitioned."""
+        if self.is_partitioned():
+            return False
+
+        table = self.quote(self.table)
+        old_table = f"{self.table}_unpartitioned"
+        pk_column = self.quote(self.model._meta.pk.column)  # pylint: disable=W0212
+        sequence = f"{self.table}_part_id_seq"
+        with transaction.atomic():
+            # Check the deferred constraints of the rows written earlier in the
+            # transaction, the tables cannot be altered with pending checks
+            self.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            # Foreign keys cannot reference a partitioned table
+            referencing = self.execute(
+                "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+                "WHERE contype = 'f' AND confrelid = to_regclass(%s)",
+                [self.table],
+            )
+            for referencing_table, constraint in referencing:
+                self.execute(
+                    f"ALTER TABLE {referencing_table} "
+                    f"DROP CONSTRAINT {self.quote(constraint)}"
+                )
+
+            self.execute(f"ALTER TABLE {table} RENAME TO {self.quote(old_table)}")
+            self.execute(
+                f"CREATE TABLE {table} (LIKE {self.quote(old_table)} "
+                f"INCLUDING CONSTRAINTS) PARTITION BY RANGE "
+                f"({self.quote(PARTITION_COLUMN)})"
+            )
+            self.execute(f"CREATE SEQUENCE {self.quote(sequence)}")
+            self.execute(
+                f"SELECT setval(%s, COALESCE(MAX({pk_column}), 0) + 1, false) "
+                f"FROM {self.quote(old_table)}",
+                [sequence],
+            )
+            self.execute(
+                f"ALTER TABLE {table} ALTER COLUMN {pk_column} "
+                f"SET DEFAULT nextval('{sequence}')"
+            )
+            self.execute(
+                f"ALTER SEQUENCE {self.quote(sequence)} OWNED BY {table}.{pk_column}"
+            )
+            for statement in self.index_statements():
+                self.execute(statement)
+
+            self.execute(
+                f"CREATE TABLE {self.quote(self.default_partition)} "
+                f"PARTITION OF {table} DEFAULT"
+            )
+            first_day = self.execute(
+                f"SELECT MIN({self.quote(PARTITION_COLUMN)}) FROM {self.quote(old_table)}"
+            )[0][0]
+            today = datetime.now(dt_timezone.utc).date()
+            self.create_partitions(
+                first_day.astimezone(dt_timezone.utc).date() if first_day else today,
+                today,
+            )
+            self.execute(f"INSERT INTO {table} SELECT * FROM {self.quote(old_table)}")
+        return True
+
+    def expired_keys(self, before):
+        """Return the lowest and highest primary keys of the rows before the
+        day, i.e. of the partitions about to be dropped, or None if there are
+        no such rows."""
+        pk_column = self.quote(self.model._meta.pk.column)  # pylint: disable=W0212
+        row = self.execute(
+            f"SELECT MIN({pk_column}), MAX({pk_column}) FROM {self.quote(self.table)} "
+            f"WHERE {self.quote(PARTITION_COLUMN)} < %s",
+            [_bound(before)],
+        )[0]
+        return None if row[0] is None else row
+
+    def delete_orphans(self, related_model, keys):
+        """Delete the rows of the related model whose row in the table has been
+        dropped, among the rows referencing the range of primary keys returned
+        by ``expired_keys`` so that only that range of the index is read."""
+        field = next(
+            f
+            for f in related_model._meta.local_fields  # pylint: disable=W0212
+            if f.is_relation and f.remote_field.model is self.model
+        )
+        related_table = self.quote(
+            related_model._meta.db_table
+        )  # pylint: disable=W0212
+        pk_column = self.quote(self.model._meta.pk.column)  # pylint: disable=W0212
+        column = self.quote(field.column)
+        self.execute(
+            f"DELETE FROM {related_table} r WHERE r.{column} BETWEEN %s AND %s "
+            f"AND NOT EXISTS (SELECT 1 FROM {self.quote(self.table)} t "
+            f"WHERE t.{pk_column} = r.{column})",
+            list(keys),
+        )
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from pyas2 import settings
+
+
+class BloomFilter:
+    """Bloom filter sized for the expected number of keys and false positive
+    rate, it never answers no for a key that was added."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Derive all the positions from two hashes (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(key)
+        )
+
+
+class MessagePrefilter:
+    """Rolling Bloom filter of the message ids and partners of the messages in
+    the archive, used to skip the database lookup for messages that are
+    certainly not duplicates.
+
+    The filter keeps one Bloom filter per day of ``MAX_ARCH_DAYS`` and drops
+    the days that are no longer archived. It is loaded from the database on
+    first use, updated when this process saves a message and picks up the
+    messages saved by other processes every ``DUPLICATE_PREFILTER_REFRESH``
+    seconds. A duplicate received by another process within that interval is
+    rejected by the unique constraint when the message is saved.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.days = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.refreshed_at = 0
+        # Last primary keys seen by the previous two refreshes, the rows
+        # after the older one are read again in case of out of order commits
+        self.last_pks = (0, 0)
+
+    @staticmethod
+    def make_key(message_id, partner_id):
+        return f"{partner_id}\n{message_id}"
+
+    def _add(self, message_id, partner_id, day):
+        bloom = self.days.get(day)
+        if bloom is None:
+            bloom = self.days[day] = BloomFilter(
+                settings.DUPLICATE_PREFILTER_CAPACITY,
+                settings.DUPLICATE_PREFILTER_ERROR_RATE / (settings.MAX_ARCH_DAYS + 1),
+            )
+        bloom.add(self.make_key(message_id, partner_id))
+
+    def add(self, message_id, partner_id, timestamp=None):
+        """Add the message to the filter."""
+        day = (timestamp or timezone.now()).date()
+        with self.lock:
+            self._add(message_id, partner_id, day)
+
+    def refresh(self):
+        """Load the messages saved since the last refresh and drop the days
+        that are no longer archived."""
+        start = timezone.now() - timedelta(settings.MAX_ARCH_DAYS)
+        messages = self.model.objects.filter(pk__gt=self.last_pks[0])
+        if not self.loaded:
+            messages = messages.filter(timestamp__gte=start)
+
+        last_pk = self.last_pks[1]
+        rows = messages.order_by("pk").values_list(
+            "pk", "message_id", "partner_id", "timestamp"
+        )
+        with self.lock:
+            for pk, message_id, partner_id, timestamp in rows.iterator():
+                self._add(message_id, partner_id, timestamp.date())
+                last_pk = max(last_pk, pk)
+            for day in [day for day in self.days if day < start.date()]:
+                del self.days[day]
+            if self.loaded:
+                self.last_pks = (self.last_pks[1], last_pk)
+            else:
+                self.last_pks = (last_pk, last_pk)
+            self.loaded = True
+            self.refreshed_at = time.monotonic()
+
+    def might_contain(self, message_id, partner_id):
+        """Return False if the message is certainly not in the database."""
+        elapsed = time.monotonic() - self.refreshed_at
+        if not self.loaded or elapsed >= settings.DUPLICATE_PREFILTER_REFRESH:
+            self.refresh()
+        key = self.make_key(message_id, partner_id)
+        return any(key in bloom for bloom in list(self.days.values()))
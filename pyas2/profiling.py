@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import cProfile
+import functools
+import logging
+import marshal
+import random
+import time
+
+from pyas2 import settings
+
+logger = logging.getLogger("pyas2")
+
+_current_sample = contextvars.ContextVar("pyas2_profile_sample", default=None)
+
+
+class ProfileSample:
+    """Profile of a sampled call and the message it handled."""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.message = None
+
+    def dumps(self):
+        """Return the profile in the format read by ``pstats.Stats``."""
+        self.profiler.create_stats()
+        return marshal.dumps(self.profiler.stats)
+
+
+def profile_message(message):
+    """Link the message to the profile of the current call, if it is sampled."""
+    sample = _current_sample.get()
+    if sample is not None:
+        sample.message = message
+
+
+def profiled(func):
+    """Decorator profiling a ``PROFILING_SAMPLE_RATE`` share of the calls of the
+    function, the profile is stored with the message of the call when the call
+    takes ``PROFILING_THRESHOLD`` seconds or more."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if (
+            _current_sample.get() is not None
+            or random.random() >= settings.PROFILING_SAMPLE_RATE
+        ):
+            return func(*args, **kwargs)
+
+        sample = ProfileSample()
+        try:
+            sample.profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return func(*args, **kwargs)
+
+        token = _current_sample.set(sample)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sample.profiler.disable()
+            _current_sample.reset(token)
+            elapsed = time.perf_counter() - start
+            if sample.message is not None and elapsed >= settings.PROFILING_THRESHOLD:
+                try:
+                    sample.message.save_profile(sample.dumps())
+                except Exception:  # pylint: disable=W0703
+                    logger.exception("Failed to store the profile of a slow call.")
+
+    return wrapper
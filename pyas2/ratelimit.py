@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from pyas2 import settings
+
+logger = logging.getLogger("pyas2")
+
+# Number of seconds after which an in-flight slot of a crashed process expires
+IN_FLIGHT_LEASE = 600
+
+# Number of seconds after which a stale bucket lock is released by the cache
+LOCK_TIMEOUT = 5
+
+# Number of seconds between the checks for a free in-flight slot
+IN_FLIGHT_POLL_INTERVAL = 0.1
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a send could not be admitted within the max wait time."""
+
+
+@contextmanager
+def cache_lock(cache, key):
+    """Acquire a short lived lock stored in the cache, used to serialize the
+    read-modify-write of the shared bucket state across processes."""
+    lock_key = f"{key}:lock"
+    while not cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        cache.delete(lock_key)
+
+
+class PartnerThrottle:
+    """Enforce the message rate, byte rate and in-flight limits of a partner.
+
+    The state of the token buckets and the in-flight slots is kept in the
+    cache configured by the ``RATE_LIMIT_CACHE`` setting so that the limits
+    are shared by all the processes using the same cache. The local memory
+    cache is not shared, with it the limits apply to each process alone.
+    """
+
+    # Whether the warning about the local memory cache has been logged
+    warned_local_cache = False
+
+    def __init__(self, partner, cache=None):
+        self.partner = partner
+        self.cache = cache or caches[settings.RATE_LIMIT_CACHE]
+        self.key = f"pyas2:throttle:{partner.as2_name}"
+
+    def warn_local_cache(self):
+        """Warn once per process that the limits are not shared when the
+        cache is local to the process."""
+        if (
+            isinstance(self.cache, LocMemCache)
+            and not PartnerThrottle.warned_local_cache
+        ):
+            PartnerThrottle.warned_local_cache = True
+            logger.warning(
+                f"The partner rate limits are kept in the local memory cache "
+                f'"{settings.RATE_LIMIT_CACHE}" of each process, set RATE_LIMIT_CACHE '
+                f"to a shared cache such as Redis or Memcached to share them."
+            )
+
+    @property
+    def enabled(self):
+        """Return True if any of the limits is set for the partner."""
+        return bool(
+            self.partner.rate_limit_msgs
+            or self.partner.rate_limit_bytes
+            or self.partner.max_in_flight
+        )
+
+    def _take_tokens(self, name, rate, cost, now):
+        """Take tokens from the bucket if available and return the number of
+        seconds to wait otherwise. Must be called with the lock held."""
+        key = f"{self.key}:{name}"
+        tokens, last = self.cache.get(key, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+
+        # Allow costs larger than the bucket to go through once it is full
+        needed = min(cost, rate)
+        if tokens < needed:
+            return (needed - tokens) / rate, (key, (tokens, now))
+        return 0, (key, (tokens - cost, now))
+
+    def _try_acquire(self, size):
+        """Try to admit a single send, return a tuple of the seconds to wait
+        and the in-flight slot id when admitted."""
+        partner = self.partner
+        with cache_lock(self.cache, self.key):
+            now = time.time()
+            wait, updates = 0, []
+            if partner.rate_limit_msgs:
+                bucket_wait, update = self._take_tokens(
+                    "msgs", partner.rate_limit_msgs, 1, now
+                )
+                wait = max(wait, bucket_wait)
+                updates.append(update)
+            if partner.rate_limit_bytes:
+                bucket_wait, update = self._take_tokens(
+                    "bytes", partner.rate_limit_bytes, size, now
+                )
+                wait = max(wait, bucket_wait)
+                updates.append(update)
+
+            slots, slot_id = None, None
+            if partner.max_in_flight:
+                slots = {
+                    k: v
+                    for k, v in self.cache.get(f"{self.key}:slots", {}).items()
+                    if v > now
+                }
+                # The slots are freed by the other sends at any time, the
+                # lease expiry only bounds the slots of crashed processes
+                if len(slots) >= partner.max_in_flight:
+                    wait = max(wait, IN_FLIGHT_POLL_INTERVAL)
+
+            if wait:
+                return wait, None
+
+            for key, state in updates:
+                self.cache.set(key, state, timeout=None)
+            if slots is not None:
+                slot_id = uuid4().hex
+                slots[slot_id] = now + IN_FLIGHT_LEASE
+                self.cache.set(f"{self.key}:slots", slots, timeout=IN_FLIGHT_LEASE)
+            return 0, slot_id
+
+    def _release(self, slot_id):
+        """Free the in-flight slot taken by the send."""
+        with cache_lock(self.cache, self.key):
+            slots = self.cache.get(f"{self.key}:slots", {})
+            slots.pop(slot_id, None)
+            self.cache.set(f"{self.key}:slots", slots, timeout=IN_FLIGHT_LEASE)
+
+    @contextmanager
+    def acquire(self, size, max_wait=None):
+        """Wait until the partner limits admit a send of ``size`` bytes and hold
+        an in-flight slot for the duration of the block."""
+        if not self.enabled:
+            yield
+            return
+
+        self.warn_local_cache()
+        if max_wait is None:
+            max_wait = settings.RATE_LIMIT_MAX_WAIT
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait, slot_id = self._try_acquire(size)
+            if not wait:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RateLimitExceeded(
+                    f'Rate limit of partner "{self.partner.as2_name}" not '
+                    f"available within {max_wait} seconds."
+                )
+            logger.debug(
+                f'Throttling send to partner "{self.partner.as2_name}" '
+                f"for {wait:.3f} seconds."
+            )
+            time.sleep(min(wait, remaining))
+
+        try:
+            yield
+        finally:
+            if slot_id:
+                self._release(slot_id)
+
+
+class AdmissionControl:
+    """Limit the number and the total size of the requests handled at the same
+    time by the process, to ``RECEIVE_MAX_IN_FLIGHT`` requests and
+    ``RECEIVE_MAX_IN_FLIGHT_BYTES`` bytes. A request larger than the byte limit
+    is only admitted when no other request is in flight."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+
+    def try_acquire(self, size):
+        """Admit the request of the size if within the limits, returns False
+        when it must be refused."""
+        max_requests = settings.RECEIVE_MAX_IN_FLIGHT
+        max_bytes = settings.RECEIVE_MAX_IN_FLIGHT_BYTES
+        with self.lock:
+            if max_requests and self.in_flight >= max_requests:
+                return False
+            if max_bytes and self.in_flight and self.in_flight_bytes + size > max_bytes:
+                return False
+            self.in_flight += 1
+            self.in_flight_bytes += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.in_flight -= 1
+            self.in_flight_bytes -= size
+
+
+receive_admission = AdmissionControl()
@@ -0,0 +1,76 @@
+"""
+Lightweight WSGI and ASGI applications for nodes that only receive AS2
+messages and asynchronous MDNs from partners.
+
+Requests are dispatched straight to the receive view without running the
+project's middleware or loading its URL configuration, point the server at
+``pyas2.receive_app:application`` (WSGI) or
+``pyas2.receive_app:asgi_application`` (ASGI) with ``DJANGO_SETTINGS_MODULE``
+set.
+"""
+import django
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.handlers.wsgi import WSGIHandler
+
+try:
+    from django.core.handlers.asgi import ASGIHandler
+except ImportError:  # pragma: no cover
+    ASGIHandler = None
+
+# URL configuration holding only the receive urls
+RECEIVE_URLCONF = "pyas2.receive_urls"
+
+
+class ReceiveHandlerMixin:
+    """Handler that resolves the requests against the receive urls only and
+    skips all the middleware."""
+
+    def load_middleware(self, is_async=False):
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+        if is_async:
+            self._middleware_chain = convert_exception_to_response(self._receive_async)
+        else:
+            self._middleware_chain = convert_exception_to_response(self._receive)
+
+    def _receive(self, request):
+        request.urlconf = RECEIVE_URLCONF
+        return self._get_response(request)
+
+    async def _receive_async(self, request):
+        request.urlconf = RECEIVE_URLCONF
+        return await self._get_response_async(request)
+
+
+class ReceiveWSGIHandler(ReceiveHandlerMixin, WSGIHandler):
+    """WSGI handler for the receive only application."""
+
+
+def get_receive_wsgi_application():
+    """Return the receive only WSGI application."""
+    django.setup(set_prefix=False)
+    return ReceiveWSGIHandler()
+
+
+if ASGIHandler:
+
+    class ReceiveASGIHandler(ReceiveHandlerMixin, ASGIHandler):
+        """ASGI handler for the receive only application."""
+
+    def get_receive_asgi_application():
+        """Return the receive only ASGI application."""
+        django.setup(set_prefix=False)
+        return ReceiveASGIHandler()
+
+
+def __getattr__(name):
+    """Create the applications on first access so that only the one served is
+    loaded."""
+    if name == "application":
+        globals()[name] = get_receive_wsgi_application()
+    elif name == "asgi_application" and ASGIHandler:
+        globals()[name] = get_receive_asgi_application()
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return globals()[name]
@@ -0,0 +1,10 @@
+from django.urls import re_path
+
+from pyas2 import views
+
+# Receive on the same path as the full application, whatever its prefix
+urlpatterns = [
+    re_path(
+        r"^(?:.*/)?as2receive/?$", views.ReceiveAs2Message.as_view(), name="as2-receive"
+    ),
+]
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import queue
+import threading
+import traceback
+
+import requests
+from django.core.files.storage import default_storage
+from django.db import connections
+from django.utils.functional import cached_property
+from pyas2lib import Message as AS2Message
+
+from pyas2 import settings
+from pyas2.models import Message
+from pyas2.tasks import dispatch_send
+from pyas2.tracing import start_span
+
+logger = logging.getLogger("pyas2")
+
+
+class BatchSender:
+    """Send many files from an organization to a partner in a single pass.
+
+    The pyas2lib organization and partner objects, with their keys and
+    certificates, are loaded once for the pair and the messages are created in
+    batches of ``SEND_BATCH_SIZE`` before being sent one after the other.
+    """
+
+    def __init__(self, organization, partner, batch_size=None):
+        self.organization = organization
+        self.partner = partner
+        self.batch_size = batch_size or settings.SEND_BATCH_SIZE
+
+    @cached_property
+    def as2org(self):
+        return self.organization.as2org
+
+    @cached_property
+    def as2partner(self):
+        return self.partner.as2partner
+
+    def build(self, path):
+        """Build the AS2 message for the file, returns the pyas2lib message,
+        the payload, the original file name and the seconds spent building."""
+        original_filename = os.path.basename(path)
+        with default_storage.open(path, "rb") as in_file:
+            payload = in_file.read()
+        as2message = AS2Message(sender=self.as2org, receiver=self.as2partner)
+        with start_span("as2.build") as span:
+            as2message.build(
+                payload,
+                filename=original_filename,
+                subject=self.partner.subject,
+                content_type=self.partner.content_type,
+                disposition_notification_to=self.organization.email_address
+                or "no-reply@pyas2.com",
+            )
+        return as2message, payload, original_filename, span.duration
+
+    def resend(self, message, session=None):
+        """Send the envelope kept for the retries of the message again, or
+        build the message again from its stored payload and send it."""
+        envelope = message.load_envelope()
+        if envelope:
+            message.send_message(*envelope, session=session)
+            return
+
+        as2message = AS2Message(sender=self.as2org, receiver=self.as2partner)
+        with start_span("as2.build") as span:
+            as2message.build(
+                message.payload.read(),
+                filename=os.path.basename(message.payload.name),
+                subject=self.partner.subject,
+                content_type=self.partner.content_type,
+                disposition_notification_to=self.organization.email_address
+                or "no-reply@pyas2.com",
+            )
+        message.add_timing("crypto", span.duration)
+        message.send_message(as2message.headers, as2message.content, session=session)
+
+    @staticmethod
+    def discard(messages):
+        """Delete the messages that were created but not sent and their payloads."""
+        for message in messages:
+            message.payload.delete(save=False)
+        Message.objects.filter(pk__in=[message.pk for message in messages]).delete()
+
+    def send(self, paths, priority=None, delete=True):
+        """Send the files to the partner and return the created messages, files
+        that no longer exist are skipped."""
+        if priority is None:
+            priority = self.partner.default_priority
+
+        sent_messages = []
+        for start in range(0, len(paths), self.batch_size):
+            batch_paths, outbound = [], []
+            for path in paths[start : start + self.batch_size]:
+                try:
+                    outbound.append(self.build(path))
+                except FileNotFoundError:
+                    logger.warning(f'Payload at location "{path}" does not exist.')
+                    continue
+                batch_paths.append(path)
+
+            messages = Message.objects.bulk_create_from_as2messages(
+                self.organization,
+                self.partner,
+                [built[:3] for built in outbound],
+                priority,
+            )
+            dispatched = 0
+            try:
+                for message, (as2message, _, _, build_time), path in zip(
+                    messages, outbound, batch_paths
+                ):
+                    message.add_timing("crypto", build_time)
+                    dispatched += 1
+                    try:
+                        dispatch_send(message, as2message.headers, as2message.content)
+                    except Exception:
+                        message.status = "E"
+                        message.detailed_status = (
+                            f"Failed to send message, error:\n{traceback.format_exc()}"
+                        )
+                        message.save()
+                        raise
+                    if delete:
+                        default_storage.delete(path)
+            finally:
+                # Remove the pending messages of the batch that were not sent,
+                # their files are left in the outbox for the next run
+                self.discard(messages[dispatched:])
+            sent_messages.extend(messages)
+        return sent_messages
+
+
+class BulkResender:
+    """Resend stored outbound messages from a pool of ``workers`` threads.
+
+    The messages are streamed from the queryset and handed to the workers
+    through a bounded queue, each worker sends over its own pooled HTTP
+    session and the keys and certificates are loaded once per organization
+    and partner pair. The optional ``progress`` callback is called with each
+    message once it is resent and the number of messages done so far.
+    """
+
+    def __init__(self, workers=None, progress=None):
+        self.workers = workers or settings.RESEND_WORKERS
+        self.progress = progress
+        self.senders = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def get_sender(self, message):
+        key = (message.organization_id, message.partner_id)
+        with self.lock:
+            if key not in self.senders:
+                self.senders[key] = BatchSender(message.organization, message.partner)
+            return self.senders[key]
+
+    def resend(self, message, session):
+        try:
+            self.get_sender(message).resend(message, session)
+            succeeded = message.status in ("S", "P")
+        except Exception:  # pylint: disable=W0703
+            logger.exception(f"Failed to resend message {message.message_id}.")
+            succeeded = False
+
+        with self.lock:
+            if succeeded:
+                self.sent += 1
+            else:
+                self.failed += 1
+            done = self.sent + self.failed
+        if self.progress:
+            self.progress(message, done)
+
+    def work(self, messages):
+        with requests.Session() as session:
+            try:
+                while True:
+                    message = messages.get()
+                    if message is None:
+                        break
+                    self.resend(message, session)
+            finally:
+                connections.close_all()
+
+    def run(self, messages):
+        """Resend the outbound messages of the queryset, returns the number of
+        messages sent and failed."""
+        messages = messages.filter(direction="OUT").select_related(
+            "organization", "partner"
+        )
+        if self.workers <= 1:
+            with requests.Session() as session:
+                for message in messages.iterator():
+                    self.resend(message, session)
+            return self.sent, self.failed
+
+        pending = queue.Queue(maxsize=self.workers * 2)
+        threads = [
+            threading.Thread(target=self.work, args=(pending,))
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for message in messages.iterator():
+                pending.put(message)
+        finally:
+            for _ in threads:
+                pending.put(None)
+            for thread in threads:
+                thread.join()
+        return self.sent, self.failed
@@ -20,3 +20,116 @@ ASYNC_MDN_WAIT = APP_SETTINGS.get("ASYNC_MDN_WAIT", 30)
 
 # Max number of days worth of messages to be saved in archive
 MAX_ARCH_DAYS = APP_SETTINGS.get("MAX_ARCH_DAYS", 30)
+
+# Name of the django cache used to share the partner rate limits across processes
+RATE_LIMIT_CACHE = APP_SETTINGS.get("RATE_LIMIT_CACHE", "default")
+
+# Max number of seconds a send waits for the partner rate limits
+RATE_LIMIT_MAX_WAIT = APP_SETTINGS.get("RATE_LIMIT_MAX_WAIT", 60)
+
+# Number of dispatches a waiting lower priority lane can be skipped before it is served
+PRIORITY_STARVATION_LIMIT = APP_SETTINGS.get("PRIORITY_STARVATION_LIMIT", 10)
+
+# Number of seconds to wait before the first retry, doubled on every further retry
+RETRY_DELAY = APP_SETTINGS.get("RETRY_DELAY", 60)
+
+# Max number of seconds to wait between retries
+RETRY_MAX_DELAY = APP_SETTINGS.get("RETRY_MAX_DELAY", 3600)
+
+# Fraction of the retry delay added or removed at random
+RETRY_JITTER = APP_SETTINGS.get("RETRY_JITTER", 0.1)
+
+# Max number of messages loaded at once by the retry process
+RETRY_BATCH_SIZE = APP_SETTINGS.get("RETRY_BATCH_SIZE", 100)
+
+# Name of the django cache used to share the partner circuit breakers across processes
+CIRCUIT_BREAKER_CACHE = APP_SETTINGS.get("CIRCUIT_BREAKER_CACHE", RATE_LIMIT_CACHE)
+
+# Number of consecutive failed sends after which the circuit to a partner is opened
+CIRCUIT_BREAKER_THRESHOLD = APP_SETTINGS.get("CIRCUIT_BREAKER_THRESHOLD", 5)
+
+# Number of seconds the circuit stays open before a probe send is let through
+CIRCUIT_BREAKER_COOLDOWN = APP_SETTINGS.get("CIRCUIT_BREAKER_COOLDOWN", 60)
+
+# Max number of outbox files built and stored at once when sending in bulk
+SEND_BATCH_SIZE = APP_SETTINGS.get("SEND_BATCH_SIZE", 100)
+
+# Name of the django cache used to share the certificate chain validations across processes
+CERT_VALIDATION_CACHE = APP_SETTINGS.get("CERT_VALIDATION_CACHE", RATE_LIMIT_CACHE)
+
+# Max number of seconds a successful certificate chain validation is cached
+CERT_VALIDATION_CACHE_TTL = APP_SETTINGS.get("CERT_VALIDATION_CACHE_TTL", 86400)
+
+# Check a probabilistic filter of the archived messages before looking up duplicates in the database
+DUPLICATE_PREFILTER = APP_SETTINGS.get("DUPLICATE_PREFILTER", False)
+
+# Expected number of messages per day in the duplicate prefilter
+DUPLICATE_PREFILTER_CAPACITY = APP_SETTINGS.get("DUPLICATE_PREFILTER_CAPACITY", 100000)
+
+# Rate of duplicate checks that still query the database for messages that do not exist
+DUPLICATE_PREFILTER_ERROR_RATE = APP_SETTINGS.get(
+    "DUPLICATE_PREFILTER_ERROR_RATE", 0.001
+)
+
+# Number of seconds between loads of the messages saved by other processes into the prefilter
+DUPLICATE_PREFILTER_REFRESH = APP_SETTINGS.get("DUPLICATE_PREFILTER_REFRESH", 5)
+
+# Dotted path of the class exporting the trace spans, tracing is disabled when not set
+TRACING_EXPORTER = APP_SETTINGS.get("TRACING_EXPORTER")
+
+# File the JsonFileExporter appends the trace spans to
+TRACING_FILE = APP_SETTINGS.get(
+    "TRACING_FILE", os.path.join(DATA_DIR or "", "messages", "traces.jsonl")
+)
+
+# Share of the receives and sends that are profiled, profiling is disabled when 0
+PROFILING_SAMPLE_RATE = APP_SETTINGS.get("PROFILING_SAMPLE_RATE", 0)
+
+# Min number of seconds of a profiled receive or send for its profile to be stored
+PROFILING_THRESHOLD = APP_SETTINGS.get("PROFILING_THRESHOLD", 1)
+
+# Max number of bytes of stored profiles, the oldest profiles are deleted beyond it
+PROFILING_MAX_SIZE = APP_SETTINGS.get("PROFILING_MAX_SIZE", 100 * 1024 * 1024)
+
+# Number of messages resent at the same time by the bulk resend
+RESEND_WORKERS = APP_SETTINGS.get("RESEND_WORKERS", 4)
+
+# Interval of the partitions of the message and MDN tables on PostgreSQL, "day" or "month"
+PARTITION_INTERVAL = APP_SETTINGS.get("PARTITION_INTERVAL", "day")
+
+# Number of future partitions created ahead of the current one
+PARTITION_PREMAKE = APP_SETTINGS.get("PARTITION_PREMAKE", 3)
+
+# Max number of bytes of the payloads compressed into the database instead of the storage,
+# 0 disables it
+INLINE_PAYLOAD_MAX_SIZE = APP_SETTINGS.get("INLINE_PAYLOAD_MAX_SIZE", 8 * 1024)
+
+# Number of threads writing the payloads and inbox copies of messages to the storage at the
+# same time
+STORAGE_WRITE_WORKERS = APP_SETTINGS.get("STORAGE_WRITE_WORKERS", 4)
+
+# Dotted path of the backend running the background tasks
+TASK_BACKEND = APP_SETTINGS.get("TASK_BACKEND", "pyas2.tasks.InlineBackend")
+
+# Number of threads running the tasks of the thread pool backend
+TASK_WORKERS = APP_SETTINGS.get("TASK_WORKERS", 4)
+
+# Number of times a failed task of the database queue is run before it is marked as failed
+TASK_MAX_ATTEMPTS = APP_SETTINGS.get("TASK_MAX_ATTEMPTS", 3)
+
+# Number of seconds after which a task left running by a stopped worker is run again
+TASK_LOCK_TIMEOUT = APP_SETTINGS.get("TASK_LOCK_TIMEOUT", 600)
+
+# Number of seconds the task worker waits when the database queue is empty
+TASK_POLL_INTERVAL = APP_SETTINGS.get("TASK_POLL_INTERVAL", 1)
+
+# Max number of AS2 requests received at the same time by a process, further requests get a 503,
+# 0 disables it
+RECEIVE_MAX_IN_FLIGHT = APP_SETTINGS.get("RECEIVE_MAX_IN_FLIGHT", 0)
+
+# Max number of bytes of the AS2 requests received at the same time by a process, requests
+# without Content-Length get a 411, 0 disables it
+RECEIVE_MAX_IN_FLIGHT_BYTES = APP_SETTINGS.get("RECEIVE_MAX_IN_FLIGHT_BYTES", 0)
+
+# Number of seconds the partners are asked to wait before sending a refused request again
+RECEIVE_RETRY_AFTER = APP_SETTINGS.get("RECEIVE_RETRY_AFTER", 30)
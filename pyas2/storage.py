@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from pyas2 import settings
+
+logger = logging.getLogger("pyas2")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the thread pool shared by the storage writes of the process."""
+    global _executor  # pylint: disable=W0603
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.STORAGE_WRITE_WORKERS,
+                thread_name_prefix="pyas2-storage",
+            )
+        return _executor
+
+
+def run_writes(writes):
+    """Run the independent storage writes at the same time on the bounded
+    thread pool and wait for all of them to complete.
+
+    Each write is a pair of callables, the write itself and the cleanup that
+    undoes it when called with its result. When a write fails the completed
+    writes are cleaned up and the first error is raised, so that no partial
+    set of files is left behind. Returns the results of the writes.
+    """
+    if len(writes) <= 1 or settings.STORAGE_WRITE_WORKERS <= 1:
+        results = []
+        for write, _ in writes:
+            try:
+                results.append(write())
+            except BaseException:
+                _cleanup(zip(writes, results))
+                raise
+        return results
+
+    # Run each write in a copy of the context so that its spans are children
+    # of the current span
+    executor = get_executor()
+    futures = [
+        executor.submit(contextvars.copy_context().run, write) for write, _ in writes
+    ]
+    wait(futures)
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        _cleanup(
+            (write, future.result())
+            for write, future in zip(writes, futures)
+            if not future.exception()
+        )
+        raise errors[0]
+    return [future.result() for future in futures]
+
+
+def undo_writes(writes, results):
+    """Clean up the completed writes with their results, e.g. when the rows
+    referencing the written files could not be saved."""
+    _cleanup(zip(writes, results))
+
+
+def _cleanup(completed):
+    for (_, cleanup), result in completed:
+        try:
+            cleanup(result)
+        except Exception:  # pylint: disable=W0703
+            logger.exception("Failed to clean up a partial storage write.")
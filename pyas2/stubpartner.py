@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from pyas2lib import Message as As2Message
+from pyas2lib import Organization as As2Organization
+from pyas2lib import Partner as As2Partner
+
+logger = logging.getLogger("pyas2")
+
+# Size of the chunks read and written when the bandwidth is limited
+CHUNK_SIZE = 16 * 1024
+
+
+class StubPartnerHandler(BaseHTTPRequestHandler):
+    """Handle the AS2 messages posted to the stub partner."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint: disable=C0103
+        server = self.server
+        body = server.read(self.rfile, int(self.headers.get("Content-Length", 0)))
+        server.wait()
+
+        if random.random() < server.error_rate:
+            server.count("error")
+            self.respond(server.error_status, b"Stub partner error")
+            return
+
+        # Parse the message and build the MDN as a partner would
+        raw_headers = "".join(
+            f"{key}: {value}\r\n" for key, value in self.headers.items()
+        )
+        as2message = As2Message()
+        status, _, as2mdn = as2message.parse(
+            raw_headers.encode() + b"\r\n" + body,
+            find_org_cb=server.find_organization,
+            find_partner_cb=server.find_partner,
+        )
+        server.count(status)
+
+        if as2mdn and as2mdn.mdn_mode == "SYNC":
+            self.respond(200, as2mdn.content, as2mdn.headers)
+        else:
+            if as2mdn and as2mdn.mdn_mode == "ASYNC":
+                threading.Timer(server.mdn_delay, server.send_mdn, (as2mdn,)).start()
+            self.respond(200, b"AS2 message has been received")
+
+    def respond(self, status, content, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {"Content-Type": "text/plain"}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.server.write(self.wfile, content)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logger.debug(f"Stub partner {self.address_string()}: {format % args}")
+
+
+class StubPartnerServer(ThreadingHTTPServer):
+    """HTTP server acting as an AS2 partner, it parses the posted messages and
+    answers with synchronous MDNs or returns asynchronous MDNs without storing
+    anything.
+
+    The partner signs the MDNs and decrypts the messages with the ``key`` and
+    verifies the signatures of the messages with the ``cert``, when set. It
+    can add ``latency`` seconds with up to ``jitter`` more seconds to each
+    request, fail a share ``error_rate`` of the requests with
+    ``error_status``, limit the transfer of each request to ``bandwidth``
+    bytes per second and wait ``mdn_delay`` seconds before returning an
+    asynchronous MDN.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        server_address,
+        key=None,
+        key_pass=None,
+        cert=None,
+        latency=0,
+        jitter=0,
+        error_rate=0,
+        error_status=500,
+        bandwidth=0,
+        mdn_delay=0,
+    ):
+        super().__init__(server_address, StubPartnerHandler)
+        self.key = key
+        self.key_pass = key_pass
+        self.cert = cert
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.bandwidth = bandwidth
+        self.mdn_delay = mdn_delay
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/pyas2/as2receive"
+
+    def find_organization(self, as2_name):
+        return As2Organization(
+            as2_name=as2_name,
+            sign_key=self.key,
+            sign_key_pass=self.key_pass,
+            decrypt_key=self.key,
+            decrypt_key_pass=self.key_pass,
+        )
+
+    def find_partner(self, as2_name):
+        return As2Partner(
+            as2_name=as2_name, verify_cert=self.cert, validate_certs=False
+        )
+
+    def count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    def wait(self):
+        """Add the artificial latency to the request."""
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self, rfile, length):
+        """Read the request body within the bandwidth limit."""
+        if not self.bandwidth:
+            return rfile.read(length)
+        chunks = []
+        while length > 0:
+            chunk = rfile.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+            time.sleep(len(chunk) / self.bandwidth)
+        return b"".join(chunks)
+
+    def write(self, wfile, content):
+        """Write the response body within the bandwidth limit."""
+        if not self.bandwidth:
+            wfile.write(content)
+            return
+        for start in range(0, len(content), CHUNK_SIZE):
+            chunk = content[start : start + CHUNK_SIZE]
+            wfile.write(chunk)
+            time.sleep(len(chunk) / self.bandwidth)
+
+    def send_mdn(self, as2mdn):
+        """Return the asynchronous MDN to the URL requested by the sender."""
+        try:
+            response = requests.post(
+                as2mdn.mdn_url, headers=as2mdn.headers, data=as2mdn.content
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Stub partner failed to return the MDN: {e}")
+            self.count("mdn failed")
+        else:
+            self.count("mdn returned")
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Background execution of the AS2 work that does not need to block the web
+request or the command handing it off.
+
+The work is split in tasks registered by name with the ``task`` decorator,
+their arguments are JSON serializable so that any backend can store or
+transport them. The ``TASK_BACKEND`` setting selects the backend running the
+tasks:
+
+* ``pyas2.tasks.InlineBackend`` runs the tasks at once in the calling thread,
+  which is the default and the behavior of the previous versions.
+* ``pyas2.tasks.ThreadPoolBackend`` runs the tasks on a pool of
+  ``TASK_WORKERS`` threads of the process.
+* ``pyas2.tasks.DatabaseBackend`` queues the tasks in a database table that
+  is processed by the ``as2taskworker`` command.
+
+The backends of external brokers subclass ``TaskBackend`` and implement
+``enqueue(name, arguments)``, their workers call ``run_task``.
+"""
+import functools
+import json
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core import management
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from pyas2 import settings
+from pyas2.models import Mdn, Message, Task
+from pyas2.utils import run_post_receive, run_post_send
+
+logger = logging.getLogger("pyas2")
+
+# Number of seconds before a failed task of the database queue is run again
+RETRY_DELAY = 60
+
+TASKS = {}
+
+
+def task(func):
+    """Register the function as a task under its name."""
+    TASKS[func.__name__] = func
+    return func
+
+
+def run_task(name, arguments):
+    """Run the task with the arguments, called by the backends and the workers
+    of external brokers."""
+    logger.debug(f'Running task "{name}" with arguments {arguments}.')
+    return TASKS[name](**arguments)
+
+
+class TaskBackend:
+    """Interface of the task backends set with the ``TASK_BACKEND``
+    setting."""
+
+    # Whether the tasks are done once they are enqueued
+    runs_inline = False
+    # Whether the tasks are enqueued in the transaction of the caller, the
+    # other backends are handed the tasks once the transaction is committed
+    transactional = False
+
+    def enqueue(self, name, arguments):
+        """Run the task with the arguments, now or later."""
+        raise NotImplementedError
+
+
+class InlineBackend(TaskBackend):
+    """Run the tasks at once in the calling thread."""
+
+    runs_inline = True
+
+    def enqueue(self, name, arguments):
+        run_task(name, arguments)
+
+
+class ThreadPoolBackend(TaskBackend):
+    """Run the tasks on a pool of ``TASK_WORKERS`` threads of the process, the
+    queued tasks are lost when the process stops."""
+
+    def __init__(self, workers=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or settings.TASK_WORKERS,
+            thread_name_prefix="pyas2-task",
+        )
+
+    @staticmethod
+    def run(name, arguments):
+        try:
+            run_task(name, arguments)
+        except Exception:  # pylint: disable=W0703
+            logger.exception(f'Task "{name}" failed.')
+        finally:
+            connections.close_all()
+
+    def enqueue(self, name, arguments):
+        self.executor.submit(self.run, name, arguments)
+
+
+class DatabaseBackend(TaskBackend):
+    """Queue the tasks in the database, they are run by the ``as2taskworker``
+    command and survive restarts."""
+
+    transactional = True
+
+    def enqueue(self, name, arguments):
+        Task.objects.create(name=name, arguments=json.dumps(arguments))
+
+    @staticmethod
+    def claim():
+        """Claim the next due task of the queue, returns None when the queue
+        is empty. The tasks left running by a stopped worker for more than
+        ``TASK_LOCK_TIMEOUT`` seconds are claimed again, each claim counts as
+        an attempt."""
+        now = timezone.now()
+        stale = now - timedelta(seconds=settings.TASK_LOCK_TIMEOUT)
+        while True:
+            pending = (
+                Task.objects.filter(status="Q", run_after__lte=now)
+                | Task.objects.filter(status="R", started_at__lt=stale)
+            ).order_by("run_after")
+            queued = pending.values_list("pk", "status", "started_at").first()
+            if queued is None:
+                return None
+            # Only one worker updates the task from the status and start time
+            # it read, the start time tells apart the claims of a stale task
+            pk, status, started_at = queued
+            if not Task.objects.filter(
+                pk=pk, status=status, started_at=started_at
+            ).update(status="R", started_at=now, attempts=F("attempts") + 1):
+                continue
+            claimed = Task.objects.get(pk=pk)
+            if claimed.attempts <= settings.TASK_MAX_ATTEMPTS:
+                return claimed
+            # The task stopped the workers running it every time, do not let
+            # it stop the next ones
+            claimed.status = "E"
+            claimed.error = (
+                f"The task was interrupted {claimed.attempts - 1} times, "
+                "its worker stopped while running it."
+            )
+            claimed.save()
+
+    @staticmethod
+    def process(queued_task):
+        """Run the claimed task and delete it, a failed task is run again
+        until it has been attempted ``TASK_MAX_ATTEMPTS`` times."""
+        try:
+            run_task(queued_task.name, json.loads(queued_task.arguments))
+        except Exception:  # pylint: disable=W0703
+            logger.exception(f'Task "{queued_task.name}" failed.')
+            queued_task.error = traceback.format_exc()
+            if queued_task.attempts < settings.TASK_MAX_ATTEMPTS:
+                queued_task.status = "Q"
+                queued_task.run_after = timezone.now() + timedelta(seconds=RETRY_DELAY)
+            else:
+                queued_task.status = "E"
+            queued_task.save()
+            return False
+        queued_task.delete()
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend():
+    """Return the backend set with the ``TASK_BACKEND`` setting."""
+    return import_string(settings.TASK_BACKEND)()
+
+
+def enqueue(name, **arguments):
+    """Hand the task off to the backend. Unless the backend runs the tasks
+    inline or queues them in the same transaction, this waits for the current
+    transaction to be committed so that the task finds the rows written by
+    the caller."""
+    backend = get_backend()
+    if backend.runs_inline or backend.transactional:
+        backend.enqueue(name, arguments)
+    else:
+        transaction.on_commit(functools.partial(backend.enqueue, name, arguments))
+
+
+def dispatch_send(message, headers, body):
+    """Send the outbound message with the task backend, the message is sent
+    later from the envelope kept for its retries unless the backend runs the
+    tasks inline. Returns True if the message was sent inline."""
+    if get_backend().runs_inline:
+        message.send_message(headers, body)
+        return True
+    message.store_envelope(headers, body)
+    message.save()
+    message.save_timings()
+    enqueue("send_message", message_id=message.pk)
+    return False
+
+
+@task
+def send_message(message_id):
+    """Send the pending outbound message from its envelope."""
+    message = Message.objects.select_related("organization", "partner").get(
+        pk=message_id
+    )
+    envelope = message.load_envelope()
+    # Claim the message as the send of an earlier run of the task may be
+    # waiting for its asynchronous MDN, it is retried if the send is interrupted
+    retry_at = timezone.now() + message.partner.get_retry_delay(message.retries or 0)
+    if envelope is None or not Message.objects.filter(
+        pk=message.pk, status="P", timings__sent_at__isnull=True
+    ).update(status="R", next_attempt_at=retry_at):
+        logger.info(f"Message {message.message_id} has already been sent.")
+        return
+    message.status = "R"
+    message.next_attempt_at = retry_at
+    message.send_message(*envelope)
+
+
+@task
+def send_async_mdn(mdn_id):
+    """Send the pending asynchronous MDN to the partner."""
+    mdn = Mdn.objects.select_related("message__partner").get(pk=mdn_id)
+    if not mdn.send_async_mdn():
+        raise RuntimeError(f"Failed to send MDN {mdn.mdn_id}.")
+
+
+@task
+def resend_messages(message_ids):
+    """Resend the outbound messages concurrently."""
+    # The sender hands its sends off to the tasks, import it when needed
+    from pyas2.sender import BulkResender  # pylint: disable=C0415
+
+    messages = Message.objects.filter(pk__in=message_ids).order_by("timestamp")
+    sent, failed = BulkResender().run(messages)
+    # The failed messages are not resent again with the task, they are
+    # retried like any other failed send
+    logger.info(f"Resent {sent} messages, {failed} failed.")
+
+
+@task
+def post_receive(message_id, full_filename):
+    """Run the post receive command of the partner."""
+    message = Message.objects.select_related("organization", "partner").get(
+        pk=message_id
+    )
+    run_post_receive(message, full_filename)
+
+
+@task
+def post_send(message_id):
+    """Run the post send command of the partner."""
+    message = Message.objects.select_related("organization", "partner").get(
+        pk=message_id
+    )
+    run_post_send(message)
+
+
+@task
+def compact_store(keep_days=1):
+    """Pack the closed day folders of the store."""
+    management.call_command("compactas2store", keep_days=keep_days)
+
+
+@task
+def clean_archive(by_day=False):
+    """Delete the messages and files older than ``MAX_ARCH_DAYS``."""
+    management.call_command("manageas2server", clean=True, by_day=by_day)
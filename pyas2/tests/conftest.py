@@ -1,6 +1,32 @@
 """Define the test fixtures and other configurations for the test cases."""
+import os
+import threading
+
 import pytest
+from django.core.cache import cache
+from django.test import override_settings
 from pyas2.models import Organization, Partner
+from pyas2.stubpartner import StubPartnerServer
+
+
+@pytest.fixture(scope="session", autouse=True)
+def media_root(tmp_path_factory):
+    """Write the messages and files of the test cases to a temporary folder,
+    which is also the working directory of the relative paths of the tests."""
+    media_root = str(tmp_path_factory.mktemp("media"))
+    cwd = os.getcwd()
+    os.chdir(media_root)
+    try:
+        with override_settings(MEDIA_ROOT=media_root):
+            yield media_root
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Reset the rate limits and circuit breakers shared through the cache."""
+    cache.clear()
 
 
 @pytest.fixture
@@ -24,3 +50,14 @@ def partner():
         compress=False,
         mdn=False,
     )
+
+
+@pytest.fixture
+def stub_partner():
+    """Run a stub AS2 partner on a free local port."""
+    server = StubPartnerServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
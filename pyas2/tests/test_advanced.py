@@ -1,19 +1,62 @@
 import importlib
+import json
 import os
+import pstats
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
 from unittest import mock
 
+import pytest
+from django.conf import settings as django_settings
+from django.core import management
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.http import HttpResponse
 from django.test import Client, override_settings
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
 from pyas2lib import Message as As2Message
 from pyas2lib import Mdn as As2Mdn
+from pyas2lib import Organization as As2Organization
+from pyas2lib import Partner as As2Partner
+from requests.exceptions import RequestException
 
 from pyas2 import settings
+from pyas2.admin import MessageAdmin
+from pyas2.breaker import CircuitBreaker
+from pyas2.certificates import validate_certificate_chain
+from pyas2.lanes import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, PriorityLanes
 from pyas2.models import Message
+from pyas2.models import MessageTimings
 from pyas2.models import Mdn
 from pyas2.models import Organization
 from pyas2.models import Partner
 from pyas2.models import PrivateKey
 from pyas2.models import PublicCertificate
+from pyas2.models import Task
+from pyas2.prefilter import BloomFilter, MessagePrefilter
+from pyas2.ratelimit import PartnerThrottle, RateLimitExceeded, receive_admission
+from pyas2.sender import BatchSender, BulkResender
+from pyas2.storage import run_writes
+from pyas2.tasks import (
+    TASKS,
+    DatabaseBackend,
+    ThreadPoolBackend,
+    dispatch_send,
+    enqueue,
+    get_backend,
+    run_task,
+)
+from pyas2.tracing import (
+    get_exporter,
+    message_span_id,
+    message_trace_id,
+    start_span,
+)
 from pyas2.tests.test_basic import SendMessageMock
 from pyas2.tests import TEST_DIR
 
@@ -83,10 +126,8 @@ class AdvancedTestCases(TestCase):
             if os.path.isfile(file_path):
                 os.unlink(file_path)
         for message in Message.objects.all():
-            message.headers.delete()
             message.payload.delete()
         for mdn in Mdn.objects.all():
-            mdn.headers.delete()
             mdn.payload.delete()
 
     def test_post_send_command(self):
@@ -106,13 +147,15 @@ class AdvancedTestCases(TestCase):
             mdn=True,
             mdn_mode="SYNC",
             mdn_sign="sha1",
-            cmd_send="touch %s/$messageid.sent" % TEST_DIR,
+            cmd_send="touch %s/$messageid.sent" % django_settings.MEDIA_ROOT,
         )
         in_message = self.build_and_send(partner)
         self.assertEqual(in_message.status, "S")
 
         # Check that the command got executed
-        touch_file = os.path.join(TEST_DIR, "%s.sent" % in_message.message_id)
+        touch_file = os.path.join(
+            django_settings.MEDIA_ROOT, "%s.sent" % in_message.message_id
+        )
         self.assertTrue(os.path.exists(touch_file))
         os.remove(touch_file)
 
@@ -132,7 +175,7 @@ class AdvancedTestCases(TestCase):
             mdn=True,
             mdn_mode="ASYNC",
             mdn_sign="sha1",
-            cmd_send="touch %s/$messageid.sent" % TEST_DIR,
+            cmd_send="touch %s/$messageid.sent" % django_settings.MEDIA_ROOT,
         )
         in_message = self.build_and_send(partner)
 
@@ -148,7 +191,9 @@ class AdvancedTestCases(TestCase):
         self.assertEqual(in_message.status, "S")
 
         # Check that the command got executed
-        touch_file = os.path.join(TEST_DIR, "%s.sent" % in_message.message_id)
+        touch_file = os.path.join(
+            django_settings.MEDIA_ROOT, "%s.sent" % in_message.message_id
+        )
         self.assertTrue(os.path.exists(touch_file))
         os.remove(touch_file)
 
@@ -156,7 +201,9 @@ class AdvancedTestCases(TestCase):
         """Test that the command after successful receive gets executed."""
         # settings.DATA_DIR = TEST_DIR
         # add the post receive command and save it
-        self.partner.cmd_receive = "touch %s/$filename.received" % TEST_DIR
+        self.partner.cmd_receive = (
+            "touch %s/$filename.received" % django_settings.MEDIA_ROOT
+        )
         self.partner.save()
 
         # Create the client partner and send the command
@@ -177,7 +224,8 @@ class AdvancedTestCases(TestCase):
 
         # Check that the command got executed
         touch_file = os.path.join(
-            TEST_DIR, "%s.msg.received" % in_message.message_id.replace("@", "")
+            django_settings.MEDIA_ROOT,
+            "%s.msg.received" % in_message.message_id.replace("@", ""),
         )
         self.assertTrue(os.path.exists(touch_file))
         os.remove(touch_file)
@@ -188,7 +236,9 @@ class AdvancedTestCases(TestCase):
         """Test using the filename of the payload received while saving the file."""
 
         # add the post receive command and save it
-        self.partner.cmd_receive = "touch %s/$filename.received" % TEST_DIR
+        self.partner.cmd_receive = (
+            "touch %s/$filename.received" % django_settings.MEDIA_ROOT
+        )
         self.partner.keep_filename = True
         self.partner.save()
 
@@ -209,7 +259,9 @@ class AdvancedTestCases(TestCase):
         self.assertEqual(in_message.status, "S")
 
         # Check that the command got executed
-        touch_file = os.path.join(TEST_DIR, "testmessage.edi.received")
+        touch_file = os.path.join(
+            django_settings.MEDIA_ROOT, "testmessage.edi.received"
+        )
         self.assertTrue(os.path.exists(touch_file))
         os.remove(touch_file)
 
@@ -217,7 +269,9 @@ class AdvancedTestCases(TestCase):
         """Test using the sender and receiver as2 name while the payload received."""
 
         # add the post receive command and save it
-        self.partner.cmd_receive = "touch %s/$sender.to.$receiver" % TEST_DIR
+        self.partner.cmd_receive = (
+            "touch %s/$sender.to.$receiver" % django_settings.MEDIA_ROOT
+        )
         self.partner.keep_filename = True
         self.partner.save()
 
@@ -239,7 +293,8 @@ class AdvancedTestCases(TestCase):
 
         # Check that the command got executed
         touch_file = os.path.join(
-            TEST_DIR, "%s.to.%s" % (self.organization.as2_name, partner.as2_name)
+            django_settings.MEDIA_ROOT,
+            "%s.to.%s" % (self.organization.as2_name, partner.as2_name),
         )
         self.assertTrue(os.path.exists(touch_file))
         os.remove(touch_file)
@@ -293,6 +348,58 @@ class AdvancedTestCases(TestCase):
         )
         self.assertEqual(out_message.status, "E")
 
+    @mock.patch("requests.post")
+    def test_duplicate_missed_by_check(self, mock_request):
+        """Test that a duplicate missed by the check before the parsing, e.g.
+        received by another process meanwhile, keeps the original message."""
+        partner = Partner.objects.create(
+            name="AS2 Server",
+            as2_name="as2server",
+            target_url="http://localhost:8080/pyas2/as2receive",
+            signature="sha1",
+            signature_cert=self.server_crt,
+            encryption="tripledes_192_cbc",
+            encryption_cert=self.server_crt,
+            mdn=True,
+            mdn_mode="SYNC",
+            mdn_sign="sha1",
+        )
+        as2message = As2Message(
+            sender=self.organization.as2org, receiver=partner.as2partner
+        )
+        as2message.build(
+            self.payload,
+            filename="testmessage.edi",
+            subject=partner.subject,
+            content_type=partner.content_type,
+        )
+        in_message, _ = Message.objects.create_from_as2message(
+            as2message=as2message, payload=self.payload, direction="OUT", status="P"
+        )
+        mock_request.side_effect = SendMessageMock(self.client)
+        in_message.send_message(as2message.headers, as2message.content)
+        original = Message.objects.get(message_id=in_message.message_id, direction="IN")
+
+        with mock.patch.object(
+            Message.objects, "message_exists", return_value=False
+        ), mock.patch("pyas2.views.tasks.enqueue") as mocked_enqueue:
+            in_message.send_message(as2message.headers, as2message.content)
+            mocked_enqueue.assert_not_called()
+
+        # The original message is kept and the duplicate is answered as such
+        self.assertEqual(in_message.status, "E")
+        self.assertEqual(
+            Message.objects.get(pk=original.pk).timestamp, original.timestamp
+        )
+        self.assertEqual(
+            Message.objects.get(pk=original.pk).detailed_status,
+            original.detailed_status,
+        )
+        out_message = Message.objects.get(
+            message_id=in_message.message_id + "_duplicate", direction="IN"
+        )
+        self.assertEqual(out_message.status, "E")
+
     def test_org_missing_error(self):
         # Create the client partner and send the command
         partner = Partner.objects.create(
@@ -507,5 +614,807 @@ class AdvancedTestCases(TestCase):
 def test_setting_data_directory():
     """Test that the data directory gets set correctly."""
     assert settings.DATA_DIR is None
-    importlib.reload(settings)
-    assert settings.DATA_DIR is TEST_DIR
+    try:
+        importlib.reload(settings)
+        assert settings.DATA_DIR is TEST_DIR
+    finally:
+        with override_settings(PYAS2={}):
+            importlib.reload(settings)
+
+
+@pytest.mark.django_db
+def test_partner_rate_limits(mocker, caplog, partner):
+    """Test that the message rate and in-flight limits of the partner are enforced."""
+    mocker.patch.object(PartnerThrottle, "warned_local_cache", False)
+    partner.rate_limit_msgs = 1
+    throttle = PartnerThrottle(partner)
+    with throttle.acquire(100, max_wait=0):
+        pass
+    assert "local memory cache" in caplog.text
+    with pytest.raises(RateLimitExceeded):
+        with throttle.acquire(100, max_wait=0):
+            pass
+
+    throttle.cache.clear()
+    partner.rate_limit_msgs = None
+    partner.max_in_flight = 1
+    with throttle.acquire(100, max_wait=0):
+        with pytest.raises(RateLimitExceeded):
+            with throttle.acquire(100, max_wait=0):
+                pass
+    with throttle.acquire(100, max_wait=0):
+        pass
+
+    # A waiting send is admitted soon after the in-flight slot is freed
+    holding = threading.Event()
+
+    def hold_slot():
+        with throttle.acquire(100, max_wait=0):
+            holding.set()
+            time.sleep(0.2)
+
+    holder = threading.Thread(target=hold_slot)
+    holder.start()
+    holding.wait()
+    started = time.monotonic()
+    with throttle.acquire(100, max_wait=5):
+        pass
+    assert time.monotonic() - started < 1
+    holder.join()
+
+
+@pytest.mark.django_db
+def test_send_message_rate_limited(mocker, organization, partner):
+    """Test that a message is marked for retry when the partner is throttled."""
+    mocked_post = mocker.patch("requests.post")
+    mocker.patch("pyas2.settings.RATE_LIMIT_MAX_WAIT", 0)
+    partner.rate_limit_bytes = 10
+    partner.save()
+
+    message = Message.objects.create(
+        message_id="some-message-id",
+        direction="OUT",
+        status="P",
+        organization=organization,
+        partner=partner,
+    )
+    message.send_message({}, b"x" * 100)
+    message.send_message({}, b"x" * 100)
+    message.refresh_from_db()
+    assert mocked_post.call_count == 1
+    assert message.status == "R"
+    assert "Rate limit" in message.detailed_status
+
+
+def test_priority_lanes():
+    """Test that higher priority lanes are served first without starving the rest."""
+    lanes = PriorityLanes(starvation_limit=2)
+    for i in range(4):
+        lanes.push(PRIORITY_HIGH, f"high-{i}")
+    lanes.push(PRIORITY_LOW, "low-0")
+    lanes.push(PRIORITY_NORMAL, "normal-0")
+
+    assert len(lanes) == 6
+    assert list(lanes) == [
+        "high-0",
+        "high-1",
+        "normal-0",
+        "low-0",
+        "high-2",
+        "high-3",
+    ]
+    with pytest.raises(IndexError):
+        lanes.pop()
+
+
+@pytest.mark.django_db
+def test_circuit_breaker(mocker, organization, partner):
+    """Test that sends are short-circuited once the partner keeps failing."""
+    mocker.patch("pyas2.settings.CIRCUIT_BREAKER_THRESHOLD", 2)
+    mocked_post = mocker.patch(
+        "requests.post", side_effect=RequestException("Connection refused")
+    )
+    message = Message.objects.create(
+        message_id="some-message-id",
+        direction="OUT",
+        status="P",
+        organization=organization,
+        partner=partner,
+    )
+    breaker = CircuitBreaker(partner)
+    message.send_message({}, b"payload")
+    assert breaker.state == CircuitBreaker.CLOSED
+    message.send_message({}, b"payload")
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # Sends are not attempted while the circuit is open
+    message.send_message({}, b"payload")
+    assert mocked_post.call_count == 2
+    assert message.status == "R"
+    assert "Circuit" in message.detailed_status
+
+    # Retries are postponed without being counted while the circuit is open
+    message.retries = 1
+    message.next_attempt_at = timezone.now()
+    message.save()
+    management.call_command("manageas2server", retry=True, stdout=StringIO())
+    message.refresh_from_db()
+    assert mocked_post.call_count == 2
+    assert message.retries == 1
+    assert message.status == "R"
+    assert message.next_attempt_at > timezone.now()
+
+    # A successful probe closes the circuit once the cooldown has passed
+    mocker.patch("pyas2.settings.CIRCUIT_BREAKER_COOLDOWN", 0)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    mocked_post.side_effect = None
+    message.send_message({}, b"payload")
+    assert mocked_post.call_count == 3
+    assert message.status == "S"
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("bulk_insert", [True, False])
+def test_batch_sender(mocker, organization, partner, bulk_insert):
+    """Test sending files in batches with and without bulk inserts."""
+    mocker.patch.object(
+        type(connection.features),
+        "can_return_rows_from_bulk_insert",
+        new_callable=mock.PropertyMock,
+        return_value=bulk_insert,
+    )
+    mocked_send_message = mocker.patch("pyas2.models.Message.send_message")
+    mocked_as2partner = mocker.patch.object(
+        Partner,
+        "as2partner",
+        new_callable=mock.PropertyMock,
+        return_value=partner.as2partner,
+    )
+    paths = []
+    for i in range(3):
+        path = os.path.join(django_settings.MEDIA_ROOT, f"batch_{i}.edi")
+        with open(path, "wb") as fp:
+            fp.write(f"payload {i}".encode())
+        paths.append(path)
+
+    sender = BatchSender(organization, partner, batch_size=2)
+    messages = sender.send(paths + ["missing.edi"], priority=PRIORITY_LOW)
+    assert len(messages) == 3
+    assert all(message.pk for message in messages)
+    assert mocked_send_message.call_count == 3
+    assert mocked_as2partner.call_count == 1
+    assert Message.objects.filter(priority=PRIORITY_LOW).count() == 3
+    assert messages[2].payload.read() == b"payload 2"
+    assert not any(os.path.exists(path) for path in paths)
+
+    # The messages of a failed batch that were not sent are removed and their
+    # files are left in the outbox
+    Message.objects.all().delete()
+    for i, path in enumerate(paths):
+        with open(path, "wb") as fp:
+            fp.write(f"payload {i}".encode())
+    mocked_send_message.side_effect = [None, Exception("Send failed")]
+    with pytest.raises(Exception, match="Send failed"):
+        BatchSender(organization, partner, batch_size=3).send(paths)
+    assert list(Message.objects.order_by("pk").values_list("status", flat=True)) == [
+        "P",
+        "E",
+    ]
+    assert [os.path.exists(path) for path in paths] == [False, True, True]
+
+
+@pytest.mark.django_db
+def test_certificate_validation_cache(mocker):
+    """Test that the certificate chain validations are cached until the
+    certificate is saved again or expires."""
+    mocked_verify = mocker.patch(
+        "pyas2.certificates.verify_certificate_chain", return_value=True
+    )
+    cache_set = mocker.spy(caches[settings.CERT_VALIDATION_CACHE], "set")
+    mocker.patch("pyas2.settings.CERT_VALIDATION_CACHE_TTL", 10**10)
+    with open(os.path.join(TEST_DIR, "client_public.pem"), "rb") as fp:
+        cert = PublicCertificate.objects.create(name="cert", certificate=fp.read())
+
+    validate_certificate_chain(cert.certificate, cert.certificate_ca)
+    validate_certificate_chain(cert.certificate, cert.certificate_ca)
+    assert mocked_verify.call_count == 1
+    remaining = (cert.valid_to - timezone.now()).total_seconds()
+    assert 0 < cache_set.call_args.kwargs["timeout"] <= remaining
+
+    # The partner uses the cached validation when loading the certificate
+    partner = Partner.objects.create(
+        name="partner",
+        as2_name="partner",
+        target_url="http://localhost:8080/pyas2/as2receive",
+        encryption="tripledes_192_cbc",
+        encryption_cert=cert,
+    )
+    partner.as2partner.load_encrypt_cert()
+    assert mocked_verify.call_count == 1
+
+    # Validations that reject self signed certificates are cached apart
+    validate_certificate_chain(
+        cert.certificate, cert.certificate_ca, ignore_self_signed=False
+    )
+    assert mocked_verify.call_count == 2
+    assert mocked_verify.call_args.kwargs["ignore_self_signed"] is False
+
+    # Saving the certificate drops the cached validations
+    cert.save()
+    validate_certificate_chain(cert.certificate, cert.certificate_ca)
+    validate_certificate_chain(
+        cert.certificate, cert.certificate_ca, ignore_self_signed=False
+    )
+    assert mocked_verify.call_count == 4
+
+    # The validations are not cached beyond the expiry of the CA bundle
+    with open(os.path.join(TEST_DIR, "server_public.pem"), "rb") as fp:
+        server_cert = fp.read()
+    validate_certificate_chain(server_cert, cert.certificate)
+    remaining = (cert.valid_to - timezone.now()).total_seconds()
+    assert 0 < cache_set.call_args.kwargs["timeout"] <= remaining
+
+
+def test_bloom_filter():
+    """Test that the bloom filter finds all added keys with few false positives."""
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(f"message-{i}")
+    assert all(f"message-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+@pytest.mark.django_db
+def test_duplicate_prefilter(mocker, organization, partner, django_assert_num_queries):
+    """Test that the duplicate check only queries the database when the
+    prefilter cannot rule out the message."""
+    mocker.patch("pyas2.settings.DUPLICATE_PREFILTER", True)
+    mocker.patch("pyas2.settings.DUPLICATE_PREFILTER_REFRESH", 3600)
+    Message.objects.create(
+        message_id="existing-id", partner=partner, direction="IN", status="S"
+    )
+    prefilter = MessagePrefilter(Message)
+    mocker.patch.object(Message.objects, "prefilter", prefilter)
+
+    # The prefilter is loaded from the database on first use
+    with django_assert_num_queries(2):
+        assert Message.objects.message_exists("existing-id", partner.as2_name)
+    with django_assert_num_queries(0):
+        assert not Message.objects.message_exists("new-id", partner.as2_name)
+
+    # Messages saved by this process are added right away
+    Message.objects.create(
+        message_id="new-id", partner=partner, direction="IN", status="S"
+    )
+    with django_assert_num_queries(1):
+        assert Message.objects.message_exists("new-id", partner.as2_name)
+
+    # Messages saved by other processes are picked up by the next refresh
+    Message.objects.bulk_create(
+        [Message(message_id="other-id", partner=partner, direction="IN", status="S")]
+    )
+    assert not prefilter.might_contain("other-id", partner.as2_name)
+    prefilter.refresh()
+    assert prefilter.might_contain("other-id", partner.as2_name)
+
+
+@pytest.fixture
+def trace_file(mocker, tmp_path):
+    """Export the trace spans to a temporary file."""
+    mocker.patch("pyas2.settings.TRACING_EXPORTER", "pyas2.tracing.JsonFileExporter")
+    mocker.patch("pyas2.settings.TRACING_FILE", str(tmp_path / "traces.jsonl"))
+    get_exporter.cache_clear()
+    yield tmp_path / "traces.jsonl"
+    get_exporter.cache_clear()
+
+
+def read_spans(trace_file):
+    with open(trace_file) as fp:
+        return [json.loads(line) for line in fp]
+
+
+@pytest.mark.django_db
+def test_tracing_receive(organization, partner, trace_file):
+    """Test that the phases of a received message are traced."""
+    as2message = As2Message(
+        sender=As2Organization(as2_name=partner.as2_name),
+        receiver=As2Partner(as2_name=organization.as2_name, compress=False),
+    )
+    as2message.build(b"test data", filename="testmessage.edi")
+    content_type = as2message.headers.pop("Content-Type")
+    http_headers = {
+        "HTTP_%s" % key.replace("-", "_").upper(): value
+        for key, value in as2message.headers.items()
+    }
+    response = Client().post(
+        "/pyas2/as2receive",
+        data=as2message.content,
+        content_type=content_type,
+        **http_headers,
+    )
+    assert response.status_code == 200
+
+    spans = {span["name"]: span for span in read_spans(trace_file)}
+    assert list(spans) == [
+        "as2.headers.extract",
+        "as2.mdn.parse",
+        "as2.message.parse",
+        "as2.store.inbox",
+        "as2.store",
+        "as2.post_receive",
+        "as2.receive",
+    ]
+    root = spans.pop("as2.receive")
+    assert root["kind"] == "SPAN_KIND_SERVER"
+    assert root["traceId"] == message_trace_id(as2message.message_id)
+    assert root["spanId"] == message_span_id(as2message.message_id)
+    assert root["parentSpanId"] == ""
+    # The inbox copy is written on the storage pool along with the payload
+    inbox = spans.pop("as2.store.inbox")
+    assert inbox["traceId"] == root["traceId"]
+    assert inbox["parentSpanId"] == spans["as2.store"]["spanId"]
+    for span in spans.values():
+        assert span["traceId"] == root["traceId"]
+        assert span["parentSpanId"] == root["spanId"]
+
+
+@pytest.mark.django_db
+def test_tracing_send(mocker, organization, partner, trace_file):
+    """Test that the retries of a message are traced as children of its
+    first send."""
+    mocker.patch("requests.post", side_effect=RequestException("Refused"))
+    message = Message.objects.create(
+        message_id="some-message-id",
+        direction="OUT",
+        status="P",
+        organization=organization,
+        partner=partner,
+    )
+    message.send_message({}, b"payload")
+    message.retries = 1
+    message.send_message({}, b"payload")
+
+    spans = read_spans(trace_file)
+    first_send, retry_send = [span for span in spans if span["name"] == "as2.send"]
+    http_request = next(span for span in spans if span["name"] == "http.request")
+    assert first_send["spanId"] == message_span_id("some-message-id")
+    assert http_request["parentSpanId"] == first_send["spanId"]
+    assert http_request["status"]["code"] == "STATUS_CODE_ERROR"
+    assert retry_send["parentSpanId"] == first_send["spanId"]
+    assert retry_send["traceId"] == first_send["traceId"]
+
+
+def test_tracing_buffer(mocker, trace_file):
+    """Test that the spans are only kept when tracing is enabled and that the
+    spans of a long running operation are exported in batches."""
+    mocker.patch("pyas2.tracing.MAX_BUFFERED_SPANS", 3)
+    with start_span("as2.watch") as root:
+        for _ in range(4):
+            with start_span("as2.send"):
+                pass
+        assert len(read_spans(trace_file)) == 3
+        assert len(root.finished) == 1
+    assert len(read_spans(trace_file)) == 5
+    assert root.finished == []
+
+    # Without an exporter the spans are timed but not kept
+    mocker.patch("pyas2.settings.TRACING_EXPORTER", None)
+    get_exporter.cache_clear()
+    with start_span("as2.watch") as root:
+        with start_span("as2.send") as span:
+            pass
+        assert root.finished == []
+    assert span.duration > 0
+
+
+@pytest.mark.django_db
+def test_message_timings(mocker, admin_client, organization, partner):
+    """Test that the phase timings of messages are stored and sortable in the
+    admin."""
+    as2message = As2Message(
+        sender=As2Organization(as2_name=partner.as2_name),
+        receiver=As2Partner(as2_name=organization.as2_name, compress=False),
+    )
+    as2message.build(b"test data", filename="testmessage.edi")
+    content_type = as2message.headers.pop("Content-Type")
+    http_headers = {
+        "HTTP_%s" % key.replace("-", "_").upper(): value
+        for key, value in as2message.headers.items()
+    }
+    response = Client().post(
+        "/pyas2/as2receive",
+        data=as2message.content,
+        content_type=content_type,
+        **http_headers,
+    )
+    assert response.status_code == 200
+    received = Message.objects.get(message_id=as2message.message_id)
+    for phase in ["parse", "crypto", "storage", "hooks"]:
+        assert getattr(received.timings, f"{phase}_ms") is not None
+    assert received.timings.http_ms is None
+    assert received.timings.sent_at is None
+
+    mocker.patch("requests.post")
+    path = os.path.join(django_settings.MEDIA_ROOT, "timings.edi")
+    with open(path, "wb") as fp:
+        fp.write(b"payload")
+    (sent,) = BatchSender(organization, partner).send([path])
+    sent = Message.objects.get(pk=sent.pk)
+    for phase in ["crypto", "storage", "http", "hooks"]:
+        assert getattr(sent.timings, f"{phase}_ms") is not None
+    assert sent.timings.sent_at is not None
+
+    # Retries add up to the stored timings
+    sent.timings.http_ms = 1000
+    sent.timings.save()
+    sent.add_timing("http", 0.5)
+    sent.save_timings()
+    sent.timings.refresh_from_db()
+    assert sent.timings.http_ms == 1500
+
+    response = admin_client.get("/admin/pyas2/message/")
+    assert b"HTTP (ms)" in response.content
+    # Sort on the HTTP column, the ordering parameter counts from 1
+    column = MessageAdmin.list_display.index("mdn_url") + 5
+    response = admin_client.get(f"/admin/pyas2/message/?o=-{column}")
+    assert response.status_code == 200
+    assert list(response.context["cl"].result_list) == [sent, received]
+
+    response = admin_client.get(f"/admin/pyas2/message/{sent.pk}/change/")
+    assert b"Timings (ms)" in response.content
+
+
+@pytest.mark.django_db
+def test_slow_call_profiles(mocker, admin_client, organization, partner):
+    """Test that the profiles of the sampled slow sends are stored up to the
+    disk cap and can be downloaded."""
+    mocker.patch("requests.post")
+    mocker.patch("pyas2.settings.PROFILING_SAMPLE_RATE", 1)
+    mocker.patch("pyas2.settings.PROFILING_THRESHOLD", 0)
+    messages = []
+    for i in range(2):
+        message = Message.objects.create(
+            message_id=f"profiled-message-{i}",
+            direction="OUT",
+            status="P",
+            organization=organization,
+            partner=partner,
+        )
+        message.send_message({}, b"payload")
+        messages.append(message)
+
+    first = MessageTimings.objects.get(message=messages[0])
+    stats = pstats.Stats(first.profile.path)
+    assert any(func[2] == "send_message" for func in stats.stats)
+    response = admin_client.get(
+        reverse("download-file", args=["message_profile", messages[0].pk])
+    )
+    assert response.content == first.profile.read()
+
+    # Only the newest profile is kept beyond the disk cap, the sizes are read
+    # from the database
+    mocker.patch("pyas2.settings.PROFILING_MAX_SIZE", 1)
+    size = mocker.patch("django.core.files.storage.FileSystemStorage.size")
+    messages[1].save_profile(b"profile")
+    assert not size.called
+    first.refresh_from_db()
+    assert not first.profile
+    assert first.profile_size is None
+    second = MessageTimings.objects.get(message=messages[1])
+    assert second.profile.read() == b"profile"
+    assert second.profile_size == len(b"profile")
+
+    # Calls that are not sampled are not profiled
+    mocker.patch("pyas2.settings.PROFILING_SAMPLE_RATE", 0)
+    messages[0].send_message({}, b"payload")
+    assert not MessageTimings.objects.get(message=messages[0]).profile
+
+
+@pytest.mark.django_db
+def test_stub_partner(organization, partner, stub_partner):
+    """Test sending messages to the stub partner with signed MDNs and errors."""
+    with open(os.path.join(TEST_DIR, "client_private.pem"), "rb") as fp:
+        stub_partner.key = fp.read()
+    stub_partner.key_pass = "test"
+    with open(os.path.join(TEST_DIR, "client_public.pem"), "rb") as fp:
+        partner.signature_cert = PublicCertificate.objects.create(
+            certificate=fp.read(), verify_cert=False
+        )
+    partner.target_url = stub_partner.url
+    partner.mdn = True
+    partner.mdn_mode = "SYNC"
+    partner.mdn_sign = "sha256"
+    partner.save()
+
+    def send():
+        path = os.path.join(django_settings.MEDIA_ROOT, "stub.edi")
+        with open(path, "wb") as fp:
+            fp.write(b"payload")
+        (message,) = BatchSender(organization, partner).send([path])
+        return Message.objects.get(pk=message.pk)
+
+    message = send()
+    assert message.status == "S"
+    assert message.mdn.signed
+    assert stub_partner.stats["processed"] == 1
+
+    stub_partner.error_rate = 1
+    stub_partner.error_status = 503
+    message = send()
+    assert message.status == "R"
+    assert "503" in message.detailed_status
+    assert stub_partner.stats["error"] == 1
+
+
+@pytest.mark.django_db
+def test_resend_action(mocker, admin_client, organization, partner, stub_partner):
+    """Test resending the selected messages from the admin."""
+    mocker.patch("pyas2.settings.RESEND_WORKERS", 1)
+    partner.target_url = stub_partner.url
+    partner.save()
+    for i in range(3):
+        message = Message.objects.create(
+            message_id=f"resend-{i}",
+            direction="OUT",
+            status="E",
+            organization=organization,
+            partner=partner,
+        )
+        message.payload.save("resend.edi", ContentFile(b"payload"))
+
+    response = admin_client.post(
+        "/admin/pyas2/message/",
+        {
+            "action": "resend_messages",
+            "_selected_action": list(Message.objects.values_list("pk", flat=True)),
+        },
+        follow=True,
+    )
+    assert "Resent 3 messages, 0 failed." in response.content.decode()
+    assert Message.objects.filter(status="S").count() == 3
+    assert stub_partner.stats["processed"] == 3
+
+    # Larger selections are refused when the tasks run inline
+    mocker.patch("pyas2.admin.RESEND_INLINE_LIMIT", 2)
+    response = admin_client.post(
+        "/admin/pyas2/message/",
+        {
+            "action": "resend_messages",
+            "_selected_action": list(Message.objects.values_list("pk", flat=True)),
+        },
+        follow=True,
+    )
+    assert "Select at most 2 messages to resend" in response.content.decode()
+    assert stub_partner.stats["processed"] == 3
+
+    # They are queued in batches with a background task backend
+    mocker.patch("pyas2.admin.RESEND_BATCH_SIZE", 2)
+    mocker.patch("pyas2.settings.TASK_BACKEND", "pyas2.tasks.DatabaseBackend")
+    get_backend.cache_clear()
+    try:
+        response = admin_client.post(
+            "/admin/pyas2/message/",
+            {
+                "action": "resend_messages",
+                "_selected_action": list(Message.objects.values_list("pk", flat=True)),
+            },
+            follow=True,
+        )
+    finally:
+        get_backend.cache_clear()
+    assert "Queued 3 messages for resending." in response.content.decode()
+    assert [
+        len(json.loads(arguments)["message_ids"])
+        for arguments in Task.objects.values_list("arguments", flat=True)
+    ] == [2, 1]
+    for queued_task in Task.objects.all():
+        DatabaseBackend.process(queued_task)
+    assert stub_partner.stats["processed"] == 6
+
+
+@pytest.mark.django_db
+def test_bulk_resender_workers(mocker, organization, partner):
+    """Test that the bulk resender spreads the messages over its workers."""
+    threads = set()
+
+    def resend(sender, message, session):
+        threads.add(threading.get_ident())
+        message.status = "E" if message.message_id == "resend-0" else "S"
+
+    mocker.patch.object(BatchSender, "resend", autospec=True, side_effect=resend)
+    mocker.patch("pyas2.sender.connections.close_all")
+    for i in range(20):
+        Message.objects.create(
+            message_id=f"resend-{i}",
+            direction="IN" if i % 5 == 4 else "OUT",
+            status="E",
+            organization=organization,
+            partner=partner,
+        )
+    progress = mocker.Mock()
+    resender = BulkResender(workers=4, progress=progress)
+    sent, failed = resender.run(Message.objects.all())
+    outbound = Message.objects.filter(direction="OUT").count()
+    assert (sent, failed) == (outbound - 1, 1)
+    assert progress.call_count == outbound
+    assert len(resender.senders) == 1
+    assert threading.get_ident() not in threads
+
+
+def test_concurrent_storage_writes():
+    """Test that the storage writes run on the pool and that the completed
+    writes are cleaned up when one of them fails."""
+    threads = []
+
+    def write(result):
+        threads.append(threading.get_ident())
+        return result
+
+    assert run_writes([(lambda: write(1), None), (lambda: write(2), None)]) == [1, 2]
+    assert threading.get_ident() not in threads
+
+    def fail():
+        raise OSError("Storage unavailable")
+
+    cleanup = mock.Mock()
+    with pytest.raises(OSError, match="Storage unavailable"):
+        run_writes([(lambda: write("saved.msg"), cleanup), (fail, mock.Mock())])
+    cleanup.assert_called_once_with("saved.msg")
+
+
+@pytest.mark.django_db
+def test_database_task_backend(mocker, organization, partner):
+    """Test handing off the sends to the database queue and running the
+    queued tasks with the worker command."""
+    mocker.patch("pyas2.settings.TASK_BACKEND", "pyas2.tasks.DatabaseBackend")
+    get_backend.cache_clear()
+    try:
+        as2message = As2Message(sender=organization.as2org, receiver=partner.as2partner)
+        as2message.build(b"test data", filename="testmessage.edi")
+        message, _ = Message.objects.create_from_as2message(
+            as2message=as2message, payload=b"test data", direction="OUT", status="P"
+        )
+        mocked_post = mocker.patch("requests.post")
+        assert not dispatch_send(message, as2message.headers, as2message.content)
+        assert not mocked_post.called
+        assert Task.objects.get().name == "send_message"
+
+        management.call_command("as2taskworker", once=True, stdout=StringIO())
+        assert mocked_post.call_args.kwargs["data"] == as2message.content
+        message.refresh_from_db()
+        assert message.status == "S"
+        assert not Task.objects.exists()
+
+        # Failed tasks are kept once they have been attempted enough times
+        mocker.patch("pyas2.settings.TASK_MAX_ATTEMPTS", 1)
+        enqueue("post_send", message_id=0)
+        management.call_command("as2taskworker", once=True, stdout=StringIO())
+        failed = Task.objects.get()
+        assert failed.status == "E"
+        assert "DoesNotExist" in failed.error
+
+        # A task left running by a stopped worker is claimed again once, the
+        # claims count as attempts
+        mocker.patch("pyas2.settings.TASK_MAX_ATTEMPTS", 2)
+        failed.status = "R"
+        failed.started_at = timezone.now() - timedelta(hours=1)
+        failed.save()
+        assert DatabaseBackend.claim().pk == failed.pk
+        assert DatabaseBackend.claim() is None
+        Task.objects.filter(pk=failed.pk).update(
+            started_at=timezone.now() - timedelta(hours=1)
+        )
+        assert DatabaseBackend.claim() is None
+        failed.refresh_from_db()
+        assert failed.status == "E"
+        assert "interrupted" in failed.error
+
+        # The send of a message waiting for its asynchronous MDN is not
+        # repeated when its task runs again
+        mocked_post.reset_mock()
+        Message.objects.filter(pk=message.pk).update(status="P")
+        run_task("send_message", {"message_id": message.pk})
+        assert not mocked_post.called
+
+        with pytest.raises(management.CommandError):
+            management.call_command("as2taskworker", enqueue="unknown")
+    finally:
+        get_backend.cache_clear()
+
+
+@pytest.mark.django_db
+def test_thread_pool_task_backend(mocker, django_capture_on_commit_callbacks):
+    """Test that the thread pool backend runs the tasks on its threads once
+    the transaction is committed."""
+    threads = []
+    mocker.patch.dict(TASKS, {"record": lambda: threads.append(threading.get_ident())})
+    backend = ThreadPoolBackend(workers=1)
+    mocker.patch("pyas2.tasks.get_backend", return_value=backend)
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        enqueue("record")
+        assert not threads
+    assert len(callbacks) == 1
+    backend.executor.shutdown(wait=True)
+    assert len(threads) == 1
+    assert threading.get_ident() not in threads
+
+
+@pytest.mark.django_db
+def test_send_message_task_claims(mocker, organization, partner):
+    """Test that the send task claims the pending message and leaves it to
+    the retries if the send is interrupted."""
+    message = Message.objects.create(
+        message_id="claimed-id",
+        direction="OUT",
+        status="P",
+        organization=organization,
+        partner=partner,
+    )
+    message.store_envelope({}, b"payload")
+    message.save()
+    mocked_send = mocker.patch(
+        "pyas2.models.Message.send_message", side_effect=KeyboardInterrupt
+    )
+    with pytest.raises(KeyboardInterrupt):
+        run_task("send_message", {"message_id": message.pk})
+    message.refresh_from_db()
+    assert message.status == "R"
+    assert message.next_attempt_at > timezone.now()
+
+    # The interrupted message is no longer claimed by the task
+    run_task("send_message", {"message_id": message.pk})
+    assert mocked_send.call_count == 1
+
+
+@pytest.mark.django_db
+def test_receive_admission_control(mocker):
+    """Test that the receives over the in-flight limits get a 503 before
+    their body is read."""
+    mocker.patch("pyas2.settings.RECEIVE_MAX_IN_FLIGHT", 1)
+    mocker.patch("pyas2.settings.RECEIVE_MAX_IN_FLIGHT_BYTES", 100)
+    mocker.patch("pyas2.settings.RECEIVE_RETRY_AFTER", 15)
+    client = Client()
+
+    assert receive_admission.try_acquire(10)
+    try:
+        response = client.post(
+            "/pyas2/as2receive", data=b"x", content_type="text/plain"
+        )
+        assert response.status_code == 503
+        assert response["Retry-After"] == "15"
+    finally:
+        receive_admission.release(10)
+
+    # The byte limit applies to the requests received at the same time
+    mocker.patch("pyas2.settings.RECEIVE_MAX_IN_FLIGHT", 0)
+    assert receive_admission.try_acquire(60)
+    try:
+        response = client.post(
+            "/pyas2/as2receive", data=b"x" * 50, content_type="text/plain"
+        )
+        assert response.status_code == 503
+        assert receive_admission.try_acquire(20)
+        receive_admission.release(20)
+    finally:
+        receive_admission.release(60)
+
+    # The size of the requests without Content-Length is not known
+    response = client.post(
+        "/pyas2/as2receive", data=b"x", content_type="text/plain", CONTENT_LENGTH=""
+    )
+    assert response.status_code == 411
+
+    # A request larger than the byte limit is admitted when alone
+    mocked_post = mocker.patch(
+        "pyas2.views.ReceiveAs2Message.post", return_value=HttpResponse("received")
+    )
+    response = client.post(
+        "/pyas2/as2receive", data=b"x" * 200, content_type="text/plain"
+    )
+    assert response.status_code == 200
+    assert mocked_post.call_count == 1
+    assert receive_admission.in_flight == 0
+    assert receive_admission.in_flight_bytes == 0
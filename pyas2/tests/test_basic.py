@@ -81,10 +81,8 @@ class BasicServerClientTestCase(TestCase):
                 os.unlink(file_path)
 
         for message in Message.objects.all():
-            message.headers.delete()
             message.payload.delete()
         for mdn in Mdn.objects.all():
-            mdn.headers.delete()
             mdn.payload.delete()
 
     def testEndpoint(self):
@@ -114,9 +112,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertFalse(hasattr(in_message, "mdn"))
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testNoEncryptMessageMdn(self):
         """Test Permutation 2: Sender sends un-encrypted data and requests an
@@ -142,9 +138,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertFalse(in_message.mdn.signed)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testNoEncryptMessageSignMdn(self):
         """Test Permutation 3: Sender sends un-encrypted data and requests a
@@ -172,9 +166,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertTrue(in_message.mdn.signed)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testEncryptMessageNoMdn(self):
         """Test Permutation 4: Sender sends encrypted data and does NOT
@@ -199,9 +191,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertEqual(in_message.status, "S")
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testEncryptMessageMdn(self):
         """Test Permutation 5: Sender sends encrypted data and requests an
@@ -228,9 +218,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertIsNotNone(in_message.mdn)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testEncryptMessageSignMdn(self):
         """Test Permutation 6: Sender sends encrypted data and requests
@@ -260,9 +248,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertTrue(in_message.mdn.signed)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testSignMessageNoMdn(self):
         """Test Permutation 7: Sender sends signed data and does NOT request
@@ -286,9 +272,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertEqual(in_message.status, "S")
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testSignMessageMdn(self):
         """Test Permutation 8: Sender sends signed data and requests an
@@ -315,9 +299,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertIsNotNone(in_message.mdn)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testSignMessageSignMdn(self):
         """Test Permutation 9: Sender sends signed data and requests a
@@ -346,9 +328,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertTrue(in_message.mdn.signed)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testEncryptSignMessageNoMdn(self):
         """Test Permutation 10: Sender sends encrypted and signed data and
@@ -375,9 +355,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertEqual(in_message.status, "S")
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testEncryptSignMessageMdn(self):
         """Test Permutation 11: Sender sends encrypted and signed data and
@@ -407,9 +385,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertIsNotNone(in_message.mdn)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testEncryptSignMessageSignMdn(self):
         """Test Permutation 12: Sender sends encrypted and signed data and
@@ -441,9 +417,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertTrue(in_message.mdn.signed)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     def testCompressEncryptSignMessageSignMdn(self):
         """Test Permutation 13: Sender sends compressed, encrypted and signed
@@ -477,9 +451,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertTrue(in_message.mdn.signed)
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
     @mock.patch("requests.post")
     def testEncryptSignMessageAsyncSignMdn(self, mock_request):
@@ -526,9 +498,7 @@ class BasicServerClientTestCase(TestCase):
         self.assertEqual(out_message.mdn.status, "S")
 
         # Check if input and output files are the same
-        self.assertTrue(
-            self.compareFiles(in_message.payload.name, out_message.payload.name)
-        )
+        self.assertTrue(self.compareFiles(in_message.payload, out_message.payload))
 
         # Check async mdn failure
         mock_request.side_effect = RequestException()
@@ -556,9 +526,9 @@ class BasicServerClientTestCase(TestCase):
         return in_message
 
     @staticmethod
-    def compareFiles(filename1, filename2):
-        with open(filename1, "rt") as a:
-            with open(filename2, "rt") as b:
+    def compareFiles(file1, file2):
+        with file1.open("r") as a:
+            with file2.open("r") as b:
                 # Note that "all" and "zip" are lazy
                 # (will stop at the first line that's not identical)
                 return all(
@@ -1,47 +1,80 @@
 """Test the management commands of the pyas2 app."""
 import os
 import shutil
+import zlib
+from datetime import date, timedelta
+from io import StringIO
 from pathlib import Path
+from unittest import mock
 
 import pytest
 from django.conf import settings
 from django.core import management
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import DatabaseError, IntegrityError, connection
+from django.utils import timezone
+from pyas2lib import Organization as As2Organization
+from pyas2lib import Partner as As2Partner
+from requests.exceptions import ConnectionError as RequestsConnectionError
 
 from pyas2 import settings as app_settings
-from pyas2.models import As2Message, Message, Mdn
+from pyas2.lanes import PRIORITY_HIGH
+from pyas2.models import As2Message, Message, MessageTimings, Mdn
+from pyas2.outbox import create_outbox_folder, scan_outboxes
+from pyas2.packs import _read_member, _replace_file, read_packed
+from pyas2.partitions import (
+    TablePartitioner,
+    interval_start,
+    next_interval,
+    partition_name,
+    partition_start,
+)
+from pyas2.templatetags.pyas2 import readfilefield
 from pyas2.tests import TEST_DIR
+from pyas2.management.commands.as2loadtest import percentile
 from pyas2.management.commands.sendas2bulk import Command as SendBulkCommand
+from pyas2.management.commands.watchas2outbox import Command as WatchOutboxCommand
+from pyas2.management.commands.watchas2outbox import OBSERVER_SCAN_INTERVAL
 
 
 @pytest.mark.django_db
 def test_sendbulk_command(mocker, partner, organization):
     """Test the command for sending all files in the outbox folder"""
-    mocked_call_command = mocker.patch(
-        "pyas2.management.commands.sendas2bulk.call_command"
-    )
+    mocked_send_message = mocker.patch("pyas2.models.Message.send_message")
 
     # Call the command
     command = SendBulkCommand()
     command.handle()
+    assert mocked_send_message.call_count == 0
 
     # Create a file for testing and try again
     outbox_dir = os.path.join(
         "messages", partner.as2_name, "outbox", organization.as2_name
     )
     test_file = Path(os.path.join(outbox_dir, "testmessage.edi"))
-    test_file.touch()
+    test_file.write_bytes(b"test data")
     command.handle()
-    mocked_call_command.assert_called_with(
-        "sendas2message",
-        organization.as2_name,
-        partner.as2_name,
-        str(test_file),
-        delete=True,
-    )
+    assert mocked_send_message.call_count == 1
+    assert not test_file.exists()
+    message = Message.objects.get(partner=partner, organization=organization)
+    assert message.direction == "OUT"
+    assert message.status == "P"
+    assert message.payload.read() == b"test data"
+    assert message.priority == partner.default_priority
+
+    # Files in the priority folders are sent with the priority of the folder
+    os.makedirs(os.path.join(outbox_dir, "high"))
+    for i in range(3):
+        Path(os.path.join(outbox_dir, "high", f"test{i}.edi")).touch()
+    mocker.patch.object(app_settings, "SEND_BATCH_SIZE", 2)
+    command.handle()
+    assert mocked_send_message.call_count == 4
+    assert Message.objects.filter(priority=PRIORITY_HIGH).count() == 3
+    assert not os.listdir(os.path.join(outbox_dir, "high"))
 
     # Try with the data directory
-    app_settings.DATA_DIR = settings.BASE_DIR
+    app_settings.DATA_DIR = settings.MEDIA_ROOT
     command.handle()
 
     # Delete the folder
@@ -49,10 +82,100 @@ def test_sendbulk_command(mocker, partner, organization):
     shutil.rmtree(outbox_dir)
 
 
+@pytest.mark.django_db
+def test_scan_outboxes(mocker, partner, organization):
+    """Test that the outbox folders are created and scanned in a single walk"""
+    mocker.patch("pyas2.outbox._created_outboxes", set())
+    outbox_dir = os.path.join(
+        "messages", partner.as2_name, "outbox", organization.as2_name
+    )
+    if os.path.isdir(outbox_dir):
+        shutil.rmtree(outbox_dir)
+
+    # The outbox folder of a pair is created once it exchanges a message
+    as2message = As2Message(sender=organization.as2org, receiver=partner.as2partner)
+    as2message.build(b"test data", filename="testmessage.edi")
+    Message.objects.create_from_as2message(
+        as2message=as2message, payload=b"test data", direction="OUT", status="P"
+    )
+    assert os.path.isdir(outbox_dir)
+    assert list(scan_outboxes()) == []
+
+    # Files in the outbox and priority folders are found, others are skipped
+    os.makedirs(os.path.join(outbox_dir, "low"), exist_ok=True)
+    Path(os.path.join(outbox_dir, "first.edi")).touch()
+    Path(os.path.join(outbox_dir, "second.edi.part")).touch()
+    Path(os.path.join(outbox_dir, "low", "third.edi")).touch()
+    inbox_dir = os.path.join("messages", organization.as2_name, "inbox")
+    os.makedirs(inbox_dir, exist_ok=True)
+    Path(os.path.join(inbox_dir, "received.edi")).touch()
+
+    assert sorted(scan_outboxes(), key=lambda f: f[2]) == [
+        (
+            partner.as2_name,
+            organization.as2_name,
+            os.path.join(outbox_dir, "first.edi"),
+            None,
+        ),
+        (
+            partner.as2_name,
+            organization.as2_name,
+            os.path.join(outbox_dir, "low", "third.edi"),
+            "low",
+        ),
+    ]
+    shutil.rmtree(outbox_dir)
+    shutil.rmtree(inbox_dir)
+
+
+def test_create_outbox_folder_retried(mocker):
+    """Test that an outbox folder that could not be created is created by the
+    next message."""
+    mocker.patch("pyas2.outbox._created_outboxes", set())
+    makedirs = mocker.patch(
+        "pyas2.outbox.os.makedirs", side_effect=[PermissionError, None]
+    )
+    with pytest.raises(PermissionError):
+        create_outbox_folder("as2server", "as2client")
+    create_outbox_folder("as2server", "as2client")
+    create_outbox_folder("as2server", "as2client")
+    assert makedirs.call_count == 2
+
+
+def test_scan_outboxes_object_storage(mocker):
+    """Test that the outboxes of an object storage are scanned with a prefix
+    listing per partner folder."""
+    keys = {
+        "media/messages/as2client/outbox/": [
+            "as2server/first.edi",
+            "as2server/second.edi.part",
+            "as2server/low/third.edi",
+            "as2server/unknown/fourth.edi",
+        ]
+    }
+    storage = mocker.patch("pyas2.outbox.default_storage")
+    storage.path.side_effect = NotImplementedError
+    storage.location = "media"
+    storage.listdir.return_value = (["as2client", "as2server", "__store"], [])
+    storage.bucket.objects.filter.side_effect = lambda Prefix: [
+        mock.Mock(key=Prefix + key) for key in keys.get(Prefix, [])
+    ]
+
+    outbox_dir = "messages/as2client/outbox/as2server"
+    assert list(scan_outboxes()) == [
+        ("as2client", "as2server", f"{outbox_dir}/first.edi", None),
+        ("as2client", "as2server", f"{outbox_dir}/low/third.edi", "low"),
+    ]
+    assert storage.listdir.call_count == 1
+    assert storage.bucket.objects.filter.call_count == 3
+
+
 @pytest.mark.django_db
 def test_sendmessage_command(mocker, organization, partner):
     """Test the command for sending an as2 message"""
-    test_message = os.path.join(TEST_DIR, "testmessage.edi")
+    test_message = shutil.copy(
+        os.path.join(TEST_DIR, "testmessage.edi"), settings.MEDIA_ROOT
+    )
 
     # Try to run with invalid org and client
     with pytest.raises(management.CommandError):
@@ -66,13 +189,25 @@ def test_sendmessage_command(mocker, organization, partner):
 
     with pytest.raises(management.CommandError):
         management.call_command(
-            "sendas2message", organization.as2_name, partner.as2_name, "testmessage.edi"
+            "sendas2message", organization.as2_name, partner.as2_name, "missing.edi"
         )
 
     # Try again with a valid org
     management.call_command(
         "sendas2message", organization.as2_name, partner.as2_name, test_message
     )
+    assert Message.objects.get().priority == partner.default_priority
+
+    # Try again with the priority set
+    Message.objects.all().delete()
+    management.call_command(
+        "sendas2message",
+        organization.as2_name,
+        partner.as2_name,
+        test_message,
+        priority="high",
+    )
+    assert Message.objects.get().priority == PRIORITY_HIGH
 
     # Try again with delete function
     mocked_delete = mocker.patch(
@@ -106,17 +241,26 @@ def test_manageserver_command(mocker, organization, partner):
     out_message, _ = Message.objects.create_from_as2message(
         as2message=as2message, payload=payload, direction="OUT", status="P"
     )
+    assert out_message.headers == as2message.headers_str.decode()
     out_message.send_message(as2message.headers, as2message.content)
 
-    # Test the retry command
+    # Test the retry command is not run before the next attempt is due
     out_message.refresh_from_db()
     assert out_message.status == "R"
+    assert out_message.next_attempt_at > timezone.now()
+    management.call_command("manageas2server", retry=True)
+    out_message.refresh_from_db()
+    assert out_message.retries is None
+
+    # Test the retry command
+    Message.objects.update(next_attempt_at=timezone.now())
     management.call_command("manageas2server", retry=True)
     out_message.refresh_from_db()
     assert out_message.retries == 1
 
     # Test max retry setting
     app_settings.MAX_RETRIES = 1
+    Message.objects.update(next_attempt_at=timezone.now())
     management.call_command("manageas2server", retry=True)
     out_message.refresh_from_db()
     assert out_message.retries == 2
@@ -141,8 +285,12 @@ def test_manageserver_command(mocker, organization, partner):
     assert out_message.status == "E"
 
     # Test the async mdn command for outbound mdns
-    mdn = Mdn.objects.create(mdn_id="some-mdn-id", message=out_message, status="P")
-    mdn.headers.save("some-mdn-id.headers", ContentFile(""))
+    mdn = Mdn.objects.create(
+        mdn_id="some-mdn-id",
+        message=out_message,
+        status="P",
+        headers="content-type: text/plain\r\n",
+    )
     mdn.payload.save("some-mdn-id.mdn", ContentFile("MDN Content"))
     management.call_command("manageas2server", async_mdns=True)
     mdn.refresh_from_db()
@@ -151,8 +299,15 @@ def test_manageserver_command(mocker, organization, partner):
     management.call_command("manageas2server", async_mdns=True)
     mdn.refresh_from_db()
     assert mocked_post.call_count == 1
+    assert mocked_post.call_args.kwargs["headers"] == {"content-type": "text/plain"}
     assert mdn.status == "S"
 
+    # An MDN sent meanwhile by the task backend is not sent again
+    stale_mdn = Mdn.objects.get(pk=mdn.pk)
+    stale_mdn.status = "P"
+    assert stale_mdn.send_async_mdn()
+    assert mocked_post.call_count == 1
+
     # Test the clean command
     management.call_command("manageas2server", clean=True)
     assert Message.objects.filter(message_id=out_message.message_id).count() == 0
@@ -164,3 +319,513 @@ def test_manageserver_command(mocker, organization, partner):
     )
     management.call_command("manageas2server", clean=True)
     assert Message.objects.filter(message_id=out_message.message_id).count() == 0
+
+
+@pytest.mark.django_db
+def test_retry_backoff(mocker, partner):
+    """Test the exponential backoff of the retries with the partner settings."""
+    mocker.patch("random.uniform", return_value=0)
+    assert partner.get_retry_delay(0).total_seconds() == app_settings.RETRY_DELAY
+    partner.retry_delay = 10
+    partner.retry_max_delay = 50
+    assert partner.get_retry_delay(0).total_seconds() == 10
+    assert partner.get_retry_delay(2).total_seconds() == 40
+    assert partner.get_retry_delay(3).total_seconds() == 50
+
+    mocker.patch("random.uniform", return_value=0.5)
+    partner.retry_jitter = 0.5
+    assert partner.get_retry_delay(0).total_seconds() == 15
+
+
+@pytest.mark.django_db
+def test_watch_outbox_command(mocker, partner, organization):
+    """Test that the outbox watcher sends the files once they are fully written."""
+    mocked_send = mocker.patch("pyas2.management.commands.watchas2outbox.BatchSender")
+    outbox_dir = os.path.join(
+        "messages", partner.as2_name, "outbox", organization.as2_name
+    )
+    os.makedirs(outbox_dir, exist_ok=True)
+    Path(os.path.join(outbox_dir, "testmessage.edi.part")).touch()
+    test_file = os.path.join(outbox_dir, "testmessage.edi")
+    Path(test_file).touch()
+
+    # Files are only sent after they stay unchanged for the settle time
+    command = WatchOutboxCommand()
+    command.scan()
+    assert list(command.pending) == [test_file]
+    command.send_ready(now=1)
+    assert mocked_send.call_count == 0
+    command.send_ready(now=2)
+    mocked_send.assert_called_once_with(organization, partner)
+    mocked_send.return_value.send.assert_called_once_with([test_file], priority=None)
+    assert not command.pending
+
+    # Files that failed to be sent are tried again after a backoff
+    mocked_send.return_value.send.side_effect = Exception("Partner down")
+    command.scan()
+    command.send_ready(now=10)
+    command.send_ready(now=11)
+    assert mocked_send.return_value.send.call_count == 2
+    assert list(command.pending) == [test_file]
+    command.send_ready(now=15)
+    command.send_ready(now=15.5)
+    assert mocked_send.return_value.send.call_count == 2
+    mocked_send.return_value.send.side_effect = None
+    command.send_ready(now=16)
+    command.send_ready(now=17)
+    assert mocked_send.return_value.send.call_count == 3
+    assert not command.pending and not command.failures
+
+    # Files reported by the notifications are mapped to the outbox
+    command.watched_root = os.path.abspath("messages")
+    command.add_event(os.path.abspath(os.path.join(outbox_dir, "high", "a.edi")))
+    command.add_event(os.path.abspath(os.path.join(outbox_dir, ".hidden")))
+    assert list(command.pending) == [os.path.join(outbox_dir, "high", "a.edi")]
+
+    # Files missed by the notifications are found by the periodic scans
+    command.pending = {}
+    command.last_scan = 100
+    command.rescan(now=100 + OBSERVER_SCAN_INTERVAL - 1)
+    assert not command.pending
+    command.rescan(now=100 + OBSERVER_SCAN_INTERVAL)
+    assert list(command.pending) == [test_file]
+    assert command.last_scan == 100 + OBSERVER_SCAN_INTERVAL
+    shutil.rmtree(outbox_dir)
+
+
+@pytest.mark.django_db
+def test_loadtest_command(mocker, organization, partner):
+    """Test the command for load testing an AS2 server."""
+
+    def receive(url, auth=None, headers=None, data=None):
+        """Receive the message as the partner and return a synchronous MDN."""
+        raw_headers = "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+        _, _, as2mdn = As2Message().parse(
+            raw_headers.encode() + b"\r\n" + data,
+            find_org_cb=lambda as2_name: As2Organization(as2_name=as2_name),
+            find_partner_cb=lambda as2_name: As2Partner(as2_name=as2_name),
+        )
+        return mock.Mock(
+            status_code=200, headers=as2mdn.headers, content=as2mdn.content
+        )
+
+    mocked_post = mocker.patch("requests.Session.post", side_effect=receive)
+    out = StringIO()
+    management.call_command(
+        "as2loadtest",
+        organization.as2_name,
+        partner.as2_name,
+        messages=4,
+        concurrency=1,
+        sizes="100:3,1000",
+        mdn="sync",
+        stdout=out,
+    )
+    assert mocked_post.call_count == 4
+    assert "Succeeded: 4" in out.getvalue()
+    assert "processed: 4" in out.getvalue()
+
+    # Report the failed requests by their error class
+    mocked_post.side_effect = RequestsConnectionError("Refused")
+    out = StringIO()
+    management.call_command(
+        "as2loadtest",
+        organization.as2_name,
+        partner.as2_name,
+        messages=2,
+        mdn="none",
+        stdout=out,
+    )
+    assert "Failed: 2" in out.getvalue()
+    assert "ConnectionError: 2" in out.getvalue()
+
+    with pytest.raises(management.CommandError):
+        management.call_command(
+            "as2loadtest", organization.as2_name, partner.as2_name, sizes="big"
+        )
+
+
+def test_loadtest_percentile():
+    """Test the nearest-rank percentile of the load test latencies."""
+    assert percentile([], 50) == 0
+    assert percentile([1, 2], 50) == 1
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile(list(range(1, 101)), 100) == 100
+    assert percentile([5], 0) == 5
+
+
+@pytest.mark.django_db
+def test_resend_command(mocker, organization, partner):
+    """Test the command for resending outbound messages."""
+    mocked_post = mocker.patch("requests.Session.post")
+    for status in ["E", "E", "R", "S"]:
+        message = Message.objects.create(
+            message_id=f"resend-{Message.objects.count()}",
+            direction="OUT",
+            status=status,
+            organization=organization,
+            partner=partner,
+        )
+        message.payload.save("resend.edi", ContentFile(b"payload"))
+
+    out = StringIO()
+    management.call_command("resendas2messages", status=["E"], workers=1, stdout=out)
+    assert mocked_post.call_count == 2
+    assert Message.objects.filter(status="S").count() == 3
+    assert "Sent 2 messages, 0 failed." in out.getvalue()
+
+    # Failed resends are retried later
+    mocked_post.side_effect = RequestsConnectionError("Refused")
+    out = StringIO()
+    management.call_command(
+        "resendas2messages",
+        partner=partner.as2_name,
+        since=timezone.now().date().isoformat(),
+        workers=1,
+        stdout=out,
+    )
+    assert mocked_post.call_count == 3
+    assert Message.objects.filter(status="R").count() == 1
+    assert "Sent 0 messages, 1 failed." in out.getvalue()
+
+    # Messages outside the filters are not resent
+    management.call_command("resendas2messages", partner="unknown", workers=1)
+    management.call_command("resendas2messages", until="2000-01-01", workers=1)
+    assert mocked_post.call_count == 3
+
+    with pytest.raises(management.CommandError):
+        management.call_command("resendas2messages", since="yesterday")
+
+
+@pytest.mark.django_db
+def test_compact_store_command(mocker, organization, partner):
+    """Test packing the closed day folders of the store and reading the
+    packed files."""
+    folder = "messages/__store/payload/sent/20000101"
+    messages = []
+    for i in range(3):
+        message = Message.objects.create(
+            message_id=f"packed-{i}",
+            direction="OUT",
+            status="S",
+            organization=organization,
+            partner=partner,
+        )
+        message.payload.name = default_storage.save(
+            f"{folder}/packed-{i}.msg", ContentFile(f"payload {i}".encode())
+        )
+        message.save()
+        messages.append(message)
+
+    management.call_command("compactas2store", stdout=StringIO())
+    assert default_storage.listdir(folder)[1] == []
+    message = Message.objects.get(pk=messages[0].pk)
+    assert message.payload.read() == b"payload 0"
+    assert message.payload.size == len(b"payload 0")
+    assert readfilefield(Message.objects.get(pk=messages[1].pk).payload) == "payload 1"
+
+    # Files added to a packed folder are packed along with the existing ones
+    default_storage.save(f"{folder}/late.msg", ContentFile(b"late payload"))
+    management.call_command("compactas2store", stdout=StringIO())
+    for i, message in enumerate(messages):
+        assert Message.objects.get(pk=message.pk).payload.read() == (
+            f"payload {i}".encode()
+        )
+    assert read_packed(f"{folder}/late.msg") == b"late payload"
+    with pytest.raises(FileNotFoundError):
+        read_packed(f"{folder}/missing.msg")
+
+    # The packs are deleted with the archive
+    mocker.patch("pyas2.settings.MAX_ARCH_DAYS", 30)
+    management.call_command("manageas2server", clean=True, stdout=StringIO())
+    with pytest.raises(FileNotFoundError):
+        read_packed(f"{folder}/late.msg")
+
+
+def test_packs_object_storage(mocker):
+    """Test that the packed files are read with a ranged request and that the
+    index is switched with a copy on an object storage."""
+    storage = mocker.patch("pyas2.packs.default_storage")
+    storage.path.side_effect = NotImplementedError
+    storage.location = "media"
+    storage.bucket.name = "bucket"
+    storage.bucket.meta.client.exceptions.NoSuchKey = KeyError
+    storage.save.side_effect = lambda name, content: name
+    compressed = zlib.compress(b"packed payload")
+    storage.bucket.Object.return_value.get.return_value = {
+        "Body": mock.Mock(read=mock.Mock(return_value=compressed))
+    }
+    index = {"pack": "store/20000101.pack", "files": {"a.msg": [10, 20, 14]}}
+
+    assert _read_member(index, "a.msg") == b"packed payload"
+    storage.bucket.Object.assert_called_with("media/store/20000101.pack")
+    storage.bucket.Object.return_value.get.assert_called_with(Range="bytes=10-29")
+    storage.open.assert_not_called()
+
+    storage.bucket.Object.return_value.get.side_effect = KeyError
+    with pytest.raises(FileNotFoundError):
+        _read_member(index, "a.msg")
+
+    _replace_file("store/20000101.idx", ContentFile(b"{}"))
+    storage.save.assert_called_once_with("store/20000101.idx.new", mock.ANY)
+    storage.bucket.Object.assert_called_with("media/store/20000101.idx")
+    storage.bucket.Object.return_value.copy_from.assert_called_once_with(
+        CopySource={"Bucket": "bucket", "Key": "media/store/20000101.idx.new"}
+    )
+    storage.delete.assert_called_once_with("store/20000101.idx.new")
+
+
+@pytest.mark.django_db
+def test_clean_by_day(mocker, organization, partner, django_assert_num_queries):
+    """Test cleaning up whole days of messages and archived files at once."""
+    mocker.patch("pyas2.settings.MAX_ARCH_DAYS", 1)
+    now = timezone.now()
+    for days_ago in [4, 4, 3, 0]:
+        message = Message.objects.create(
+            message_id=f"clean-{Message.objects.count()}",
+            direction="OUT",
+            status="S",
+            organization=organization,
+            partner=partner,
+        )
+        Mdn.objects.create(mdn_id=message.message_id, message=message, status="S")
+        message.add_timing("http", 0.1)
+        message.save_timings()
+        Message.objects.filter(pk=message.pk).update(
+            timestamp=now - timedelta(days_ago)
+        )
+
+    old_day = (now - timedelta(4)).strftime("%Y%m%d")
+    folders = [
+        f"messages/__store/payload/sent/{old_day}",
+        f"messages/__store/mdn/received/{old_day}",
+        f"messages/__store/profile/{old_day}",
+        f"messages/__store/payload/sent/{now.strftime('%Y%m%d')}",
+    ]
+    for folder in folders:
+        default_storage.save(f"{folder}/clean.msg", ContentFile(b"payload"))
+
+    # A range delete per day and table, whatever the number of messages
+    with django_assert_num_queries(7):
+        assert Message.objects.delete_by_day(now - timedelta(1)) == 2
+    assert list(Message.objects.values_list("message_id", flat=True)) == ["clean-3"]
+    assert Mdn.objects.count() == 1
+
+    management.call_command("manageas2server", clean=True, by_day=True)
+    for folder in folders[:3]:
+        assert not default_storage.exists(f"{folder}/clean.msg")
+    assert default_storage.exists(f"{folders[3]}/clean.msg")
+    assert Message.objects.count() == 1
+    default_storage.delete(f"{folders[3]}/clean.msg")
+
+
+@pytest.mark.django_db
+def test_clean_by_utc_day(organization, partner):
+    """Test that the messages are deleted by UTC day as the day folders of the
+    store, whatever the current time zone."""
+    day = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    message = Message.objects.create(
+        message_id="clean-utc", direction="OUT", status="S", partner=partner
+    )
+    Message.objects.filter(pk=message.pk).update(timestamp=day - timedelta(hours=12))
+    with timezone.override("Pacific/Auckland"):
+        assert Message.objects.delete_by_day(day + timedelta(hours=6)) == 1
+    assert not Message.objects.filter(pk=message.pk).exists()
+
+
+def test_partition_intervals():
+    """Test the names and bounds of the partitions of the message tables."""
+    day = date(2024, 1, 31)
+    assert interval_start(day, "day") == day
+    assert next_interval(day, "day") == date(2024, 2, 1)
+    assert interval_start(day, "month") == date(2024, 1, 1)
+    assert next_interval(date(2024, 12, 1), "month") == date(2025, 1, 1)
+
+    name = partition_name("pyas2_message", day, "day")
+    assert name == "pyas2_message_p20240131"
+    assert partition_start("pyas2_message", name, "day") == day
+    name = partition_name("pyas2_message", date(2024, 1, 1), "month")
+    assert name == "pyas2_message_p202401"
+    assert partition_start("pyas2_message", name, "month") == date(2024, 1, 1)
+    assert partition_start("pyas2_message", "pyas2_message_default", "day") is None
+
+
+@pytest.mark.skipif(
+    connection.vendor == "postgresql",
+    reason="Requires a database other than PostgreSQL",
+)
+@pytest.mark.django_db
+def test_partition_tables_requires_postgresql():
+    """Test that the partitioning command refuses other databases."""
+    with pytest.raises(management.CommandError, match="only supported on PostgreSQL"):
+        management.call_command("partitionas2tables", setup=True)
+
+
+@pytest.mark.postgresql
+@pytest.mark.skipif(
+    connection.vendor != "postgresql",
+    reason="Requires a PostgreSQL database, set DATABASE_URL to run it",
+)
+@pytest.mark.django_db
+def test_partition_tables_postgresql(mocker, organization, partner):
+    """Test converting the message and MDN tables, creating and dropping their
+    partitions on a PostgreSQL server."""
+    mocker.patch("pyas2.settings.PARTITION_INTERVAL", "day")
+    mocker.patch("pyas2.settings.PARTITION_PREMAKE", 2)
+    mocker.patch("pyas2.settings.MAX_ARCH_DAYS", 30)
+    now = timezone.now()
+    # The expired message is created last, its id is the highest
+    for message_id, days_ago in [("recent", 1), ("expired", 40)]:
+        message = Message.objects.create(
+            message_id=message_id,
+            direction="OUT",
+            status="S",
+            organization=organization,
+            partner=partner,
+        )
+        Mdn.objects.create(mdn_id=message_id, message=message, status="S")
+        message.add_timing("http", 0.1)
+        message.save_timings()
+        Message.objects.filter(pk=message.pk).update(
+            timestamp=now - timedelta(days_ago)
+        )
+        Mdn.objects.filter(message=message).update(timestamp=now - timedelta(days_ago))
+
+    expired_folder = "messages/__store/payload/sent/" + (now - timedelta(40)).strftime(
+        "%Y%m%d"
+    )
+    default_storage.save(f"{expired_folder}/expired.msg", ContentFile(b"payload"))
+
+    out = StringIO()
+    management.call_command("partitionas2tables", setup=True, stdout=out)
+    partitioner = TablePartitioner(Message)
+    assert partitioner.is_partitioned()
+    assert TablePartitioner(Mdn).is_partitioned()
+    partitions = partitioner.partitions()
+    assert "pyas2_message_default" in partitions
+    for days in [-1, 0, 2]:
+        day = now.date() + timedelta(days)
+        assert partition_name("pyas2_message", day, "day") in partitions
+
+    # The partition of the expired message is dropped along with its MDN and
+    # timings, the recent message is kept
+    assert list(Message.objects.values_list("message_id", flat=True)) == ["recent"]
+    assert list(Mdn.objects.values_list("mdn_id", flat=True)) == ["recent"]
+    assert MessageTimings.objects.count() == 1
+    assert not default_storage.exists(f"{expired_folder}/expired.msg")
+
+    # The duplicates are detected by the application
+    mocker.patch.dict(Message.objects.__dict__, {"partitioned": None})
+    del Message.objects.partitioned
+    assert Message.objects.partitioned
+    with pytest.raises(IntegrityError):
+        Message.objects.check_unique("recent", partner.as2_name)
+    Message.objects.check_unique("other", partner.as2_name)
+
+    out = StringIO()
+    management.call_command("partitionas2tables", stdout=out)
+    assert 'Created 0 and dropped 0 partitions of table "pyas2_message"' in (
+        out.getvalue()
+    )
+
+
+@pytest.mark.django_db
+def test_inline_payloads(mocker, organization, partner):
+    """Test that small payloads are compressed into the database and larger
+    ones saved to the storage."""
+    mocker.patch("pyas2.settings.INLINE_PAYLOAD_MAX_SIZE", 16)
+    message = Message.objects.create(
+        message_id="inline",
+        direction="OUT",
+        status="S",
+        organization=organization,
+        partner=partner,
+    )
+    message.payload.save("inline.msg", ContentFile(b"small payload"))
+    assert not default_storage.exists(message.payload.name)
+
+    message = Message.objects.get(pk=message.pk)
+    assert message.payload_inline is not None
+    assert message.payload.read() == b"small payload"
+    assert message.payload.size == len(b"small payload")
+    assert readfilefield(Message.objects.get(pk=message.pk).payload) == "small payload"
+
+    message.payload.delete()
+    message = Message.objects.get(pk=message.pk)
+    assert not message.payload and message.payload_inline is None
+
+    message.payload.save("large.msg", ContentFile(b"payload above the threshold"))
+    message = Message.objects.get(pk=message.pk)
+    assert message.payload_inline is None
+    assert default_storage.exists(message.payload.name)
+    assert message.payload.read() == b"payload above the threshold"
+    message.payload.delete()
+
+
+@pytest.mark.django_db
+def test_create_message_rolls_back_files(mocker, organization, partner):
+    """Test that the files written for a message are deleted along with its
+    row when the message cannot be saved."""
+    as2message = As2Message(
+        sender=As2Organization(as2_name=partner.as2_name),
+        receiver=As2Partner(as2_name=organization.as2_name, compress=False),
+    )
+    as2message.build(b"test data", filename="testmessage.edi")
+    as2message.message_id = "rolled-back"
+
+    def list_files():
+        return {
+            os.path.join(root, name)
+            for root, _, names in os.walk(settings.MEDIA_ROOT)
+            for name in names
+        }
+
+    files = list_files()
+    original_save = Message.save
+
+    def save(message, *args, **kwargs):
+        if kwargs.get("update_fields"):
+            raise DatabaseError("Connection lost")
+        return original_save(message, *args, **kwargs)
+
+    mocker.patch.object(Message, "save", save)
+    with pytest.raises(DatabaseError):
+        Message.objects.create_from_as2message(
+            as2message=as2message, payload=b"x" * 1024, direction="IN", status="S"
+        )
+    assert not Message.objects.filter(message_id="rolled-back").exists()
+    assert list_files() == files
+
+
+@pytest.mark.django_db
+def test_retry_replays_envelope(mocker, organization, partner):
+    """Test that the retries send the envelope of the first send again
+    without building the message again."""
+    as2message = As2Message(sender=organization.as2org, receiver=partner.as2partner)
+    as2message.build(b"test data", filename="testmessage.edi")
+    message, _ = Message.objects.create_from_as2message(
+        as2message=as2message, payload=b"test data", direction="OUT", status="P"
+    )
+    mocked_post = mocker.patch(
+        "requests.post", side_effect=RequestsConnectionError("Refused")
+    )
+    message.send_message(as2message.headers, as2message.content)
+    message.refresh_from_db()
+    assert message.status == "R"
+    assert message.load_envelope() == (as2message.headers, as2message.content)
+
+    mocked_build = mocker.patch("pyas2.management.commands.manageas2server.AS2Message")
+    mocked_post.side_effect = None
+    Message.objects.update(next_attempt_at=timezone.now())
+    management.call_command("manageas2server", retry=True)
+    assert not mocked_build.called
+    retry_kwargs = mocked_post.call_args.kwargs
+    assert retry_kwargs["headers"] == as2message.headers
+    assert as2message.headers["Message-ID"] == f"<{message.message_id}>"
+    assert retry_kwargs["data"] == as2message.content
+
+    # The envelope is dropped once the message is sent
+    message.refresh_from_db()
+    assert message.status == "S"
+    assert message.envelope is None
@@ -1,11 +1,17 @@
 import os
 
+import pytest
 from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
 from django.test import TestCase, Client
+from django.test.client import ClientHandler
 from django.urls import reverse
+from pyas2lib import Message as As2Message
+from pyas2lib import Organization as As2Organization
+from pyas2lib import Partner as As2Partner
 
 from pyas2.models import PublicCertificate, PrivateKey, Message, Mdn
+from pyas2.receive_app import ReceiveHandlerMixin
 from pyas2.tests import TEST_DIR
 
 
@@ -136,3 +142,42 @@ def test_send_as2_message_view(mocker, client, admin_client, organization, partn
         response = admin_client.post(reverse("as2-send"), data=post_data)
     assert response.status_code == 302
     assert mocked_send_message.call_count == 1
+
+
+class ReceiveClientHandler(ReceiveHandlerMixin, ClientHandler):
+    """Test client handler using the receive only application."""
+
+
+@pytest.mark.django_db
+def test_receive_app(organization, partner):
+    """Test that the receive only application receives messages without
+    running the middleware."""
+    as2message = As2Message(
+        sender=As2Organization(as2_name=partner.as2_name),
+        receiver=As2Partner(as2_name=organization.as2_name, compress=False),
+    )
+    as2message.build(b"test data", filename="testmessage.edi")
+    content_type = as2message.headers.pop("Content-Type")
+    http_headers = {
+        "HTTP_%s" % key.replace("-", "_").upper(): value
+        for key, value in as2message.headers.items()
+    }
+
+    client = Client()
+    client.handler = ReceiveClientHandler()
+    response = client.post(
+        "/pyas2/as2receive",
+        data=as2message.content,
+        content_type=content_type,
+        **http_headers,
+    )
+    assert response.status_code == 200
+    assert "X-Content-Type-Options" not in response
+    message = Message.objects.get(message_id=as2message.message_id, direction="IN")
+    assert message.status == "S"
+    assert message.payload.read() == b"test data"
+
+    # Only the receive urls are served
+    assert client.get("/as2receive/").status_code == 200
+    assert client.get("/admin/").status_code == 404
+    assert Client().get("/pyas2/as2receive")["X-Content-Type-Options"] == "nosniff"
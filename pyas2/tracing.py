@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from django.utils.module_loading import import_string
+
+from pyas2 import settings
+
+logger = logging.getLogger("pyas2")
+
+SPAN_KIND_INTERNAL = "SPAN_KIND_INTERNAL"
+SPAN_KIND_SERVER = "SPAN_KIND_SERVER"
+SPAN_KIND_CLIENT = "SPAN_KIND_CLIENT"
+
+STATUS_CODE_UNSET = "STATUS_CODE_UNSET"
+STATUS_CODE_OK = "STATUS_CODE_OK"
+STATUS_CODE_ERROR = "STATUS_CODE_ERROR"
+
+# Number of finished spans kept for a span that has not ended, they are
+# exported early once reached so long running operations do not grow the memory
+MAX_BUFFERED_SPANS = 512
+
+_current_span = contextvars.ContextVar("pyas2_current_span", default=None)
+
+
+def message_trace_id(message_id):
+    """Return the trace id shared by all the spans of an AS2 message."""
+    return hashlib.sha256(message_id.encode()).hexdigest()[:32]
+
+
+def message_span_id(message_id):
+    """Return the id of the span that first handled an AS2 message, the later
+    spans of the message such as its retries and MDNs are its children."""
+    return hashlib.sha256(message_id.encode()).hexdigest()[32:48]
+
+
+class Span:
+    """A timed operation following the OpenTelemetry data model, the ids of
+    its trace are resolved when it is exported so that they can be linked to
+    an AS2 message once its id is known."""
+
+    def __init__(self, name, kind=SPAN_KIND_INTERNAL, attributes=None, parent=None):
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.root = parent.root if parent else self
+        self.finished = []
+        self.trace_id = None if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = None
+        self.status_code = STATUS_CODE_UNSET
+        self.status_message = None
+        self.events = []
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    @property
+    def duration(self):
+        """Return the duration of the span in seconds."""
+        return ((self.end_time or time.time_ns()) - self.start_time) / 1e9
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_status(self, code, message=None):
+        self.status_code = code
+        self.status_message = message
+
+    def add_event(self, name):
+        """Record the time of an event that happened during the span."""
+        self.events.append((name, time.time_ns()))
+
+    def elapsed_since(self, name):
+        """Return the seconds from the first event with the name to the end of
+        the span, or 0 if the event did not happen."""
+        for event_name, event_time in self.events:
+            if event_name == name:
+                return ((self.end_time or time.time_ns()) - event_time) / 1e9
+        return 0
+
+    def link_message(self, message_id, first=False):
+        """Add the trace of these spans to the trace of the AS2 message, the
+        spans are the root of the trace if they first handled the message."""
+        root = self.root
+        root.trace_id = message_trace_id(message_id)
+        if first:
+            root.span_id = message_span_id(message_id)
+            root.parent_span_id = None
+        else:
+            root.parent_span_id = message_span_id(message_id)
+        self.set_attribute("as2.message_id", message_id)
+
+    def to_dict(self):
+        """Return the span in the OTLP JSON format."""
+        parent_span_id = (
+            self.parent.span_id if self.parent else self.parent_span_id
+        ) or ""
+        span = {
+            "traceId": self.root.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": parent_span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": [
+                {"key": key, "value": _attribute_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "events": [
+                {"timeUnixNano": str(event_time), "name": event_name}
+                for event_name, event_time in self.events
+            ],
+            "status": {"code": self.status_code},
+        }
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class NonRecordingSpan:
+    """Span returned when there is no current operation, it records nothing."""
+
+    duration = 0
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_status(self, code, message=None):
+        pass
+
+    def add_event(self, name):
+        pass
+
+    def elapsed_since(self, name):
+        return 0
+
+    def link_message(self, message_id, first=False):
+        pass
+
+
+NON_RECORDING_SPAN = NonRecordingSpan()
+
+
+class SpanExporter:
+    """Interface of the span exporters set with the ``TRACING_EXPORTER``
+    setting, they receive the spans of a request or command once it is
+    done."""
+
+    def export(self, spans):
+        """Export the finished spans."""
+        raise NotImplementedError
+
+
+class JsonFileExporter(SpanExporter):
+    """Append the spans to the ``TRACING_FILE`` file, one span in the OTLP JSON
+    format per line."""
+
+    def __init__(self, path=None):
+        self.path = path or settings.TRACING_FILE
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = "".join(json.dumps(span.to_dict()) + "\n" for span in spans)
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a") as trace_file:
+                trace_file.write(lines)
+
+
+@functools.lru_cache(maxsize=None)
+def get_exporter():
+    """Return the exporter set with the ``TRACING_EXPORTER`` setting, or None
+    when tracing is disabled."""
+    if not settings.TRACING_EXPORTER:
+        return None
+    return import_string(settings.TRACING_EXPORTER)()
+
+
+def get_current_span():
+    """Return the span of the current operation."""
+    return _current_span.get() or NON_RECORDING_SPAN
+
+
+@contextmanager
+def start_span(name, kind=SPAN_KIND_INTERNAL, attributes=None):
+    """Trace the block as a child of the current span. The spans are always
+    timed, as their durations are used for the message timings, and are only
+    kept for the export if tracing is enabled. They are exported once the
+    outermost span ends, or earlier when ``MAX_BUFFERED_SPANS`` are waiting."""
+    span = Span(name, kind, attributes, parent=_current_span.get())
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_status(STATUS_CODE_ERROR, str(e))
+        span.set_attribute("exception.type", type(e).__name__)
+        span.set_attribute("exception.message", str(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end_time = time.time_ns()
+        exporter = get_exporter()
+        if exporter:
+            root = span.root
+            root.finished.append(span)
+            if span is root or len(root.finished) >= MAX_BUFFERED_SPANS:
+                spans, root.finished = root.finished, []
+                try:
+                    exporter.export(spans)
+                except Exception:  # pylint: disable=W0703
+                    logger.exception("Failed to export the trace spans.")
+
+
+def traced(name, kind=SPAN_KIND_INTERNAL):
+    """Decorator tracing each call of the function as a span."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with start_span(name, kind):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,10 +1,13 @@
 import logging
 import os
+import traceback
 
 from django.contrib import messages
+from django.db import IntegrityError
 from django.shortcuts import Http404
 from django.shortcuts import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext as _
 from django.urls import reverse_lazy
@@ -16,15 +19,19 @@ from pyas2lib import Message as As2Message
 from pyas2lib import Mdn as As2Mdn
 from pyas2lib.exceptions import DuplicateDocument
 
+from pyas2 import settings
+from pyas2 import tasks
 from pyas2.models import Mdn
 from pyas2.models import Message
+from pyas2.models import MessageTimings
 from pyas2.models import Organization
 from pyas2.models import Partner
 from pyas2.models import PrivateKey
 from pyas2.models import PublicCertificate
-from pyas2.utils import run_post_receive
-from pyas2.utils import run_post_send
+from pyas2.profiling import profile_message, profiled
+from pyas2.ratelimit import receive_admission
 from pyas2.forms import SendAs2MessageForm
+from pyas2.tracing import SPAN_KIND_SERVER, get_current_span, start_span, traced
 
 logger = logging.getLogger("pyas2")
 
@@ -36,6 +43,39 @@ class ReceiveAs2Message(View):
     Checks whether its an AS2 message or an MDN and acts accordingly.
     """
 
+    def dispatch(self, request, *args, **kwargs):
+        """Refuse the AS2 messages over the in-flight limits of the process
+        before their body is read, so that the admitted ones are not slowed
+        down by a burst."""
+        if request.method != "POST":
+            return super().dispatch(request, *args, **kwargs)
+
+        try:
+            size = int(request.META.get("CONTENT_LENGTH"))
+        except (TypeError, ValueError):
+            # The size of the chunked requests is only known once read
+            if settings.RECEIVE_MAX_IN_FLIGHT_BYTES:
+                logger.warning(
+                    f"Refused an HTTP POST without Content-Length from "
+                    f'{request.META["REMOTE_ADDR"]}.'
+                )
+                return HttpResponse(_("Content-Length is required"), status=411)
+            size = 0
+        if not receive_admission.try_acquire(size):
+            logger.warning(
+                f'Refused an HTTP POST of {size} bytes from {request.META["REMOTE_ADDR"]}, '
+                f"too many messages are being received."
+            )
+            response = HttpResponse(
+                _("AS2 server is busy, please retry later"), status=503
+            )
+            response["Retry-After"] = str(settings.RECEIVE_RETRY_AFTER)
+            return response
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            receive_admission.release(size)
+
     @staticmethod
     def find_message(message_id, partner_id):
         """Find the message using the message_id  and return its pyas2 type"""
@@ -49,9 +89,9 @@ class ReceiveAs2Message(View):
     @staticmethod
     def check_message_exists(message_id, partner_id):
         """Check if the message already exists in the system"""
-        return Message.objects.filter(
-            message_id=message_id, partner_id=partner_id.strip()
-        ).exists()
+        # Mark the end of the parsing, the decryption and verification follow
+        get_current_span().add_event("as2.duplicate_check")
+        return Message.objects.message_exists(message_id, partner_id.strip())
 
     @staticmethod
     def find_organization(org_id):
@@ -71,19 +111,22 @@ class ReceiveAs2Message(View):
 
     @xframe_options_exempt
     @csrf_exempt
+    @profiled
+    @traced("as2.receive", kind=SPAN_KIND_SERVER)
     def post(self, request, *args, **kwargs):
         """Handle the post message received by the AS2 server."""
         # extract the  headers from the http request
-        as2headers = ""
-        for key in request.META:
-            if key.startswith("HTTP") or key.startswith("CONTENT"):
-                as2headers += (
-                    f'{key.replace("HTTP_", "").replace("_", "-").lower()}: '
-                    f"{request.META[key]}\n"
-                )
-
-        # build the body along with the headers
-        request_body = as2headers.encode() + b"\r\n" + request.body
+        with start_span("as2.headers.extract") as extract_span:
+            as2headers = ""
+            for key in request.META:
+                if key.startswith("HTTP") or key.startswith("CONTENT"):
+                    as2headers += (
+                        f'{key.replace("HTTP_", "").replace("_", "-").lower()}: '
+                        f"{request.META[key]}\n"
+                    )
+
+            # build the body along with the headers
+            request_body = as2headers.encode() + b"\r\n" + request.body
         logger.debug(
             f'Received an HTTP POST from {request.META["REMOTE_ADDR"]} '
             f"with payload :\n{request_body}"
@@ -94,12 +137,21 @@ class ReceiveAs2Message(View):
         as2mdn = As2Mdn()
 
         # Parse the mdn and get the message status
-        status, detailed_status = as2mdn.parse(request_body, self.find_message)
+        with start_span("as2.mdn.parse") as mdn_span:
+            status, detailed_status = as2mdn.parse(request_body, self.find_message)
 
         if not detailed_status == "mdn-not-found":
+            get_current_span().link_message(as2mdn.orig_message_id)
             message = Message.objects.get(
                 message_id=as2mdn.orig_message_id, direction="OUT"
             )
+            sent_at = (
+                MessageTimings.objects.filter(message=message)
+                .values_list("sent_at", flat=True)
+                .first()
+            )
+            if sent_at:
+                message.add_timing("mdn", (timezone.now() - sent_at).total_seconds())
             logger.info(
                 f"Asynchronous MDN received for AS2 message {as2mdn.message_id} to organization "
                 f"{message.organization.as2_name} from partner {message.partner.as2_name}"
@@ -108,7 +160,10 @@ class ReceiveAs2Message(View):
             # Update the message status and return the response
             if status == "processed":
                 message.status = "S"
-                run_post_send(message)
+                with start_span("as2.post_send") as span:
+                    if message.partner.cmd_send:
+                        tasks.enqueue("post_send", message_id=message.pk)
+                message.add_timing("hooks", span.duration)
             else:
                 message.status = "E"
                 message.detailed_status = (
@@ -117,18 +172,24 @@ class ReceiveAs2Message(View):
             # Save the message and create the mdn
             message.save()
             Mdn.objects.create_from_as2mdn(as2mdn=as2mdn, message=message, status="R")
+            message.save_timings()
 
             return HttpResponse(_("AS2 ASYNC MDN has been received"))
 
         else:
             logger.debug("Payload is not an MDN parse it as an AS2 Message")
             as2message = As2Message()
-            status, exception, as2mdn = as2message.parse(
-                request_body,
-                self.find_organization,
-                self.find_partner,
-                self.check_message_exists,
-            )
+            # Decryption and signature verification are part of the parsing
+            with start_span("as2.message.parse") as span:
+                status, exception, as2mdn = as2message.parse(
+                    request_body,
+                    self.find_organization,
+                    self.find_partner,
+                    self.check_message_exists,
+                )
+                span.set_attribute("as2.encrypted", bool(as2message.encrypted))
+                span.set_attribute("as2.signed", bool(as2message.signed))
+                span.set_attribute("as2.compressed", bool(as2message.compressed))
 
             logger.info(
                 f'Received an AS2 message with id {as2message.headers.get("message-id")} for '
@@ -139,20 +200,68 @@ class ReceiveAs2Message(View):
             # In case of duplicates update message id
             if isinstance(exception[0], DuplicateDocument):
                 as2message.message_id += "_duplicate"
+            if as2message.message_id:
+                get_current_span().link_message(as2message.message_id, first=True)
 
             # Create the Message and MDN objects
-            message, full_fn = Message.objects.create_from_as2message(
-                as2message=as2message,
-                filename=as2message.payload.get_filename(),
-                payload=as2message.content,
-                direction="IN",
-                status="S" if status == "processed" else "E",
-                detailed_status=exception[1],
+            try:
+                message, full_fn = Message.objects.create_from_as2message(
+                    as2message=as2message,
+                    filename=as2message.payload.get_filename(),
+                    payload=as2message.content,
+                    direction="IN",
+                    status="S" if status == "processed" else "E",
+                    detailed_status=exception[1],
+                    overwrite=isinstance(exception[0], DuplicateDocument),
+                )
+            except IntegrityError:
+                # The duplicate was not detected before the parsing, e.g. it
+                # was received by another process meanwhile, keep the
+                # original message and answer as for any other duplicate
+                logger.warning(
+                    f"Duplicate message {as2message.message_id} received from "
+                    f"partner {as2message.sender.as2_name}."
+                )
+                status = DuplicateDocument.disposition_type
+                exception = (
+                    DuplicateDocument(
+                        "Duplicate message received, message with this ID "
+                        "already processed."
+                    ),
+                    traceback.format_exc(),
+                )
+                as2message.message_id += "_duplicate"
+                if as2mdn:
+                    as2mdn.build(
+                        message=as2message,
+                        status=status,
+                        detailed_status=DuplicateDocument.disposition_modifier,
+                    )
+                message, full_fn = Message.objects.create_from_as2message(
+                    as2message=as2message,
+                    filename=as2message.payload.get_filename(),
+                    payload=as2message.content,
+                    direction="IN",
+                    status="E",
+                    detailed_status=exception[1],
+                    overwrite=True,
+                )
+            profile_message(message)
+            crypto_time = span.elapsed_since("as2.duplicate_check")
+            message.add_timing("crypto", crypto_time)
+            message.add_timing(
+                "parse",
+                extract_span.duration + mdn_span.duration + span.duration - crypto_time,
             )
 
             # run post receive command on success
             if status == "processed":
-                run_post_receive(message, full_fn)
+                with start_span("as2.post_receive") as span:
+                    if message.partner.cmd_receive:
+                        tasks.enqueue(
+                            "post_receive", message_id=message.pk, full_filename=full_fn
+                        )
+                message.add_timing("hooks", span.duration)
 
             # Return the mdn in case of sync else return text message
             if as2mdn and as2mdn.mdn_mode == "SYNC":
@@ -162,16 +271,22 @@ class ReceiveAs2Message(View):
                 response = HttpResponse(as2mdn.content)
                 for key, value in as2mdn.headers.items():
                     response[key] = value
-                return response
-
-            elif as2mdn and as2mdn.mdn_mode == "ASYNC":
-                Mdn.objects.create_from_as2mdn(
-                    as2mdn=as2mdn,
-                    message=message,
-                    status="P",
-                    return_url=as2mdn.mdn_url,
-                )
-            return HttpResponse(_("AS2 message has been received"))
+            else:
+                if as2mdn and as2mdn.mdn_mode == "ASYNC":
+                    mdn = Mdn.objects.create_from_as2mdn(
+                        as2mdn=as2mdn,
+                        message=message,
+                        status="P",
+                        return_url=as2mdn.mdn_url,
+                    )
+                    # The inline backend leaves the MDN to manageas2server so
+                    # that this response is not held up, the other backends
+                    # may send it before this response has gone out
+                    if not tasks.get_backend().runs_inline:
+                        tasks.enqueue("send_async_mdn", mdn_id=mdn.pk)
+                response = HttpResponse(_("AS2 message has been received"))
+            message.save_timings()
+            return response
 
     def get(self, request, *args, **kwargs):
         """Handle the GET call made to the AS2 server post endpoint."""
@@ -222,14 +337,17 @@ class SendAs2Message(FormView):
             f'Building message from {form.cleaned_data["file"].name} to send to partner '
             f"{as2message.receiver.as2_name} from org {as2message.sender.as2_name}."
         )
-        as2message.build(
-            payload,
-            filename=form.cleaned_data["file"].name,
-            subject=form.cleaned_data["partner"].subject,
-            content_type=form.cleaned_data["partner"].content_type,
-            disposition_notification_to=form.cleaned_data["organization"].email_address
-            or "no-reply@pyas2.com",
-        )
+        with start_span("as2.build") as build_span:
+            as2message.build(
+                payload,
+                filename=form.cleaned_data["file"].name,
+                subject=form.cleaned_data["partner"].subject,
+                content_type=form.cleaned_data["partner"].content_type,
+                disposition_notification_to=form.cleaned_data[
+                    "organization"
+                ].email_address
+                or "no-reply@pyas2.com",
+            )
 
         message, _ = Message.objects.create_from_as2message(
             as2message=as2message,
@@ -237,9 +355,13 @@ class SendAs2Message(FormView):
             filename=form.cleaned_data["file"].name,
             direction="OUT",
             status="P",
+            priority=form.cleaned_data.get("priority")
+            or form.cleaned_data["partner"].default_priority,
         )
-        message.send_message(as2message.headers, as2message.content)
-        if message.status in ["S", "P"]:
+        message.add_timing("crypto", build_span.duration)
+        if not tasks.dispatch_send(message, as2message.headers, as2message.content):
+            messages.success(self.request, "Message has been queued for sending.")
+        elif message.status in ["S", "P"]:
             messages.success(
                 self.request, "Message has been successfully send to Partner."
             )
@@ -264,6 +386,12 @@ class DownloadFile(View):
             filename = os.path.basename(obj.payload.name)
             file_content = obj.payload.read()
 
+        elif obj_type == "message_profile":
+            obj = get_object_or_404(MessageTimings, message_id=obj_id)
+            if obj.profile:
+                filename = os.path.basename(obj.profile.name)
+                file_content = obj.profile.read()
+
         elif obj_type == "mdn_payload":
             obj = get_object_or_404(Mdn, pk=obj_id)
             filename = os.path.basename(obj.payload.name)
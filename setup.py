@@ -59,5 +59,6 @@ setup(
     tests_require=tests_require,
     extras_require={
         "tests": tests_require,
+        "watch": ["watchdog"],
     },
 )